@@ -1,3 +1,7 @@
 from .save_stack import save_stack
 from .results_viewer import view_results
-from .stack_from_tif import stack_from_tif
\ No newline at end of file
+from .stack_from_tif import stack_from_tif
+from .stack_from_zarr import stack_from_zarr
+from .precompute_results import precompute_results
+from .pyramid import image_pyramid, label_pyramid
+from .run_pipeline import SpotPipeline, run_pipeline
\ No newline at end of file
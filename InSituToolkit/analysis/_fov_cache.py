@@ -0,0 +1,119 @@
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+from typing import Any, Callable, Hashable, Iterable
+
+import numpy as np
+
+
+def _nbytes(data) -> int:
+    """
+    Returns the memory held by the arrays in nested lists, tuples and dicts.
+    numpy arrays count with their size. Lazy arrays (e.g. zarr or dask arrays
+    of the sidecar store) only read the chunks that are viewed, so they count
+    with the size of one chunk, or nothing if they have no chunks.
+    """
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    elif hasattr(data, 'shape') and hasattr(data, 'dtype'):
+        # dask arrays have the chunk shape as chunksize, zarr arrays as chunks
+        chunks = getattr(data, 'chunksize', getattr(data, 'chunks', None))
+        if chunks is None or not all(isinstance(n, (int, np.integer)) for n in chunks):
+            return 0
+        return int(np.prod(chunks, dtype=np.int64)) * np.dtype(data.dtype).itemsize
+    elif isinstance(data, dict):
+        return sum(_nbytes(v) for v in data.values())
+    elif isinstance(data, (list, tuple)):
+        return sum(_nbytes(v) for v in data)
+
+    return 0
+
+
+class FovCache:
+    """
+    Memory-bounded LRU cache of loaded fields of view that loads entries in a
+    background thread
+
+    Parameters
+    ----------
+    load_func : Callable[[Hashable], Any]
+        Function that loads the data for a key
+    max_bytes : int
+        Size budget of the cached arrays in bytes. The least recently used
+        entries are evicted when it is exceeded. The most recently loaded entry
+        is always kept. The default value is 2 GB.
+    n_workers : int
+        Number of loader threads. The default value is 1.
+    """
+    def __init__(self, load_func: Callable[[Hashable], Any], max_bytes: int = 2 * 1024 ** 3, n_workers: int = 1):
+        self.load_func = load_func
+        self.max_bytes = max_bytes
+
+        self._cache = OrderedDict()
+        self._sizes = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=n_workers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._cache
+
+    def request(self, key: Hashable) -> Future:
+        """
+        Returns a future for the data of a key. The future is already done
+        if the key is cached, otherwise the key is loaded in the background.
+        """
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                future = Future()
+                future.set_result(self._cache[key])
+                return future
+
+            if key not in self._pending:
+                self._pending[key] = self._executor.submit(self._load, key)
+
+            return self._pending[key]
+
+    def prefetch(self, keys: Iterable[Hashable]):
+        """
+        Starts loading the keys that are not cached
+        """
+        for key in keys:
+            self.request(key)
+
+    def _load(self, key: Hashable):
+        try:
+            data = self.load_func(key)
+        except BaseException:
+            with self._lock:
+                self._pending.pop(key, None)
+            raise
+
+        with self._lock:
+            self._pending.pop(key, None)
+            self._cache[key] = data
+            self._sizes[key] = _nbytes(data)
+            self._evict(keep=key)
+
+        return data
+
+    def _evict(self, keep: Hashable):
+        size = sum(self._sizes.values())
+        for key in list(self._cache):
+            if size <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            del self._cache[key]
+            size -= self._sizes.pop(key)
+
+    def shutdown(self):
+        """
+        Stops the loader threads and clears the cache
+        """
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            self._cache.clear()
+            self._sizes.clear()
@@ -0,0 +1,159 @@
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import zarr
+
+# Size of the square (y, x) chunks of the image arrays in the sidecar store
+_CHUNK_SIZE = 512
+
+
+def open_sidecar(path: str, mode: str = 'r') -> zarr.Group:
+    """
+    Opens the sidecar store of precomputed results
+    """
+    return zarr.open_group(path, mode=mode)
+
+
+def _write_levels(group: zarr.Group, name: str, levels: Sequence[np.ndarray]):
+    """
+    Writes the levels of a pyramid as the arrays 0, 1, ... of a subgroup,
+    replacing the subgroup if it exists. The arrays are chunked in (y, x), so
+    a viewer only reads the visible tiles of a level.
+    """
+    if name in group:
+        del group[name]
+    levels_group = group.create_group(name)
+    for i, level in enumerate(levels):
+        chunks = level.shape[:-2] + tuple(min(n, _CHUNK_SIZE) for n in level.shape[-2:])
+        levels_group.array(str(i), level, chunks=chunks, overwrite=True)
+
+
+def _read_levels(group: zarr.Group, name: str, n_levels: int) -> Optional[List[zarr.Array]]:
+    """
+    Returns the n_levels levels of a pyramid written by _write_levels without
+    reading them, or None if the subgroup is missing
+    """
+    if name not in group:
+        return None
+    levels_group = group[name]
+
+    return [levels_group[str(i)] for i in range(n_levels)]
+
+
+def _file_stat(path: str) -> Optional[Dict]:
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, TypeError):
+        return None
+
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def fov_sources(spot_file: str, mask_file: str = None, experiment_path: str = None) -> Dict:
+    """
+    Returns the size and modification time of the spot file and the mask file
+    of a field of view, and the path and stat of the experiment file if it is
+    given. The sources are stored with the results by write_fov and compared
+    by read_fov, so results computed from older files are not used.
+    """
+    sources = {
+        'spot_file': _file_stat(spot_file),
+        'mask_file': _file_stat(mask_file),
+    }
+    if experiment_path is not None:
+        sources['experiment'] = {
+            'path': os.path.abspath(experiment_path),
+            'stat': _file_stat(experiment_path)
+        }
+
+    return sources
+
+
+def is_current(sidecar: zarr.Group, fov_name: str, sources: Dict = None) -> bool:
+    """
+    Returns True if the sidecar store has the complete results of a field of
+    view, computed from the given sources. If sources is None, the sources
+    aren't checked. Only the sources that are given are compared, e.g. the
+    experiment is ignored if it isn't in sources.
+    """
+    if fov_name not in sidecar:
+        return False
+    attrs = sidecar[fov_name].attrs
+    if not attrs.get('complete', False):
+        return False
+    if sources is None:
+        return True
+
+    stored = attrs.get('sources', {})
+
+    return all(stored.get(key) == value for key, value in sources.items())
+
+
+def write_fov(
+              sidecar: zarr.Group, fov_name: str, pyramid: Sequence[np.ndarray],
+              points: List[Dict], mask_pyramid: Sequence[np.ndarray] = None,
+              sources: Dict = None
+             ):
+    """
+    Writes the max projection pyramid, the points and optionally the mask
+    pyramid of a field of view to the sidecar store. The points of all
+    targets are stored as one array sorted by target with the offset of each
+    target. sources, from fov_sources, records the files the results were
+    computed from.
+
+    The field of view is marked complete after all arrays are written, so the
+    results of an interrupted write are ignored by read_fov. The results of an
+    earlier write of the field of view are replaced, including its mask.
+    """
+    group = sidecar.require_group(fov_name)
+    group.attrs['complete'] = False
+
+    _write_levels(group, 'max_proj', pyramid)
+    if mask_pyramid is not None:
+        _write_levels(group, 'mask', mask_pyramid)
+    elif 'mask' in group:
+        del group['mask']
+
+    coords = [point['coords'] for point in points]
+    offsets = np.cumsum([0] + [len(c) for c in coords])
+    group.array(
+        'points',
+        np.concatenate(coords) if coords else np.empty((0, 3)),
+        overwrite=True
+    )
+    group.attrs.update({
+        'n_levels': len(pyramid),
+        'n_mask_levels': len(mask_pyramid) if mask_pyramid is not None else 0,
+        'targets': [str(point['name']) for point in points],
+        'offsets': offsets.tolist(),
+        'sources': sources if sources is not None else {},
+        'complete': True
+    })
+
+
+def read_fov(
+             sidecar: zarr.Group, fov_name: str, sources: Dict = None
+            ) -> Optional[Tuple[List[zarr.Array], List[Dict], Optional[List[zarr.Array]]]]:
+    """
+    Reads a field of view from the sidecar store. The pyramid levels are
+    returned as zarr arrays and are read when they are indexed. The mask
+    pyramid is None if it wasn't stored. Returns None if the field of view is
+    missing or incomplete, or if it was computed from other sources than the
+    given ones (see is_current).
+    """
+    if not is_current(sidecar, fov_name, sources):
+        return None
+    group = sidecar[fov_name]
+
+    pyramid = _read_levels(group, 'max_proj', group.attrs['n_levels'])
+    mask_pyramid = _read_levels(group, 'mask', group.attrs.get('n_mask_levels', len(group.get('mask', ()))))
+
+    coords = group['points'][...]
+    offsets = group.attrs['offsets']
+    points = [
+        {'coords': coords[offsets[i]:offsets[i + 1]], 'name': target}
+        for i, target in enumerate(group.attrs['targets'])
+    ]
+
+    return pyramid, points, mask_pyramid
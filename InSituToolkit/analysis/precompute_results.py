@@ -0,0 +1,154 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+import pandas as pd
+from skimage import io
+from starfish import Experiment
+
+from InSituToolkit.analysis._sidecar import fov_sources, is_current, open_sidecar, write_fov
+from InSituToolkit.analysis.pyramid import image_pyramid, label_pyramid
+from InSituToolkit.analysis.results_viewer import _compute_results, _mask_file, _target_channels
+
+# Experiment and target channels of each worker process
+_worker_state = {}
+
+def _parse_args():
+    """
+    Parse arguments for the CLI
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--fovs',
+        type=str,
+        required=True,
+        help="Path to the fov data",
+    )
+    parser.add_argument(
+        '--exp',
+        type=str,
+        required=True,
+        help="Path to experiment file",
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        required=True,
+        help="Path to the precomputed results store",
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help="Number of fields of view processed in parallel",
+    )
+    parser.add_argument(
+        '--overwrite',
+        action='store_true',
+        help="Recompute the fields of view already in the store",
+    )
+
+    return parser.parse_args()
+
+
+def _init_worker(experiment_path: str):
+    exp = Experiment.from_json(experiment_path)
+    _worker_state['experiment_path'] = experiment_path
+    _worker_state['exp'] = exp
+    _worker_state['target_channels'] = _target_channels(exp.codebook)
+
+
+def _precompute_fov(fov_data: pd.Series, output_path: str, min_size: int) -> str:
+    exp = _worker_state['exp']
+    mask_file = _mask_file(fov_data)
+    # Taken before reading the files, so results of files changed while they
+    # are computed are stale
+    sources = fov_sources(fov_data.spot_file, mask_file, _worker_state['experiment_path'])
+
+    im_max_proj, points = _compute_results(fov_data, exp, _worker_state['target_channels'])
+
+    mask_pyramid = None
+    if mask_file is not None:
+        mask_pyramid = label_pyramid(io.imread(mask_file), min_size)
+
+    sidecar = open_sidecar(output_path, mode='a')
+    write_fov(
+        sidecar, fov_data.fov_name, image_pyramid(im_max_proj, min_size), points,
+        mask_pyramid, sources
+    )
+
+    return fov_data.fov_name
+
+
+def precompute_results(
+                       fov_df: pd.DataFrame, experiment_path: str, output_path: str,
+                       n_workers: int = 4, overwrite: bool = False, min_size: int = 256
+                      ) -> List[str]:
+    """
+    Precomputes the max projection pyramid, the points and the mask pyramid
+    of each field of view for view_results and writes them to a zarr sidecar
+    store. The fields of view are processed in parallel worker processes.
+
+    Parameters
+    ----------
+    fov_df : pd.DataFrame
+            Table of file locations for the spot results and mask label images
+            of all fields of view
+    experiment_path : str
+            Path to the experiment file corresponding to the data analysis
+    output_path : str
+            Path to the sidecar store. It is created if it doesn't exist.
+    n_workers : int
+            Number of fields of view processed in parallel. The default value
+            is 4.
+    overwrite : bool
+            If True, the fields of view already in the store are recomputed.
+            Otherwise, only the fields of view whose spot file, mask file or
+            experiment file changed since they were stored are recomputed.
+            The default value is False.
+    min_size : int
+            Size of the smallest pyramid level. The default value is 256.
+
+    Returns
+    -------
+    fov_names : List[str]
+            Names of the fields of view that were computed
+
+    """
+    sidecar = open_sidecar(output_path, mode='a')
+
+    # Fields of view from an interrupted run are incomplete and recomputed
+    todo = [
+        fov_data for _, fov_data in fov_df.iterrows()
+        if overwrite
+        or not is_current(
+            sidecar, fov_data.fov_name,
+            fov_sources(fov_data.spot_file, _mask_file(fov_data), experiment_path)
+        )
+    ]
+    if not todo:
+        return []
+
+    with ProcessPoolExecutor(
+                             max_workers=n_workers, initializer=_init_worker,
+                             initargs=(experiment_path,)
+                            ) as executor:
+        futures = [
+            executor.submit(_precompute_fov, fov_data, output_path, min_size)
+            for fov_data in todo
+        ]
+        fov_names = [future.result() for future in futures]
+
+    return fov_names
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+
+    fov_df = pd.read_csv(args.fovs)
+
+    precompute_results(
+        fov_df, args.exp, args.output,
+        n_workers=args.workers, overwrite=args.overwrite
+    )
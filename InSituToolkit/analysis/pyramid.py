@@ -0,0 +1,65 @@
+from typing import List
+
+import numpy as np
+
+def image_pyramid(image, min_size: int = 256) -> List:
+    """
+    Returns the levels of a multiscale pyramid of an image. Each level is
+    downsampled by 2 in y and x by averaging 2x2 blocks. Levels are added until
+    the smaller of y and x is at most min_size.
+
+    The downsampling only uses strided slicing and arithmetic, so a dask array,
+    e.g. of a stitched mosaic, gives lazy levels that are only computed where
+    they are read.
+
+    Parameters
+    ----------
+    image : array-like
+        Image with y and x as the last two axes
+    min_size : int
+        Size of the smallest level. The default value is 256.
+
+    Returns
+    -------
+    pyramid : List
+        The levels from full resolution to the smallest level
+    """
+    pyramid = [image]
+    while min(pyramid[-1].shape[-2:]) > min_size:
+        level = _crop_even(pyramid[-1])
+        blocks = [level[..., i::2, j::2].astype(np.float32) for i in (0, 1) for j in (0, 1)]
+        pyramid.append((sum(blocks) / 4).astype(image.dtype))
+
+    return pyramid
+
+def label_pyramid(labels, min_size: int = 256) -> List:
+    """
+    Returns the levels of a multiscale pyramid of a label image. Each level is
+    downsampled by 2 in y and x by nearest neighbor, so no new label values are
+    created at the object borders.
+
+    Parameters
+    ----------
+    labels : array-like
+        Label image with y and x as the last two axes
+    min_size : int
+        Size of the smallest level. The default value is 256.
+
+    Returns
+    -------
+    pyramid : List
+        The levels from full resolution to the smallest level
+    """
+    pyramid = [labels]
+    while min(pyramid[-1].shape[-2:]) > min_size:
+        pyramid.append(_crop_even(pyramid[-1])[..., ::2, ::2])
+
+    return pyramid
+
+def _crop_even(image):
+    """
+    Drops the last row and column of y and x if their size is odd
+    """
+    n_y, n_x = (n - n % 2 for n in image.shape[-2:])
+
+    return image[..., :n_y, :n_x]
@@ -1,12 +1,20 @@
 import argparse
+import os
+from collections import OrderedDict
 from itertools import cycle
 
 import numpy as np
 import napari
+from napari.qt.threading import thread_worker
 import pandas as pd
 from skimage import io
 from starfish import Experiment, IntensityTable
-from starfish.types import Axes
+from starfish.types import Axes, Features
+
+from InSituToolkit import instrumentation
+from InSituToolkit.analysis._fov_cache import FovCache
+from InSituToolkit.analysis._sidecar import fov_sources, open_sidecar, read_fov
+from InSituToolkit.analysis.pyramid import image_pyramid, label_pyramid
 
 def _parse_args():
     """
@@ -26,36 +34,68 @@ def _parse_args():
         required=True,
         help="Path to experiment file",
     )
+    parser.add_argument(
+        '--sidecar',
+        type=str,
+        default=None,
+        help="Path to the precomputed results store",
+    )
 
     return parser.parse_args()
 
 
-def _make_points_array(it: IntensityTable, channel: int):
+def _make_points_array(x: np.ndarray, y: np.ndarray, channel: int):
     """
     Creates the array of spot coordinates for the napari points layer
 
     Parameters
     ----------
-    it : IntensityTable
-            IntensityTable containing the spots
+    x : np.ndarray
+            x coordinates of the spots
+    y : np.ndarray
+            y coordinates of the spots
     channel : int
             Channel index for the spots
 
     Returns
     -------
     point_coords : np.ndarray
-            Array of coordinates for the spots
+            (n_spots, 3) array of (channel, y, x) coordinates for the spots
 
     """
-    coords = zip(it.x.values, it.y.values)
-    point_coords = np.asarray([[channel, y, x] for x, y in coords])
-    
+    point_coords = np.column_stack([np.full(len(x), channel), y, x])
+
     return point_coords
 
 
-def _get_points(it, exp):
+def _target_channels(codebook):
     """
-    Creates a list of point coordinates 
+    Maps each target of a codebook to the channel of its code. This only
+    depends on the codebook, so it is computed once and reused for every
+    field of view.
+
+    Parameters
+    ----------
+    codebook : Codebook
+            Codebook of the experiment
+
+    Returns
+    -------
+    target_channels : OrderedDict[str, int]
+            Channel index of each target in codebook order
+
+    """
+    # First channel with a nonzero code value in any round
+    code = (codebook != 0).any(dim=Axes.ROUND.value).transpose(Features.TARGET, Axes.CH.value)
+    channels = np.argmax(code.values, axis=1)
+
+    return OrderedDict(zip(codebook[Features.TARGET].values, channels.tolist()))
+
+
+def _get_points(it, exp, target_channels=None):
+    """
+    Creates a list of point coordinates. The spots are grouped by target in a
+    single pass over the IntensityTable.
 
     Parameters
     ----------
@@ -63,6 +103,9 @@ def _get_points(it, exp):
             IntensityTable containing the spots
     exp : Experiment
             Experiment file corresponding to the data analysis
+    target_channels : OrderedDict[str, int]
+            Channel index of each target from _target_channels. If None, it
+            is computed from the experiment codebook.
 
     Returns
     -------
@@ -71,16 +114,23 @@ def _get_points(it, exp):
             points to be rendered
 
     """
-    # Get the codes and targets
-    codebook = exp.codebook
-    targets = list(codebook.target.values)
+    if target_channels is None:
+        target_channels = _target_channels(exp.codebook)
+    targets = list(target_channels)
+
+    # Index of each spot's target in the codebook, -1 for unknown targets
+    spot_targets = pd.Index(targets).get_indexer(it[Features.TARGET].values)
+    x = it[Axes.X.value].values
+    y = it[Axes.Y.value].values
+
+    # Group the spots by target
+    order = np.argsort(spot_targets, kind='stable')
+    bounds = np.searchsorted(spot_targets[order], np.arange(len(targets) + 1))
 
     points = []
     for i, t in enumerate(targets):
-        spots = it.where(it.target == t, drop=True)
-        code = codebook.where(codebook.target == t, drop=True).data
-        channel = int(np.nonzero(np.squeeze(code))[0])
-        point_coords = _make_points_array(spots, channel)
+        spots = order[bounds[i]:bounds[i + 1]]
+        point_coords = _make_points_array(x[spots], y[spots], target_channels[t])
         point_data = {
                     'coords': point_coords,
                     'name': t
@@ -90,17 +140,34 @@ def _get_points(it, exp):
     return points
 
 
-def _load_data(fov_data, exp):
+def _mask_file(fov_data):
+    """
+    Returns the mask file of a field of view, or None if it has no mask, e.g.
+    the output of a pipeline without segmentation. A missing mask is None in
+    the table returned by run_pipeline and NaN or empty when read from CSV.
     """
-    Load a field of view dataset 
+    mask_file = fov_data.get('mask_file')
+    if not isinstance(mask_file, str) or mask_file == '':
+        return None
+
+    return mask_file
+
+
+def _compute_results(fov_data, exp, target_channels=None):
+    """
+    Computes the max projection and the points of a field of view from the
+    experiment and the spot results
 
     Parameters
     ----------
     fov_data : pd.DataFrame
-            Table of file locations for the spot results and mask label image
-            corresponding to the dataset to be viewed
+            Table of file locations for the spot results corresponding to the
+            dataset
     exp : Experiment
             Experiment file corresponding to the data analysis
+    target_channels : OrderedDict[str, int]
+            Channel index of each target from _target_channels. If None, it
+            is computed from the experiment codebook.
 
     Returns
     -------
@@ -109,8 +176,6 @@ def _load_data(fov_data, exp):
     points : List[Dict]
             List of dictionaries containing the points and target names for the
             points to be rendered
-    mask_im : np.ndarray
-            Label image for the segmentation mask 
 
     """
     # Get the RNAscope images
@@ -120,23 +185,110 @@ def _load_data(fov_data, exp):
     # Get the spots
     spots_file = fov_data.spot_file
     it = IntensityTable.open_netcdf(spots_file)
-    
-    points = _get_points(it, exp)
 
-    # Get the segmentation mask
-    mask_file = fov_data.mask_file
-    mask_im = io.imread(mask_file)
-    
-    return im_max_proj, points, mask_im
+    points = _get_points(it, exp, target_channels)
 
+    return im_max_proj, points
 
-def view_results(fov_df, exp):
+
+def _load_data(fov_data, exp, target_channels=None, sidecar=None, experiment_path=None):
+    """
+    Load a field of view dataset as multiscale pyramids. The max projection,
+    the points and the mask are read from the sidecar store written by
+    precompute_results if it has the field of view and the spot, mask and
+    experiment files didn't change since. The pyramid levels from
+    the store are zarr arrays, so only the tiles napari displays are read.
+    Otherwise, the results are computed from the experiment and the mask file.
+    Fields of view without a mask file have no mask.
+
+    Parameters
+    ----------
+    fov_data : pd.DataFrame
+            Table of file locations for the spot results and mask label image
+            corresponding to the dataset to be viewed
+    exp : Experiment
+            Experiment file corresponding to the data analysis
+    target_channels : OrderedDict[str, int]
+            Channel index of each target from _target_channels. If None, it
+            is computed from the experiment codebook.
+    sidecar : zarr.Group
+            Sidecar store of precomputed results. If None, the results are
+            computed from the experiment.
+    experiment_path : str
+            Path to the experiment file, compared to the one the sidecar
+            results were computed from. If None, it isn't compared.
+
+    Returns
+    -------
+    im_pyramid : List
+            Multiscale pyramid of the image used for the spot detection, from
+            full resolution to the smallest level. The levels are lazy zarr
+            arrays when read from the sidecar and numpy arrays otherwise.
+    points : List[Dict]
+            List of dictionaries containing the points and target names for the
+            points to be rendered
+    mask_pyramid : List
+            Multiscale pyramid of the label image for the segmentation mask,
+            as zarr or numpy arrays like im_pyramid, or None if the field of
+            view has no mask
+
+    """
+    im_pyramid = None
+    mask_pyramid = None
+    mask_file = _mask_file(fov_data)
+    if sidecar is not None:
+        with instrumentation.stage('read sidecar'):
+            sources = fov_sources(fov_data.spot_file, mask_file, experiment_path)
+            results = read_fov(sidecar, fov_data.fov_name, sources)
+        if results is not None:
+            im_pyramid, points, mask_pyramid = results
+
+    if im_pyramid is None:
+        with instrumentation.stage('compute results'):
+            im_max_proj, points = _compute_results(fov_data, exp, target_channels)
+            im_pyramid = image_pyramid(im_max_proj)
+
+    if mask_pyramid is None and mask_file is not None:
+        # Get the segmentation mask
+        with instrumentation.stage('read mask'):
+            mask_pyramid = label_pyramid(io.imread(mask_file))
+
+    return im_pyramid, points, mask_pyramid
+
+
+def _update_mask(viewer, layers, mask_pyramid):
+    """
+    Shows the mask of a field of view in the mask layer, which is added the
+    first time a field of view has a mask, or hides the layer if the field of
+    view has no mask
+    """
+    mask_layer = layers['mask']
+    if mask_pyramid is None:
+        if mask_layer is not None:
+            mask_layer.visible = False
+    elif mask_layer is None:
+        layers['mask'] = viewer.add_labels(mask_pyramid, name='Segmentation Mask', multiscale=True)
+    else:
+        mask_layer.data = mask_pyramid
+        mask_layer.visible = True
+
+
+def view_results(
+                 fov_df, exp, cache_bytes: int = 2 * 1024 ** 3, n_prefetch: int = 1,
+                 sidecar_path: str = None, experiment_path: str = None
+                ):
     """
     Create the napari GUI that displays the image data overlayed with the
     segmentation mask and detected spots. The GUI displays one field of view
     at a time. The user can increment the field of view with the '.' key and
     decremented with the ',' key.
 
+    The neighboring fields of view are loaded in a background thread and kept
+    in an LRU cache, so switching fields of view doesn't block the GUI. The
+    image and the mask are displayed as multiscale pyramids, so napari only
+    renders the resolution level that fits the view. The mask layer is hidden
+    for the fields of view without a mask file.
+
     Parameters
     ----------
     fov_df : pd.DataFrame
@@ -144,65 +296,119 @@ def view_results(fov_df, exp):
             for all fields of view to be displayed
     exp : Experiment
             Experiment file corresponding to the data analysis
+    cache_bytes : int
+            Memory budget in bytes for the cached fields of view. The default
+            value is 2 GB.
+    n_prefetch : int
+            Number of fields of view to preload in each direction. The default
+            value is 1.
+    sidecar_path : str
+            Path to the sidecar store written by precompute_results. The
+            fields of view missing from it, or whose spot or mask file
+            changed since they were stored, are computed from the experiment.
+            If None, all fields of view are computed from the experiment.
+    experiment_path : str
+            Path to the experiment file. If given, the sidecar results
+            computed from another experiment file are not used.
 
     """
     # Get the indices
     indices = fov_df.index.values
     n_fov = len(indices)
-    
+
+    # The codebook is the same for every field of view
+    target_channels = _target_channels(exp.codebook)
+    sidecar = None
+    if sidecar_path is not None and os.path.exists(sidecar_path):
+        sidecar = open_sidecar(sidecar_path)
+    cache = FovCache(
+        lambda i: _load_data(fov_df.loc[i], exp, target_channels, sidecar, experiment_path),
+        max_bytes=cache_bytes
+    )
+
+    def prefetch(index):
+        neighbors = []
+        for offset in range(1, n_prefetch + 1):
+            neighbors += [(index + offset) % n_fov, (index - offset) % n_fov]
+        cache.prefetch(neighbors)
+
     with napari.gui_qt():
         index = 0
         colors = cycle('wgmcykb')
         viewer = napari.Viewer()
         
         fov_data = fov_df.loc[index]
-        im_max_proj, points, mask = _load_data(fov_data, exp)
+        im_pyramid, points, mask_pyramid = cache.request(index).result()
 
         metadata = {'index': index}
-        viewer.add_image(im_max_proj, name=fov_data['fov_name'], metadata=metadata)
-        viewer.add_labels(mask, name='Segmentation Mask')
+        image_layer = viewer.add_image(im_pyramid, name=fov_data['fov_name'], metadata=metadata, multiscale=True)
+        layers = {'mask': None}
+        _update_mask(viewer, layers, mask_pyramid)
 
+        point_layers = []
         for point in points:
-            viewer.add_points(
+            point_layers.append(viewer.add_points(
                 point['coords'],
                 name=point['name'],
                 symbol='ring',
                 face_color=next(colors)
-            )
+            ))
         
         viewer.status = str(index)
+        prefetch(index)
         
         @viewer.bind_key('.')
         def next_image(viewer):
-            index = viewer.layers[0].metadata['index']
+            index = image_layer.metadata['index']
             index += 1
-            viewer.layers[0].metadata['index'] = index
+            image_layer.metadata['index'] = index
             
-            new_fov = fov_df.loc[(index + n_fov)%n_fov]
-            update_viewer(viewer, new_fov)
+            show_fov((index + n_fov)%n_fov)
 
         @viewer.bind_key(',')
         def previous_image(viewer):
-            index = viewer.layers[0].metadata['index']
+            index = image_layer.metadata['index']
             index -= 1
-            viewer.layers[0].metadata['index'] = index
-            
-            new_fov = fov_df.loc[(index + n_fov)%n_fov]
-            update_viewer(viewer, new_fov)
+            image_layer.metadata['index'] = index
             
+            show_fov((index + n_fov)%n_fov)
+
+        def show_fov(fov_index):
+            future = cache.request(fov_index)
+            prefetch(fov_index)
+
+            if future.done():
+                update_viewer(viewer, fov_index, future.result())
+                return
+
+            viewer.status = 'Loading ' + fov_df.loc[fov_index].fov_name
+
+            # Wait for the load off the Qt thread and update the layers on it
+            @thread_worker(connect={'returned': lambda data: update_viewer(viewer, fov_index, data)})
+            def wait_for_fov():
+                return future.result()
+
+            wait_for_fov()
             
-        def update_viewer(viewer, new_fov):
-            im_max_proj, points, mask = _load_data(new_fov, exp)
+        def update_viewer(viewer, fov_index, data):
+            # Skip results for a field of view the user already moved past
+            if (image_layer.metadata['index'] + n_fov)%n_fov != fov_index:
+                return
+
+            new_fov = fov_df.loc[fov_index]
+            im_pyramid, points, mask_pyramid = data
             
-            viewer.layers[0].data = im_max_proj
-            viewer.layers[0].name = new_fov['fov_name']
-            viewer.layers[1].data = mask
+            image_layer.data = im_pyramid
+            image_layer.name = new_fov['fov_name']
+            _update_mask(viewer, layers, mask_pyramid)
 
-            for i, point in enumerate(points):
-                viewer.layers[i+2].data = point['coords']
+            for layer, point in zip(point_layers, points):
+                layer.data = point['coords']
             
             viewer.status = new_fov.fov_name
 
+    cache.shutdown()
+
 if __name__ == '__main__':
     args = _parse_args()
 
@@ -212,4 +418,4 @@ if __name__ == '__main__':
 
     fov_df = pd.read_csv(args.fovs)
 
-    view_results(fov_df, exp)
\ No newline at end of file
+    view_results(fov_df, exp, sidecar_path=args.sidecar, experiment_path=experiment_path)
\ No newline at end of file
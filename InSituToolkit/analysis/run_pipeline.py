@@ -0,0 +1,330 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import copy
+import os
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+import tifffile
+from starfish import Codebook, Experiment, FieldOfView, IntensityTable
+from starfish.image import Filter, Segment
+from starfish.spots import DecodeSpots, FindSpots
+from starfish.types import Axes, FunctionSource, TraceBuildingStrategies
+
+# Name of the fov table written to the output folder
+FOV_TABLE = 'fovs.csv'
+
+# Experiment and pipeline of each worker process
+_worker_state = {}
+
+def _parse_args():
+    """
+    Parse arguments for the CLI
+    """
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--exp',
+        type=str,
+        required=True,
+        help="Path to experiment file",
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        required=True,
+        help="Path to the output folder",
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help="Number of fields of view processed in parallel",
+    )
+    parser.add_argument(
+        '--overwrite',
+        action='store_true',
+        help="Rerun the fields of view that are already done",
+    )
+
+    return parser.parse_args()
+
+
+class SpotPipeline:
+    """
+    starfish pipeline run on each field of view by run_pipeline. The primary
+    images are filtered, the spots are found and decoded, and the cells are
+    segmented from the filtered stain and nuclei images. The defaults follow
+    the find_spots example.
+
+    The pipeline is sent to the worker processes, so all of its components
+    must be picklable.
+
+    Parameters
+    ----------
+    filters : List
+        starfish filters applied in order to the primary images. The default
+        is a Gaussian band pass followed by a max projection over z.
+    spot_finder : FindSpots
+        starfish spot finder run on the filtered primary images. The default
+        is a BlobDetector.
+    decoder : DecodeSpots
+        starfish spot decoder. If None, the spots are decoded with
+        PerRoundMaxChannel and the codebook of the experiment.
+    segmenter : Segment
+        starfish segmentation run on the filtered stain and nuclei images. The
+        default is a Watershed segmentation.
+    segmentation_filters : List
+        starfish filters applied in order to the stain and nuclei images. The
+        default is a max projection over z followed by a white top-hat.
+    primary_image : str
+        Name of the spot images in the experiment. The default value is 'primary'.
+    stain_image : str
+        Name of the cell stain images in the experiment. The default value is 'stain'.
+    nuclei_image : str
+        Name of the nuclei images in the experiment. The default value is 'nuclei'.
+    segmentation : bool
+        If False, the fields of view are not segmented and no mask files are
+        written. If None, run_pipeline segments the fields of view if the
+        experiment has the stain and nuclei images. The default value is None.
+    """
+    def __init__(
+                 self, filters: List = None, spot_finder=None, decoder=None,
+                 segmenter=None, segmentation_filters: List = None,
+                 primary_image: str = FieldOfView.PRIMARY_IMAGES,
+                 stain_image: str = 'stain', nuclei_image: str = 'nuclei',
+                 segmentation: bool = None
+                ):
+        max_proj = Filter.Reduce((Axes.ZPLANE,), func='max', module=FunctionSource.np)
+
+        if filters is None:
+            filters = [
+                Filter.GaussianHighPass(sigma=3),
+                Filter.GaussianLowPass(sigma=1),
+                max_proj
+            ]
+        if spot_finder is None:
+            spot_finder = FindSpots.BlobDetector(
+                min_sigma=1,
+                max_sigma=10,
+                num_sigma=10,
+                threshold=0.001,
+                measurement_type='mean',
+            )
+        if segmenter is None:
+            segmenter = Segment.Watershed(
+                nuclei_threshold=0.18,
+                input_threshold=0.22,
+                min_distance=7
+            )
+        if segmentation_filters is None:
+            segmentation_filters = [
+                max_proj,
+                Filter.WhiteTophat(masking_radius=15, is_volume=False)
+            ]
+
+        self.filters = filters
+        self.spot_finder = spot_finder
+        self.decoder = decoder
+        self.segmenter = segmenter
+        self.segmentation_filters = segmentation_filters
+        self.primary_image = primary_image
+        self.stain_image = stain_image
+        self.nuclei_image = nuclei_image
+        self.segmentation = segmentation
+
+    def find_spots(self, fov: FieldOfView, codebook: Codebook) -> IntensityTable:
+        """
+        Returns the decoded spots of a field of view
+        """
+        image = fov.get_image(self.primary_image)
+        for image_filter in self.filters:
+            image = image_filter.run(image, in_place=False)
+
+        spots = self.spot_finder.run(image)
+
+        decoder = self.decoder
+        if decoder is None:
+            decoder = DecodeSpots.PerRoundMaxChannel(
+                codebook=codebook,
+                trace_building_strategy=TraceBuildingStrategies.SEQUENTIAL
+            )
+
+        return decoder.run(spots=spots)
+
+    def segment(self, fov: FieldOfView) -> np.ndarray:
+        """
+        Returns the label image of the cells of a field of view
+        """
+        stain = fov.get_image(self.stain_image)
+        nuclei = fov.get_image(self.nuclei_image)
+        for image_filter in self.segmentation_filters:
+            stain = image_filter.run(stain, in_place=False)
+            nuclei = image_filter.run(nuclei, in_place=False)
+
+        masks = self.segmenter.run(stain, nuclei)
+
+        return np.squeeze(masks.to_label_image().xarray.values)
+
+
+def _with_segmentation(pipeline: SpotPipeline, exp: Experiment, fov_names: List[str]) -> SpotPipeline:
+    """
+    Returns the pipeline with segmentation set from the images of the fields
+    of view if it is None. Raises a ValueError if segmentation is True and a
+    field of view lacks the stain or nuclei images.
+    """
+    segmentation_images = {pipeline.stain_image, pipeline.nuclei_image}
+    missing = {}
+    for fov_name in fov_names:
+        fov_missing = segmentation_images - set(exp[fov_name].image_types)
+        if fov_missing:
+            missing[fov_name] = sorted(fov_missing)
+
+    if pipeline.segmentation is None:
+        pipeline = copy.copy(pipeline)
+        pipeline.segmentation = not missing
+    elif pipeline.segmentation and missing:
+        raise ValueError(
+            'Segmentation needs the {} and {} images, which are missing for the fields of view: {}. '
+            'Write the experiment with stain and nuclei channels or set segmentation=False.'.format(
+                pipeline.stain_image, pipeline.nuclei_image,
+                ', '.join('{} ({})'.format(name, ', '.join(images)) for name, images in missing.items())
+            )
+        )
+
+    return pipeline
+
+
+def _output_files(output_dir: str, fov_name: str) -> Tuple[str, str]:
+    spot_file = os.path.join(output_dir, fov_name + '_spots.nc')
+    mask_file = os.path.join(output_dir, fov_name + '_mask.tif')
+
+    return spot_file, mask_file
+
+
+def _init_worker(experiment_path: str, pipeline: SpotPipeline):
+    _worker_state['exp'] = Experiment.from_json(experiment_path)
+    _worker_state['pipeline'] = pipeline
+
+
+def _run_fov(fov_name: str, spot_file: str, mask_file: str) -> str:
+    exp = _worker_state['exp']
+    pipeline = _worker_state['pipeline']
+    fov = exp[fov_name]
+
+    # The files are written under temporary names and renamed when they are
+    # complete, so an interrupted field of view is rerun
+    if pipeline.segmentation:
+        tmp_file = mask_file + '.tmp'
+        tifffile.imwrite(tmp_file, pipeline.segment(fov))
+        os.replace(tmp_file, mask_file)
+
+    tmp_file = spot_file + '.tmp'
+    pipeline.find_spots(fov, exp.codebook).to_netcdf(tmp_file)
+    os.replace(tmp_file, spot_file)
+
+    return fov_name
+
+
+def run_pipeline(
+                 experiment_path: str, output_dir: str, pipeline: SpotPipeline = None,
+                 fov_names: List[str] = None, n_workers: int = 4, overwrite: bool = False
+                ) -> pd.DataFrame:
+    """
+    Runs a starfish pipeline on the fields of view of an experiment in
+    parallel worker processes. The decoded spots of each field of view are
+    saved as an IntensityTable netCDF file and the segmentation mask as a tif
+    label image. The table of the output files is saved as fovs.csv in the
+    output folder and can be passed to view_results.
+
+    Fields of view whose output files already exist are skipped, so an
+    interrupted run resumes where it stopped. If the pipeline segments the
+    fields of view, their stain and nuclei images are checked before any
+    field of view is run.
+
+    Parameters
+    ----------
+    experiment_path : str
+            Path to the experiment file, e.g. written by write_experiment
+    output_dir : str
+            Path to the output folder. It is created if it doesn't exist.
+    pipeline : SpotPipeline
+            Pipeline run on each field of view. If None, the default
+            SpotPipeline is used.
+    fov_names : List[str]
+            Names of the fields of view to process. If None, all fields of
+            view of the experiment are processed.
+    n_workers : int
+            Number of fields of view processed in parallel. The default value
+            is 4.
+    overwrite : bool
+            If True, the fields of view that are already done are rerun. The
+            default value is False.
+
+    Returns
+    -------
+    fov_df : pd.DataFrame
+            Table with the fov_name, spot_file and mask_file of each field of
+            view. mask_file is empty if the pipeline has no segmentation.
+
+    """
+    if pipeline is None:
+        pipeline = SpotPipeline()
+    exp = Experiment.from_json(experiment_path)
+    if fov_names is None:
+        fov_names = sorted(exp.keys())
+    pipeline = _with_segmentation(pipeline, exp, fov_names)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    rows = []
+    todo = []
+    for fov_name in fov_names:
+        spot_file, mask_file = _output_files(output_dir, fov_name)
+        if not pipeline.segmentation:
+            mask_file = None
+
+        rows.append({'fov_name': fov_name, 'spot_file': spot_file, 'mask_file': mask_file})
+        done = os.path.exists(spot_file) and (mask_file is None or os.path.exists(mask_file))
+        if overwrite or not done:
+            todo.append((fov_name, spot_file, mask_file))
+
+    errors = {}
+    if todo:
+        with ProcessPoolExecutor(
+                                 max_workers=n_workers, initializer=_init_worker,
+                                 initargs=(experiment_path, pipeline)
+                                ) as executor:
+            futures = {
+                fov_name: executor.submit(_run_fov, fov_name, spot_file, mask_file)
+                for fov_name, spot_file, mask_file in todo
+            }
+            # A failed field of view doesn't stop the others
+            for fov_name, future in futures.items():
+                exception = future.exception()
+                if exception is not None:
+                    errors[fov_name] = exception
+
+    fov_df = pd.DataFrame(
+        [row for row in rows if row['fov_name'] not in errors],
+        columns=['fov_name', 'spot_file', 'mask_file']
+    )
+    fov_df.to_csv(os.path.join(output_dir, FOV_TABLE), index=False)
+
+    if errors:
+        raise RuntimeError(
+            'The pipeline failed for the fields of view: ' +
+            ', '.join('{} ({!r})'.format(name, e) for name, e in errors.items())
+        )
+
+    return fov_df
+
+
+if __name__ == '__main__':
+    args = _parse_args()
+
+    run_pipeline(
+        args.exp, args.output,
+        n_workers=args.workers, overwrite=args.overwrite
+    )
@@ -1,11 +1,30 @@
+from collections import deque
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator
+
 import numpy as np
 from skimage import io, img_as_uint
+import tifffile
 from starfish import ImageStack
 
-def save_stack(im_stack:ImageStack, file_name:str):
+from InSituToolkit import instrumentation
+
+# TIFF axis letters of the ImageStack axes (r, c, z, y, x)
+_TIFF_AXES = 'TCZYX'
+
+def save_stack(
+               im_stack:ImageStack, file_name:str, compression_level:int = 0,
+               n_workers:int = 1
+              ):
     """
     Save a starfish ImageStack to disk
 
+    TIFF files are written plane by plane as a BigTIFF, so only one 16 bit
+    plane per worker is held in memory in addition to the ImageStack. Files
+    ending in .ome.tif or .ome.tiff are written as OME-TIFF. Rounds are stored
+    as the T axis.
+
     Parameters
     ----------
     im_stack : ImageStack
@@ -15,6 +34,79 @@ def save_stack(im_stack:ImageStack, file_name:str):
         Name for the image file. The extension will set the format
         as defined my skimage.io. Images with be 16 bit uint.
 
+    compression_level : int
+        zlib compression level of TIFF files from 0 (no compression) to 9.
+        The default value is 0.
+
+    n_workers : int
+        Number of planes converted and compressed in parallel for TIFF files.
+        The default value is 1.
+
     """
-    im_array = np.squeeze(im_stack.xarray.data)
-    io.imsave(file_name, img_as_uint(im_array))
+    data = im_stack.xarray.data
+
+    # Drop the singleton axes like np.squeeze, but keep at least (y, x)
+    keep = [i for i, n in enumerate(data.shape[:-2]) if n > 1]
+    shape = tuple(data.shape[i] for i in keep) + data.shape[-2:]
+    axes = ''.join(_TIFF_AXES[i] for i in keep) + 'YX'
+
+    with instrumentation.stage('save stack'):
+        if file_name.lower().endswith(('.tif', '.tiff')):
+            _save_tiff(data, file_name, shape, axes, compression_level, n_workers)
+        else:
+            # Other formats are written in a single shot, but the conversion is
+            # still done plane by plane into one 16 bit array
+            im_array = np.empty(shape, dtype=np.uint16)
+            im_planes = im_array.reshape((-1,) + shape[-2:])
+            for i, plane in enumerate(_iter_planes(data, n_workers=1)):
+                im_planes[i] = plane
+            io.imsave(file_name, im_array)
+
+    instrumentation.count(instrumentation.BYTES_WRITTEN, os.path.getsize(file_name))
+
+def _iter_planes(data: np.ndarray, n_workers: int = 1) -> Iterator[np.ndarray]:
+    """
+    Yields each (y, x) plane of data converted to uint16. With several
+    workers, up to 2 * n_workers planes are converted ahead.
+    """
+    planes = (data[index] for index in np.ndindex(data.shape[:-2]))
+
+    if n_workers <= 1:
+        for plane in planes:
+            yield img_as_uint(plane)
+        return
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for plane in planes:
+            pending.append(executor.submit(img_as_uint, plane))
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def _save_tiff(
+               data: np.ndarray, file_name: str, shape: tuple, axes: str,
+               compression_level: int = 0, n_workers: int = 1
+              ):
+    ome = file_name.lower().endswith(('.ome.tif', '.ome.tiff'))
+
+    compression_args = {}
+    if compression_level > 0:
+        compression_args = {
+            'compression': 'zlib',
+            'compressionargs': {'level': compression_level},
+            # Strips of each page are compressed in parallel
+            'rowsperstrip': 64,
+            'maxworkers': n_workers
+        }
+
+    with tifffile.TiffWriter(file_name, bigtiff=True, ome=ome) as tif:
+        tif.write(
+            _iter_planes(data, n_workers),
+            shape=shape,
+            dtype=np.uint16,
+            photometric='minisblack',
+            metadata={'axes': axes},
+            **compression_args
+        )
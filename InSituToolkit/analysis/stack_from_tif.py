@@ -1,11 +1,33 @@
+import os
+import warnings
+
 import numpy as np
-import skimage as sk
+from skimage import img_as_float32
+import tifffile
 from starfish import ImageStack
-import string
 
-def stack_from_tif(file_name: string ) -> ImageStack:
+from InSituToolkit import instrumentation
+
+# ImageStack axis of each TIFF axis. Stacks of unknown type (Q, I) and samples
+# (S) are treated as channels.
+_AXIS_MAP = {'T': 0, 'C': 1, 'Q': 1, 'I': 1, 'S': 1, 'Z': 2}
+
+# dtypes passed to the ImageStack as is. starfish converts them to float32.
+_NATIVE_DTYPES = [np.uint8, np.uint16, np.float32]
+
+def stack_from_tif(file_name: str) -> ImageStack:
     """
     Returns a starfish ImageStack object from a tif file
+
+    The file is memory-mapped when the pages are uncompressed and contiguous,
+    otherwise it is read once. uint8, uint16 and float32 images are passed to
+    the ImageStack without an intermediate copy. Other dtypes are converted to
+    float32 plane by plane.
+
+    The T, C and Z axes of OME or ImageJ files are mapped to the round,
+    channel and z axes of the ImageStack. A plain stack of 2D images is treated
+    as multiple channels.
+
     Parameters
     ----------
     file_name: string
@@ -15,30 +37,45 @@ def stack_from_tif(file_name: string ) -> ImageStack:
     -------
     ImageStack
     """
-    image = sk.io.imread(file_name)
-    image = sk.img_as_float(image)
-    img_num = np.array(image)
-    img_dim = len(np.shape(img_num))
-    [img_ch, img_y, img_x] = [1, 1, 1]
+    instrumentation.count(instrumentation.BYTES_READ, os.path.getsize(file_name))
+
+    with instrumentation.stage('read tif'), tifffile.TiffFile(file_name) as tif:
+        series = tif.series[0]
+        axes = series.axes
+        try:
+            image = tifffile.memmap(file_name, series=0, mode='r')
+        except ValueError:
+            # Compressed or non-contiguous pages can't be memory-mapped
+            image = series.asarray()
 
-    # Treat stacks of tiff's as multiple channels
-    if img_dim == 3:
-        [img_ch, img_y, img_x] = np.shape(img_num)
+    if len(axes) < 2 or axes[-2:] != 'YX':
+        raise ValueError('Dimensionality error: images must be 2D or stacks of 2D images, got axes ' + axes)
 
-    if img_dim == 2:
-        [img_y, img_x] = np.shape(img_num)
-        img_ch  = 1
+    # Drop the singleton axes that don't map to an ImageStack axis
+    drop = tuple(i for i, axis in enumerate(axes[:-2]) if axis not in _AXIS_MAP and image.shape[i] == 1)
+    image = np.squeeze(image, axis=drop)
+    axes = ''.join(axis for i, axis in enumerate(axes) if i not in drop)
 
-    if not ((len(np.shape(img_num)) == 2) or (len(np.shape(img_num)) == 3)):
-        raise Exception('Dimensionality error: images must be 2D or 2D stacks')
+    src_axes = {}
+    for i, axis in enumerate(axes[:-2]):
+        if axis not in _AXIS_MAP or _AXIS_MAP[axis] in src_axes:
+            raise ValueError('Unsupported tif axes: ' + axes)
+        src_axes[_AXIS_MAP[axis]] = i
 
-    stack = np.empty([1, img_ch, 1, img_y, img_x])
+    # Reorder to (r, c, z, y, x) and add the missing axes, all as views
+    order = [src_axes[dst] for dst in sorted(src_axes)]
+    image = np.transpose(image, order + [len(order), len(order) + 1])
+    stack = image[tuple(slice(None) if dst in src_axes else np.newaxis for dst in range(3))]
 
-    if img_dim == 2:
-        stack[0, 0, 0, :, :] = img_num[:, :]
+    if stack.dtype not in _NATIVE_DTYPES:
+        converted = np.empty(stack.shape, dtype=np.float32)
+        for index in np.ndindex(stack.shape[:-2]):
+            converted[index] = img_as_float32(stack[index])
+        stack = converted
 
-    if img_dim == 3:
-        stack[0, :, 0, :, :] = img_num[:, :, :]
+    # Suppress the loss of precision warning
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        image_stack = ImageStack.from_numpy(stack)
 
-    image_stack = ImageStack.from_numpy(stack)
     return image_stack
@@ -0,0 +1,50 @@
+import warnings
+from typing import List
+
+import zarr
+from starfish import ImageStack
+
+from InSituToolkit import instrumentation
+
+def stack_from_zarr(
+                    file_name: str, fov: int = 0, rounds: List[int] = None,
+                    channels: List[int] = None, zplanes: List[int] = None
+                   ) -> ImageStack:
+    """
+    Returns a starfish ImageStack for one field of view of a zarr array
+    written by imaging_database.write_zarr. Only the chunks of the selected
+    rounds, channels and z planes are read and decoded.
+
+    Parameters
+    ----------
+    file_name: str
+        Path to the zarr store
+    fov: int
+        Index of the field of view. The default value is 0.
+    rounds: List[int]
+        Indices of the rounds to load. If None, all rounds are loaded.
+    channels: List[int]
+        Indices of the channels to load. If None, all channels are loaded.
+    zplanes: List[int]
+        Indices of the z planes to load. If None, all z planes are loaded.
+
+    Returns
+    -------
+    ImageStack
+    """
+    array = zarr.open(file_name, mode='r')
+
+    selection = tuple(
+        slice(None) if indices is None else list(indices)
+        for indices in [rounds, channels, zplanes]
+    )
+    with instrumentation.stage('read zarr'):
+        stack = array.oindex[(fov,) + selection]
+    instrumentation.count(instrumentation.BYTES_READ, stack.nbytes)
+
+    # Suppress the loss of precision warning
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        image_stack = ImageStack.from_numpy(stack)
+
+    return image_stack
@@ -1,5 +1,10 @@
-from ._downloaders import get_image_stack, get_numpy_stack
+from ._async_database import AsyncImageDatabase
+from ._connection import configure_pool
+from ._downloaders import get_fovs, get_image_stack, get_numpy_stack
+from ._lazy_stack import get_dask_stack, get_lazy_stack
+from ._tile_cache import TileCache
 from .experiment_writer import write_experiment
 from .get_positions import get_positions
 from .search_ids import search_ids
-from .get_channels import get_channels
\ No newline at end of file
+from .get_channels import get_channels
+from .zarr_writer import write_zarr
\ No newline at end of file
@@ -0,0 +1,184 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Union
+
+import numpy as np
+
+from ._connection import get_connection_str, session_scope
+from ._downloaders import _allocate_stack
+from ._frame_plan import FramePlan, query_frame_plan
+from ._storage import make_storage_factory
+from ._tile_cache import TileCache
+from ._tile_downloader import TileDownloader
+from .get_channels import _query_channels
+from .get_positions import _query_positions
+from .search_ids import _query_ids
+
+
+class AsyncImageDatabase:
+    """
+    asyncio client for the imaging database. The queries and tile downloads
+    run on executors owned by the client, so many requests can be served
+    concurrently from one event loop without blocking it.
+
+    The number of concurrent queries, stack requests and tile downloads are
+    each bounded. Queries use the shared connection pool, so max_queries
+    should not exceed the pool size (see configure_pool).
+
+        async with AsyncImageDatabase(db_credentials) as db:
+            stacks = await asyncio.gather(*[
+                db.get_stack(image_ids, channels, pos=pos) for pos in positions
+            ])
+
+    Parameters
+    ----------
+    db_credentials : str
+        Path to the database credentials file
+    max_queries : int
+        Maximum number of concurrent database queries. The default value is 4.
+    max_stacks : int
+        Maximum number of stack requests downloading at the same time. Other
+        requests wait for a slot. The default value is 16.
+    n_tile_workers : int
+        Number of tile download threads shared by all stack requests. The
+        default value is 32.
+    max_retries : int
+        Number of times a failed tile download is retried. The default value is 3.
+    timeout : float
+        Timeout in seconds for each tile request. The default value is 60.
+    data_path : str
+        Path to a mounted image store volume. If set, the tiles are read from
+        the volume instead of S3.
+    cache : TileCache
+        Local tile cache to read tiles from and add downloaded tiles to.
+        The default is no cache.
+    """
+    def __init__(
+                 self, db_credentials: str, max_queries: int = 4, max_stacks: int = 16,
+                 n_tile_workers: int = 32, max_retries: int = 3, timeout: float = 60,
+                 data_path: str = None, cache: TileCache = None
+                ):
+        self.db_credentials = get_connection_str(db_credentials)
+        self.max_queries = max_queries
+        self.max_stacks = max_stacks
+
+        self._db_executor = ThreadPoolExecutor(max_workers=max_queries)
+        self._tile_executor = ThreadPoolExecutor(max_workers=n_tile_workers)
+        self._downloader = TileDownloader(
+            n_workers=1,
+            max_retries=max_retries,
+            timeout=timeout,
+            storage_factory=make_storage_factory(data_path, timeout),
+            cache=cache
+        )
+
+        # Created in the event loop on first use
+        self._stack_semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        """
+        Waits for the running queries and downloads and stops the executors
+        """
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._db_executor.shutdown)
+        await loop.run_in_executor(None, self._tile_executor.shutdown)
+
+    def _query_session(self, query, *args):
+        with session_scope(self.db_credentials) as session:
+            return query(session, *args)
+
+    async def _query(self, query, *args):
+        # The executor has max_queries threads, so it bounds the concurrent
+        # queries and queues the others without blocking the loop
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self._db_executor, self._query_session, query, *args)
+
+    async def get_positions(self, dataset_serial: str, limit: int = None, offset: int = 0) -> List[int]:
+        """
+        Returns the positions of a dataset in ascending order. See get_positions.
+        """
+        return await self._query(_query_positions, dataset_serial, limit, offset)
+
+    async def get_channels(self, dataset_id: str, limit: int = None, offset: int = 0) -> Dict[int, str]:
+        """
+        Returns the (channel_idx: channel_name) pairs of a dataset in ascending
+        channel_idx order. See get_channels.
+        """
+        return await self._query(_query_channels, dataset_id, limit, offset)
+
+    async def search_ids(self, string: str, limit: int = None, offset: int = 0) -> List[str]:
+        """
+        Returns the dataset ids containing a string in alphabetical order. See search_ids.
+        """
+        return await self._query(_query_ids, string, limit, offset)
+
+    async def get_frame_plan(self, image_ids, channels, positions=(0,), times=(0,)) -> FramePlan:
+        """
+        Resolves the frames of several datasets, channels, positions and time
+        points with a single query
+        """
+        return await self._query(
+            query_frame_plan, list(image_ids), list(channels), list(positions), list(times)
+        )
+
+    async def get_stack(
+                        self, image_ids, channels, pos: int = 0, time: int = 0,
+                        ragged: str = 'pad'
+                       ) -> Union[np.ndarray, List[np.ndarray]]:
+        """
+        Downloads an image stack. The tiles are downloaded on the shared tile
+        executor and decoded directly into the output.
+
+        Parameters
+        ----------
+        image_ids : List[str]
+            A list of the image ids in round order
+        channels : List[str]
+            A list of the channels to be downloaded in the index order.
+        pos : int
+            Index of the position to download. The default value is 0.
+        time : int
+            Index of the time point to download. The default value is 0.
+        ragged : str
+            'pad' or 'list'. See get_numpy_stack. The default value is 'pad'.
+
+        Returns
+        -------
+        im_stack : Union[np.ndarray, List[np.ndarray]]
+            image stack with order (r, c, z, y, x)
+        """
+        if self._stack_semaphore is None:
+            self._stack_semaphore = asyncio.Semaphore(self.max_stacks)
+
+        async with self._stack_semaphore:
+            plan = await self.get_frame_plan(image_ids, channels, [pos], [time])
+            plan.check_complete(pos, time)
+            im_stack = _allocate_stack(plan, pos, time, ragged)
+
+            loop = asyncio.get_running_loop()
+            futures = [
+                loop.run_in_executor(
+                    self._tile_executor, self._download_tile,
+                    im_stack[r][c, z], frame.s3_dir, frame.file_name, frame.sha256
+                )
+                for r, c, z, frame in plan.tiles(pos, time)
+            ]
+            try:
+                await asyncio.gather(*futures)
+            except BaseException:
+                # Drop the queued tiles of a failed or cancelled request
+                for future in futures:
+                    future.cancel()
+                raise
+
+        return im_stack
+
+    def _download_tile(self, dest: np.ndarray, s3_dir: str, file_name: str, sha256: str):
+        dest[...] = self._downloader.fetch(s3_dir, file_name, sha256)
@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+import functools
+import os
+import threading
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+import imaging_db.utils.db_utils as db_utils
+
+# Connection pool options for new engines. See configure_pool.
+_pool_options = {
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_recycle': 3600,
+    'pool_pre_ping': True
+}
+
+# Process-wide engines keyed by connection string
+_engines = {}
+_lock = threading.Lock()
+_pid = os.getpid()
+
+
+@functools.lru_cache(maxsize=None)
+def get_connection_str(db_credentials: str) -> str:
+    """
+    Returns the connection string for a credentials file. The file is only
+    parsed once per process. A SQLAlchemy URL is returned as is.
+    """
+    if '://' in db_credentials:
+        return db_credentials
+
+    return db_utils.get_connection_str(db_credentials)
+
+
+def configure_pool(**options):
+    """
+    Sets the connection pool options (e.g., pool_size, max_overflow,
+    pool_recycle, pool_timeout) of the shared engines. Existing engines are
+    disposed and recreated with the new options on their next use.
+    """
+    with _lock:
+        _pool_options.update(options)
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def _engine_options(connection_str: str) -> dict:
+    if connection_str.startswith('sqlite'):
+        # SQLite doesn't use a sized connection pool
+        return {'pool_pre_ping': _pool_options.get('pool_pre_ping', False)}
+
+    return dict(_pool_options)
+
+
+def _reset_after_fork():
+    """
+    Drops the engines inherited from the parent process. The pooled
+    connections belong to the parent, so they are released without being
+    closed.
+    """
+    global _pid, _lock
+
+    _lock = threading.Lock()
+    for engine in _engines.values():
+        try:
+            engine.dispose(close=False)
+        except TypeError:
+            # SQLAlchemy < 1.4.33 can't dispose without closing the connections
+            pass
+    _engines.clear()
+    _pid = os.getpid()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_engine(db_credentials: str) -> sa.engine.Engine:
+    """
+    Returns the shared engine for a credentials file or URL, creating it on
+    first use
+    """
+    connection_str = get_connection_str(db_credentials)
+
+    if os.getpid() != _pid:
+        _reset_after_fork()
+
+    with _lock:
+        if connection_str not in _engines:
+            _engines[connection_str] = sa.create_engine(connection_str, **_engine_options(connection_str))
+
+        return _engines[connection_str]
+
+
+@contextmanager
+def session_scope(db_credentials: str):
+    """
+    Provides a transactional session on the shared engine
+    """
+    session = Session(bind=get_engine(db_credentials))
+
+    try:
+        yield session
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
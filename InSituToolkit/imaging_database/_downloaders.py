@@ -1,14 +1,32 @@
+import queue
+import threading
 import warnings
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 
 import numpy as np
-from starfish import ImageStack
 
 from ._image_database import ImageDatabase
+from ._region import make_region, region_shape
+from .get_positions import get_positions
+from ._storage import make_storage_factory
+from ._tile_cache import TileCache
+from ._tile_downloader import TileDownloader
 
-def get_numpy_stack(db_credentials: str, image_ids: str, channels, pos: int = 0, time: int = 0):
+def get_numpy_stack(
+                    db_credentials: str, image_ids: str, channels, pos: int = 0, time: int = 0,
+                    n_workers: int = 8, max_retries: int = 3, timeout: float = 60,
+                    data_path: str = None, ragged: str = 'pad', cache: TileCache = None,
+                    y: slice = None, x: slice = None, z: slice = None, stride: int = 1
+                   ):
     """
     Downloads an image stack from the imaging database and returns it as a numpy ndarray.
+    The stack shape and dtype are taken from the frame metadata on the database.
+
+    A region of the stack can be selected with y, x and z, and downsampled
+    with stride. Only the selected z slices are downloaded and each tile is
+    cropped as it is read, so the memory used is proportional to the region.
+    TIFF frames on a mounted image store are read without decoding the
+    whole frame.
 
     Parameters
     ----------
@@ -22,29 +40,215 @@ def get_numpy_stack(db_credentials: str, image_ids: str, channels, pos: int = 0,
         Index of the position to download. The default value is 0.
     time : int
         Index of the time point to download. The default value is 0.
+    n_workers : int
+        Number of concurrent tile downloads. The default value is 8.
+    max_retries : int
+        Number of times a failed tile download is retried. The default value is 3.
+    timeout : float
+        Timeout in seconds for each tile request. The default value is 60.
+    data_path : str
+        Path to a mounted image store volume. If set, the tiles are read from
+        the volume instead of S3.
+    ragged : str
+        How rounds with different numbers of z slices are returned. If 'pad',
+        a single array is returned and the missing slices are set to 0. If
+        'list', a list with one (c, z, y, x) array per round is returned.
+        The default value is 'pad'.
+    cache : TileCache
+        Local tile cache to read tiles from and add downloaded tiles to.
+        The default is no cache.
+    y : slice
+        Rows of each tile to download. If None, all rows are downloaded.
+    x : slice
+        Columns of each tile to download. If None, all columns are downloaded.
+    z : slice
+        z slices of each (round, channel) stack to download, indexed in slice
+        order. If None, all slices are downloaded.
+    stride : int
+        Only every stride-th row and column of the region is downloaded. The
+        default value is 1.
 
     returns
     ----------
-    im_stack : np.ndarray
+    im_stack : Union[np.ndarray, List[np.ndarray]]
         image stack with order (r, c, z, y, x)
 
     """
     db = ImageDatabase(db_credentials)
 
-    n_rounds = len(image_ids)
-    n_channels = len(channels)
-    n_slices = 11
-    im_width = 2048
-    im_height = 2048
+    # Resolve all of the frames with a single query
+    plan = db.getFramePlan(image_ids, channels, positions=[pos], times=[time])
+    plan.check_complete(pos, time)
+
+    region = make_region(y, x, stride)
+    if z is not None:
+        plan = plan.select_slices(z)
+    im_stack = _allocate_stack(plan, pos, time, ragged, region)
+
+    downloader = TileDownloader(
+        n_workers=n_workers,
+        max_retries=max_retries,
+        timeout=timeout,
+        storage_factory=make_storage_factory(data_path, timeout),
+        cache=cache
+    )
+    downloader.download_plan(plan, im_stack, pos, time, region)
+
+    return im_stack
+
+def get_fovs(
+             db_credentials: str, image_ids, channels, positions: List[int] = None,
+             times: List[int] = (0,), prefetch: int = 2, n_workers: int = 8,
+             max_retries: int = 3, timeout: float = 60, data_path: str = None,
+             ragged: str = 'pad', cache: TileCache = None
+            ) -> Iterator[Tuple[int, int, np.ndarray]]:
+    """
+    Iterates over the image stacks of several positions and time points. The
+    frames of all fields of view are resolved with one query and the next
+    fields of view are downloaded in the background while the caller processes
+    the current one.
+
+    Parameters
+    ----------
+    db_credentials : str
+        Path to the database credentials file
+    image_ids : List[str]
+        A list of the image ids in round order
+    channels : List[str]
+        A list of the channels to be downloaded in the index order.
+    positions : List[int]
+        Indices of the positions to download. If None, all positions of the
+        first image id are downloaded.
+    times : List[int]
+        Indices of the time points to download. The default value is [0].
+    prefetch : int
+        Maximum number of downloaded fields of view waiting to be consumed.
+        This bounds the memory used by the prefetching. It must be at least 1.
+        The default value is 2.
+    n_workers : int
+        Number of concurrent tile downloads. The default value is 8.
+    max_retries : int
+        Number of times a failed tile download is retried. The default value is 3.
+    timeout : float
+        Timeout in seconds for each tile request. The default value is 60.
+    data_path : str
+        Path to a mounted image store volume. If set, the tiles are read from
+        the volume instead of S3.
+    ragged : str
+        'pad' or 'list'. See get_numpy_stack. The default value is 'pad'.
+    cache : TileCache
+        Local tile cache to read tiles from and add downloaded tiles to.
+        The default is no cache.
+
+    Returns
+    -------
+    fovs : Iterator[Tuple[int, int, np.ndarray]]
+        Iterator over the position and time indices and the image stack with
+        order (r, c, z, y, x) of each field of view. The background download
+        stops when the iterator is exhausted or closed, e.g. when the caller
+        breaks out of a for loop over it.
+    """
+    if prefetch < 1:
+        raise ValueError('prefetch must be at least 1, got {}'.format(prefetch))
+
+    if positions is None:
+        positions = get_positions(db_credentials, image_ids[0])
+
+    fovs = [(pos, time) for time in times for pos in positions]
+
+    db = ImageDatabase(db_credentials)
+    plan = db.getFramePlan(image_ids, channels, positions=positions, times=times)
+    for pos, time in fovs:
+        plan.check_complete(pos, time)
+
+    downloader = TileDownloader(
+        n_workers=n_workers,
+        max_retries=max_retries,
+        timeout=timeout,
+        storage_factory=make_storage_factory(data_path, timeout),
+        cache=cache
+    )
+
+    return _iter_fovs(plan, fovs, downloader, prefetch, ragged)
+
+def _iter_fovs(plan, fovs, downloader: TileDownloader, prefetch: int, ragged: str):
+    """
+    Yields the fields of view of a FramePlan while a producer thread downloads
+    the next ones. The producer is stopped and joined when the generator is
+    exhausted, closed or garbage collected.
+    """
+    fov_queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def _put(item):
+        # Give up if the consumer stopped iterating
+        while not stop.is_set():
+            try:
+                fov_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-    im_stack = np.zeros((n_rounds, n_channels, n_slices, im_width, im_height), dtype='uint16')
-    for r, im in enumerate(image_ids):
-        for c, chan in enumerate(channels):
-            im_stack[r, c, ...] = db.getStack(im, channel=chan, pos_idx=pos, time_idx=time)
+    def _producer():
+        try:
+            for pos, time in fovs:
+                if stop.is_set():
+                    return
+                im_stack = _allocate_stack(plan, pos, time, ragged)
+                downloader.download_plan(plan, im_stack, pos, time)
+                if not _put((pos, time, im_stack)):
+                    return
+        except BaseException as e:
+            _put(e)
+            return
+        _put(None)
+
+    producer = threading.Thread(target=_producer, name='get_fovs-producer', daemon=True)
+    producer.start()
+
+    try:
+        while True:
+            item = fov_queue.get()
+            if item is None:
+                break
+            elif isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+def _allocate_stack(plan, pos: int, time: int, ragged: str = 'pad', region=None):
+    """
+    Allocates the output for a position and time point of a FramePlan with
+    the shape and dtype of the frames, or of a (y, x) region of the frames.
+    Slices without a frame are set to 0.
+    """
+    n_rounds = len(plan.image_ids)
+    n_channels = len(plan.channels)
+    round_slices = plan.round_slices(pos, time)
+    tile_shape = region_shape(region, plan.tile_shape(pos, time))
+    dtype = plan.dtype(pos, time)
+
+    if ragged == 'pad':
+        im_stack = np.empty((n_rounds, n_channels, max(round_slices)) + tile_shape, dtype=dtype)
+    elif ragged == 'list':
+        im_stack = [np.empty((n_channels, n_slices) + tile_shape, dtype=dtype) for n_slices in round_slices]
+    else:
+        raise ValueError("ragged must be 'pad' or 'list'")
+
+    # Only the slices without a frame need to be cleared
+    for r in range(n_rounds):
+        for c in range(n_channels):
+            im_stack[r][c, plan.n_slices(r, c, pos, time):] = 0
 
     return im_stack
 
-def get_image_stack(db_credentials: str, image_id: str, channels, pos: int = 0, time: int = 0):
+def get_image_stack(
+                    db_credentials: str, image_id: str, channels, pos: int = 0, time: int = 0,
+                    n_workers: int = 8, data_path: str = None, cache: TileCache = None
+                   ):
     """
     Downloads an image stack from the imaging database and returns it as a starfish ImageStack.
 
@@ -60,13 +264,27 @@ def get_image_stack(db_credentials: str, image_id: str, channels, pos: int = 0,
         Index of the position to download. The default value is 0.
     time : int
         Index of the time point to download. The default value is 0.
+    n_workers : int
+        Number of concurrent tile downloads. The default value is 8.
+    data_path : str
+        Path to a mounted image store volume. If set, the tiles are read from
+        the volume instead of S3.
+    cache : TileCache
+        Local tile cache to read tiles from and add downloaded tiles to.
+        The default is no cache.
 
     returns
     ----------
     im_stack : ImageStack
         image stack
     """
-    im_stack = get_numpy_stack(db_credentials, image_id, channels, pos, time)
+    # Imported here so the rest of the package doesn't need starfish
+    from starfish import ImageStack
+
+    im_stack = get_numpy_stack(
+        db_credentials, image_id, channels, pos, time,
+        n_workers=n_workers, data_path=data_path, cache=cache
+    )
 
     # Suppress the loss of precision warning
     with warnings.catch_warnings():
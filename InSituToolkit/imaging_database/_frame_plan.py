@@ -0,0 +1,259 @@
+from collections import OrderedDict
+from typing import Dict, Iterator, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+import imaging_db.database.db_operations as db_ops
+
+from .. import instrumentation
+
+
+class FrameRecord(NamedTuple):
+    """
+    Location and acquisition metadata for a single frame on imagingDB
+    """
+    dataset_serial: str
+    channel_name: str
+    pos_idx: int
+    time_idx: int
+    slice_idx: int
+    file_name: str
+    s3_dir: str
+    im_width: int
+    im_height: int
+    bit_depth: str
+    sha256: str
+
+
+class FramePlan:
+    """
+    All of the frames required to assemble a set of image stacks, resolved
+    with a single database query.
+
+    Rounds are indexed by the order of the image ids and channels by the order
+    of the channel names. Within a (round, channel, position, time) stack,
+    frames are ordered by slice index.
+
+    Parameters
+    ----------
+    image_ids : List[str]
+        The image ids (dataset serials) in round order
+    channels : List[str]
+        The channel names in channel index order
+    frames : List[FrameRecord]
+        The frames returned by the database query
+    """
+    def __init__(self, image_ids: Sequence[str], channels: Sequence[str], frames: List[FrameRecord]):
+        self.image_ids = list(image_ids)
+        self.channels = list(channels)
+
+        # The same dataset or channel may be requested more than once
+        round_index = {}
+        for r, im_id in enumerate(self.image_ids):
+            round_index.setdefault(im_id, []).append(r)
+        channel_index = {}
+        for c, chan in enumerate(self.channels):
+            channel_index.setdefault(chan, []).append(c)
+
+        self._stacks = {}
+        for frame in frames:
+            for r in round_index[frame.dataset_serial]:
+                for c in channel_index[frame.channel_name]:
+                    key = (r, c, frame.pos_idx, frame.time_idx)
+                    self._stacks.setdefault(key, []).append(frame)
+
+        for stack in self._stacks.values():
+            stack.sort(key=lambda f: f.slice_idx)
+
+    def __len__(self):
+        return sum(len(stack) for stack in self._stacks.values())
+
+    def stack(self, r: int, c: int, pos: int = 0, time: int = 0) -> List[FrameRecord]:
+        """
+        Returns the frames of one (round, channel) stack ordered by slice index
+        """
+        return self._stacks.get((r, c, pos, time), [])
+
+    def select_slices(self, z: slice) -> 'FramePlan':
+        """
+        Returns a plan with only the slices z of each (round, channel) stack.
+        z indexes the frames of a stack in slice order. Raises a ValueError if
+        z selects no slices of a stack.
+        """
+        if not isinstance(z, slice):
+            raise ValueError('z must be a slice, got {!r}'.format(z))
+
+        plan = FramePlan(self.image_ids, self.channels, [])
+        for (r, c, pos, time), stack in self._stacks.items():
+            selected = stack[z]
+            if len(selected) == 0:
+                raise ValueError(
+                    'z range {} selects no slices of the {} slices of dataset {}, '
+                    'channel {}, pos {}, time {}'.format(
+                        _format_slice(z), len(stack), self.image_ids[r],
+                        self.channels[c], pos, time
+                    )
+                )
+            plan._stacks[(r, c, pos, time)] = selected
+
+        for pos, time in sorted({key[2:] for key in self._stacks}):
+            plan.check_complete(pos, time)
+
+        return plan
+
+    def tiles(self, pos: int = 0, time: int = 0) -> Iterator[Tuple[int, int, int, FrameRecord]]:
+        """
+        Iterate over the frames of a position and time point
+
+        Yields
+        ------
+        (r, c, z, frame) : Tuple[int, int, int, FrameRecord]
+            The round, channel and z index of the frame in the stack and the frame
+        """
+        for r in range(len(self.image_ids)):
+            for c in range(len(self.channels)):
+                for z, frame in enumerate(self.stack(r, c, pos, time)):
+                    yield r, c, z, frame
+
+    def by_s3_dir(self, pos: int = 0, time: int = 0) -> Dict[str, List[Tuple[int, int, int, FrameRecord]]]:
+        """
+        Groups the tiles of a position and time point by their storage folder so
+        that each folder only needs a single storage client.
+        """
+        groups = OrderedDict()
+        for r, c, z, frame in self.tiles(pos, time):
+            groups.setdefault(frame.s3_dir, []).append((r, c, z, frame))
+
+        return groups
+
+    def n_slices(self, r: int, c: int, pos: int = 0, time: int = 0) -> int:
+        """
+        Returns the number of z slices in a (round, channel) stack
+        """
+        return len(self.stack(r, c, pos, time))
+
+    def round_slices(self, pos: int = 0, time: int = 0) -> List[int]:
+        """
+        Returns the number of z slices of each round, which is the largest
+        slice count over the channels of that round
+        """
+        return [
+            max([self.n_slices(r, c, pos, time) for c in range(len(self.channels))], default=0)
+            for r in range(len(self.image_ids))
+        ]
+
+    def tile_shape(self, pos: int = 0, time: int = 0) -> Tuple[int, int]:
+        """
+        Returns the (y, x) shape of the frames from FramesGlobal
+        """
+        shapes = {(f.im_height, f.im_width) for _, _, _, f in self.tiles(pos, time)}
+        if len(shapes) != 1:
+            raise ValueError('Frames must all have the same shape, found {}'.format(shapes))
+
+        return shapes.pop()
+
+    def dtype(self, pos: int = 0, time: int = 0) -> np.dtype:
+        """
+        Returns the dtype of the frames from the FramesGlobal bit depth
+        """
+        dtypes = {_bit_depth_to_dtype(f.bit_depth) for _, _, _, f in self.tiles(pos, time)}
+        if len(dtypes) != 1:
+            raise ValueError('Frames must all have the same bit depth, found {}'.format(dtypes))
+
+        return dtypes.pop()
+
+    def check_complete(self, pos: int = 0, time: int = 0):
+        """
+        Raises a ValueError if any requested (round, channel) stack has no frames
+        """
+        for r, im_id in enumerate(self.image_ids):
+            for c, chan in enumerate(self.channels):
+                if len(self.stack(r, c, pos, time)) == 0:
+                    raise ValueError(
+                        'No images match query: dataset {}, channel {}, pos {}, time {}'.format(
+                            im_id, chan, pos, time
+                        )
+                    )
+
+
+def _format_slice(s: slice) -> str:
+    """
+    Formats a slice as start:stop or start:stop:step
+    """
+    bounds = ['' if v is None else str(v) for v in (s.start, s.stop)]
+    if s.step is not None:
+        bounds.append(str(s.step))
+
+    return ':'.join(bounds)
+
+
+def _bit_depth_to_dtype(bit_depth) -> np.dtype:
+    """
+    Converts a FramesGlobal bit depth (e.g., 'uint16' or 16) to a numpy dtype
+    """
+    if isinstance(bit_depth, str) and not bit_depth.isdigit():
+        return np.dtype(bit_depth)
+
+    n_bits = int(bit_depth)
+    if n_bits <= 8:
+        return np.dtype('uint8')
+    elif n_bits <= 16:
+        return np.dtype('uint16')
+    else:
+        return np.dtype('uint32')
+
+
+def query_frame_plan(
+                     session, image_ids: Sequence[str], channels: Sequence[str],
+                     positions: Sequence[int] = (0,), times: Sequence[int] = (0,)
+                    ) -> FramePlan:
+    """
+    Resolves every frame for the requested rounds, channels, positions and
+    time points in one query.
+
+    Parameters
+    ----------
+    session : sqlalchemy.orm.session.Session
+        An open imagingDB session
+    image_ids : List[str]
+        The image ids (dataset serials) in round order
+    channels : List[str]
+        The channel names in channel index order
+    positions : List[int]
+        The position indices to include
+    times : List[int]
+        The time point indices to include
+
+    Returns
+    -------
+    plan : FramePlan
+    """
+    with instrumentation.stage('query frames'):
+        rows = _query_frame_rows(session, image_ids, channels, positions, times)
+
+    frames = [FrameRecord(*row) for row in rows]
+
+    return FramePlan(image_ids, channels, frames)
+
+
+def _query_frame_rows(session, image_ids, channels, positions, times) -> list:
+    return session.query(
+                db_ops.DataSet.dataset_serial,
+                db_ops.Frames.channel_name,
+                db_ops.Frames.pos_idx,
+                db_ops.Frames.time_idx,
+                db_ops.Frames.slice_idx,
+                db_ops.Frames.file_name,
+                db_ops.FramesGlobal.s3_dir,
+                db_ops.FramesGlobal.im_width,
+                db_ops.FramesGlobal.im_height,
+                db_ops.FramesGlobal.bit_depth,
+                db_ops.Frames.sha256,
+            ) \
+        .select_from(db_ops.Frames) \
+        .join(db_ops.FramesGlobal) \
+        .join(db_ops.DataSet) \
+        .filter(db_ops.DataSet.dataset_serial.in_(list(image_ids))) \
+        .filter(db_ops.Frames.channel_name.in_(list(channels))) \
+        .filter(db_ops.Frames.pos_idx.in_(list(positions))) \
+        .filter(db_ops.Frames.time_idx.in_(list(times))) \
+        .all()
@@ -1,8 +1,9 @@
 #import matplotlib.pyplot as plt
+from contextlib import contextmanager
 import numpy as np
-import importlib
 import os
 import sys
+import warnings
 
 import imaging_db.filestorage.s3_storage as s3_storage
     
@@ -10,14 +11,55 @@ import imaging_db.utils.db_utils as db_utils
 import imaging_db.filestorage.s3_storage as s3_storage
 import imaging_db.database.db_operations as db_ops
 
+from sqlalchemy.orm import Session
+
+from ._connection import get_connection_str, get_engine, session_scope
+from ._frame_plan import query_frame_plan
+from ._region import make_region, region_shape
+from ._storage import make_storage_factory
+from ._tile_downloader import TileDownloader
+
 class ImageDatabase:
+	''' Queries and downloads from imagingDB over the shared connection pool
+
+		Used as a context manager, a single session is reused for all of the
+		calls made in the with block. The session must not be shared between
+		threads.
+
+		with ImageDatabase(db_credentials) as db:
+			plan = db.getFramePlan(...)
+			stack = db.getStack(...)
+
+	'''
 	def __init__(self, credentials_filename):
-		self.credentials_filename = db_utils.get_connection_str(credentials_filename)
+		self.credentials_filename = get_connection_str(credentials_filename)
+		self._session = None
 
-	def getAcqMeta(self, dataset_identifier):
-		importlib.reload(db_session)
+	def __enter__(self):
+		self._session = Session(bind=get_engine(self.credentials_filename))
+		return self
 
-		with db_ops.session_scope(self.credentials_filename) as session:
+	def __exit__(self, exc_type, exc_value, traceback):
+		try:
+			if exc_type is None:
+				self._session.commit()
+			else:
+				self._session.rollback()
+		finally:
+			self._session.close()
+			self._session = None
+
+	@contextmanager
+	def _session_scope(self):
+		''' Reuse the session of the with block or open a new one '''
+		if self._session is not None:
+			yield self._session
+		else:
+			with session_scope(self.credentials_filename) as session:
+				yield session
+
+	def getAcqMeta(self, dataset_identifier):
+		with self._session_scope() as session:
 			# Find the Frames of interest
 			all_frames = session.query(db_ops.Frames) \
 			    .join(db_ops.FramesGlobal) \
@@ -29,9 +71,7 @@ class ImageDatabase:
 
 		return acq_meta
 	def getNbrPositions(self, dataset_identifier):
-		importlib.reload(db_session)
-
-		with db_ops.session_scope(self.credentials_filename) as session:
+		with self._session_scope() as session:
 			# Find the Frames of interest
 			frames_global = session.query(db_ops.FramesGlobal) \
 			    .join(db_ops.DataSet) \
@@ -49,9 +89,7 @@ class ImageDatabase:
 
 		'''
 
-		importlib.reload(db_session)
-
-		with db_ops.session_scope(self.credentials_filename) as session:
+		with self._session_scope() as session:
 			datasets = session.query(db_ops.DataSet)
 			
 			# Find the Frames of interest
@@ -76,9 +114,7 @@ class ImageDatabase:
 		'''
 
 		# Open the session
-		importlib.reload(db_session)
-		
-		with db_ops.session_scope(self.credentials_filename) as session:
+		with self._session_scope() as session:
 			datasets = session.query(db_ops.DataSet)
 			
 			# Find the Frames of interest
@@ -131,64 +167,81 @@ class ImageDatabase:
 			data_loader = s3_storage.DataStorage(s3_dir=s3_dir)
 			im_stack = data_loader.get_stack(file_names, stack_shape, bit_depth)
 			
-		session.rollback()
-		session.close()
 
 		return im_stack
 
-	def getStack(self, dataset_identifier, channel, time_idx=0, pos_idx=0, verbose=False):
+	def getFramePlan(self, dataset_identifiers, channels, positions=(0,), times=(0,)):
+		''' Resolve the frames for several datasets, channels, positions and
+			time points with a single query
+
+			Returns
+			plan : FramePlan indexed by (round, channel, pos, time)
+
+		'''
+
+		with self._session_scope() as session:
+			plan = query_frame_plan(session, dataset_identifiers, channels, positions, times)
+
+		return plan
+
+	def getStack(self, dataset_identifier, channel, time_idx=0, pos_idx=0, verbose=False, out=None, n_workers=8, cache=None,
+			y=None, x=None, z=None, stride=1, data_path=None, storage_factory=None):
 		''' Download a stack at a given set of pos, time, channel indices
 
+			The tiles are decoded directly into their z slice of the output. If
+			out is given, it must be a writable (z, y, x) array or view (e.g.,
+			im_stack[r, c] of a larger stack or a transposed view) of the
+			stack's dtype and no intermediate stack is allocated. If a TileCache is given, cached
+			tiles are read from disk instead of S3.
+
+			y and x select a region of each tile as slices, z selects slices of
+			the stack in slice order and stride downsamples the region by
+			keeping every stride-th row and column. Tiles are cropped as they
+			are read, so only the region is held in memory.
+
+			The tiles are read from S3 unless data_path, the path to a mounted
+			image store volume, is given. storage_factory overrides both and
+			creates the storage client for an s3_dir.
+
+			verbose is deprecated and has no effect.
+
 			Returns
-			im_ordered : np.ndarray containing the image [time, chan, z, x, y]
+			im_ordered : np.ndarray containing the image [time, chan, z, y, x].
+				If out is given, this is a view of out.
 
 		'''
-		
-		with db_ops.session_scope(self.credentials_filename) as session:
-			datasets = session.query(db_ops.DataSet)
-			
-			# Find the Frames of interest
-			all_frames = session.query(db_ops.Frames) \
-				.join(db_ops.FramesGlobal) \
-				.join(db_ops.DataSet) \
-				.filter(db_ops.DataSet.dataset_serial == dataset_identifier) \
-				.filter(db_ops.Frames.channel_name == channel) \
-				.filter(db_ops.Frames.time_idx == time_idx) \
-				.filter(db_ops.Frames.pos_idx == pos_idx) \
-				.all()
 
-			# Get the names of the files
-			file_names = [im.file_name for im in all_frames]
+		if verbose:
+			warnings.warn('verbose is deprecated and has no effect', DeprecationWarning, stacklevel=2)
 
-			if len(file_names) == 0:
-				raise ValueError('No images match query')
+		with self._session_scope() as session:
+			plan = query_frame_plan(session, [dataset_identifier], [channel], [pos_idx], [time_idx])
 
-			# Get the bit depth 
-			bit_depth = all_frames[0].frames_global.bit_depth
+		if len(plan) == 0:
+			raise ValueError('No images match query')
 
-			# Get the shape of the stack
-			# TODO: get the shape from the acq meta
-			stack_shape = (
-    			all_frames[0].frames_global.im_width,
-    			all_frames[0].frames_global.im_height,
-    			all_frames[0].frames_global.im_colors,
-    			len(all_frames),
-			)
+		region = make_region(y, x, stride)
+		if z is not None:
+			plan = plan.select_slices(z)
 
-			# Get the folder
-			s3_dir = all_frames[0].frames_global.s3_dir
+		stack_shape = (plan.n_slices(0, 0, pos_idx, time_idx),) + region_shape(region, plan.tile_shape(pos_idx, time_idx))
+		dtype = plan.dtype(pos_idx, time_idx)
 
-			# Download the files
-			data_loader = s3_storage.DataStorage(s3_dir=s3_dir)
-			im_stack = data_loader.get_stack(file_names, stack_shape, bit_depth)
+		if out is None:
+			out = np.empty(stack_shape, dtype=dtype)
+		elif out.shape != stack_shape:
+			raise ValueError('out has shape {}, expected {}'.format(out.shape, stack_shape))
+		elif out.dtype != dtype:
+			raise ValueError('out has dtype {}, expected {}'.format(out.dtype, dtype))
 
-			im_ordered = np.zeros((1, 1, stack_shape[3], stack_shape[0], stack_shape[1]), dtype='uint16')
+		tiles = [
+			(out[z], frame.s3_dir, frame.file_name, frame.sha256)
+			for z, frame in enumerate(plan.stack(0, 0, pos_idx, time_idx))
+		]
+		if storage_factory is None and data_path is not None:
+			storage_factory = make_storage_factory(data_path)
+		TileDownloader(n_workers=n_workers, storage_factory=storage_factory, cache=cache).download(tiles, region)
 
-			# Todo update get_stack so this isn't required...
-			for im_idx in range(len(all_frames)):
-				im_ordered[0, 0, im_idx, :, :] = im_stack[:, :, 0, im_idx]
-			
-		session.rollback()
-		session.close()
+		im_ordered = out[np.newaxis, np.newaxis]
 
 		return im_ordered
@@ -0,0 +1,179 @@
+import os
+import threading
+from typing import Tuple
+
+import dask
+from dask.base import tokenize
+import dask.array as da
+import numpy as np
+
+from ._image_database import ImageDatabase
+from ._storage import make_storage_factory
+from ._tile_cache import TileCache
+from ._tile_downloader import TileDownloader
+
+# Downloader of each storage config in this process, shared by the tasks of
+# all lazy stacks
+_downloaders = {}
+_downloaders_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    """
+    Drops the downloaders inherited from the parent process, whose storage
+    clients and locks belong to the parent
+    """
+    global _downloaders_lock
+
+    _downloaders_lock = threading.Lock()
+    _downloaders.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _get_downloader(config: Tuple, cache: TileCache = None) -> TileDownloader:
+    """
+    Returns the downloader of a storage config, which is created on first use.
+    A new downloader uses the given cache or else opens the cache folder of
+    the config.
+    """
+    with _downloaders_lock:
+        if config not in _downloaders:
+            data_path, timeout, max_retries, cache_dir, cache_bytes = config
+            if cache is None and cache_dir is not None:
+                cache = TileCache(cache_dir, max_bytes=cache_bytes)
+            _downloaders[config] = TileDownloader(
+                n_workers=1,
+                max_retries=max_retries,
+                timeout=timeout,
+                storage_factory=make_storage_factory(data_path, timeout),
+                cache=cache
+            )
+
+        return _downloaders[config]
+
+
+def _fetch_tile(s3_dir: str, file_name: str, sha256: str, config: Tuple) -> np.ndarray:
+    """
+    Task fetching one tile of a lazy stack. Its arguments are plain values, so
+    the graph can be sent to distributed or process workers, which create
+    their downloader from the storage config on first use.
+    """
+    return _get_downloader(config).fetch(s3_dir, file_name, sha256)
+
+
+def get_dask_stack(
+                   db_credentials: str, image_ids, channels, pos: int = 0, time: int = 0,
+                   max_retries: int = 3, timeout: float = 60, data_path: str = None,
+                   cache: TileCache = None
+                  ) -> da.Array:
+    """
+    Returns a lazy image stack from the imaging database as a dask array. Only
+    the frame metadata is queried up front. Each (round, channel, z) tile is
+    its own chunk and is downloaded when a computation needs it. The graph
+    only holds the frame locations and the storage config, so it can be
+    computed with the threaded, process or distributed schedulers.
+
+    Parameters
+    ----------
+    db_credentials : str
+        Path to the database credentials file
+    image_ids : List[str]
+        A list of the image ids in round order
+    channels : List[str]
+        A list of the channels in the index order.
+    pos : int
+        Index of the position to load. The default value is 0.
+    time : int
+        Index of the time point to load. The default value is 0.
+    max_retries : int
+        Number of times a failed tile download is retried. The default value is 3.
+    timeout : float
+        Timeout in seconds for each tile request. The default value is 60.
+    data_path : str
+        Path to a mounted image store volume. If set, the tiles are read from
+        the volume instead of S3.
+    cache : TileCache
+        Local tile cache to read tiles from and add downloaded tiles to.
+        The default is no cache.
+
+    returns
+    ----------
+    im_stack : dask.array.Array
+        image stack with order (r, c, z, y, x). Slices missing from a round
+        or channel are 0.
+    """
+    db = ImageDatabase(db_credentials)
+    plan = db.getFramePlan(image_ids, channels, positions=[pos], times=[time])
+    plan.check_complete(pos, time)
+
+    tile_shape = plan.tile_shape(pos, time)
+    dtype = plan.dtype(pos, time)
+    n_slices = max(plan.round_slices(pos, time))
+
+    # The concurrency comes from the dask scheduler, so each worker only
+    # fetches single tiles. The cache is passed by its folder, since the
+    # workers may be other processes.
+    config = (
+        data_path, timeout, max_retries,
+        None if cache is None else cache.cache_dir,
+        None if cache is None else cache.max_bytes
+    )
+    # Tasks run in this process use the given cache
+    _get_downloader(config, cache)
+    fetch = dask.delayed(_fetch_tile, pure=True)
+
+    rounds = []
+    for r in range(len(plan.image_ids)):
+        chans = []
+        for c in range(len(plan.channels)):
+            frames = plan.stack(r, c, pos, time)
+            tiles = [
+                da.from_delayed(
+                    fetch(
+                        frame.s3_dir, frame.file_name, frame.sha256, config,
+                        dask_key_name='tile-' + tokenize(frame.s3_dir, frame.file_name, frame.sha256, config)
+                    ),
+                    shape=tile_shape,
+                    dtype=dtype
+                )
+                for frame in frames
+            ]
+            tiles += [da.zeros(tile_shape, dtype=dtype, chunks=tile_shape)] * (n_slices - len(frames))
+            chans.append(da.stack(tiles))
+        rounds.append(da.stack(chans))
+
+    return da.stack(rounds)
+
+
+def get_lazy_stack(
+                   db_credentials: str, image_ids, channels, pos: int = 0, time: int = 0,
+                   max_retries: int = 3, timeout: float = 60, data_path: str = None,
+                   cache: TileCache = None
+                  ) -> 'xarray.DataArray':
+    """
+    Returns a lazy image stack from the imaging database as a dask-backed
+    xarray DataArray with the starfish axis names (r, c, z, y, x). Reductions
+    such as stack.max(Axes.ZPLANE.value) stream through the tiles and only
+    download the tiles they select.
+
+    The parameters are the same as for get_dask_stack.
+
+    returns
+    ----------
+    im_stack : xr.DataArray
+        image stack with dims (r, c, z, y, x)
+    """
+    # Imported here so the rest of the package doesn't need starfish
+    import xarray as xr
+    from starfish.types import Axes
+
+    data = get_dask_stack(
+        db_credentials, image_ids, channels, pos, time,
+        max_retries=max_retries, timeout=timeout, data_path=data_path, cache=cache
+    )
+    dims = [Axes.ROUND.value, Axes.CH.value, Axes.ZPLANE.value, Axes.Y.value, Axes.X.value]
+
+    return xr.DataArray(data, dims=dims)
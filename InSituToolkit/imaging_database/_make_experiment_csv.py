@@ -1,20 +1,30 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import os
 import hashlib
-from typing import List
+import json
+import tempfile
+from typing import Dict, List
 
 import boto3
 import pandas as pd
 import imaging_db.filestorage.s3_storage as s3_storage
 import imaging_db.database.db_operations as db_ops
-import imaging_db.utils.db_utils as db_utils
 
+from .. import instrumentation
+from ._connection import session_scope
 from ._constants import metadata_keys
+from ._timing import StageTimer
+
+# Size of the buffer used to stream files through the hash
+_CHUNK_SIZE = 1024 * 1024
 
 
 def make_experiment_csv(
                         db_credentials:str, csv_file:str, image_ids:List[str], channels:List[str],
                         metadata_format:str = 'micromanager', positions:int = [0], time:int=0,
-                        data_path:str = '/Volumes/imaging/czbiohub-imaging'
+                        data_path:str = '/Volumes/imaging/czbiohub-imaging',
+                        checksum_index:str = None, n_workers:int = 8
                         ):
     """
     Creates a CSV file mapping imagingDB frames to indices in an ImageStack
@@ -39,86 +49,270 @@ def make_experiment_csv(
         Index of the time point to download. The default value is 0.
     data_path : str
         Path to the image store volume
+    checksum_index : str
+        Path to a JSON file caching the file checksums between runs. If None,
+        every file is hashed.
+    n_workers : int
+        Number of files hashed concurrently. The default value is 8.
+    """
+
+    return make_experiment_csvs(
+        db_credentials, {'primary': csv_file}, image_ids, {'primary': channels},
+        metadata_format, positions, time, data_path, checksum_index, n_workers
+    )
+
+def make_experiment_csvs(
+                         db_credentials:str, csv_files:Dict[str, str], image_ids:List[str],
+                         channel_groups:Dict[str, List[str]], metadata_format:str = 'micromanager',
+                         positions:List[int] = [0], time:int = 0,
+                         data_path:str = '/Volumes/imaging/czbiohub-imaging',
+                         checksum_index:str = None, n_workers:int = 8, timer:StageTimer = None
+                         ):
+    """
+    Creates the CSV files for several images of an experiment (e.g., primary,
+    stain and nuclei) with a single metadata query and checksum pass.
+
+    Parameters
+    ----------
+    db_credentials : str
+        Path to the database credentials file
+    csv_files : Dict[str, str]
+        Path of the resulting CSV file for each image name
+    image_ids : List[str]
+        A list of the image ids in round order
+    channel_groups : Dict[str, List[str]]
+        The channels of each image name in the index order.
+    metadata_format : str
+        Format for the image metadata on imagingDB. For micromanager, set to 'micromanager'.
+        Default value is 'micromanager'
+    positions : List[int]
+        Indices of the positions to include. The default value is [0].
+    time : int
+        Index of the time point to download. The default value is 0.
+    data_path : str
+        Path to the image store volume
+    checksum_index : str
+        Path to a JSON file caching the file checksums between runs. If None,
+        every file is hashed.
+    n_workers : int
+        Number of files hashed concurrently. The default value is 8.
+    timer : StageTimer
+        Records the time of the query and checksum stages. The default is None.
+
+    Returns
+    -------
+    tile_width, tile_height : int
+        The shape of the tiles
+    """
+    if timer is None:
+        timer = StageTimer()
+
+    # Query every channel of every image at once
+    all_channels = list(OrderedDict.fromkeys(
+        chan for channels in channel_groups.values() for chan in channels
+    ))
+
+    with timer.stage('query metadata'):
+        with session_scope(db_credentials) as session:
+            im_df = _query_tile_table(session, image_ids, all_channels, positions, time, metadata_format)
+
+    if len(im_df) == 0:
+        raise ValueError('No images match query')
+
+    with timer.stage('checksums'):
+        im_df.insert(
+            im_df.columns.get_loc('path') + 1, 'sha256',
+            _calc_checksums(im_df['path'], data_path, n_workers, checksum_index)
+        )
+
+    with timer.stage('write csv'):
+        for name, channels in channel_groups.items():
+            # Renumber the channels to their index within the image
+            group_df = pd.concat([
+                im_df[im_df['ch'] == all_channels.index(chan)].assign(ch=ch)
+                for ch, chan in enumerate(channels)
+            ])
+            group_df = group_df.sort_values(['round', 'fov', 'ch', 'zplane']).reset_index(drop=True)
+            group_df.to_csv(csv_files[name])
+
+    return int(im_df['tile_width'].iloc[0]), int(im_df['tile_height'].iloc[0])
+
+def _query_tile_table(
+                      session, image_ids: List[str], channels: List[str], positions: List[int],
+                      time: int, metadata_format: str = 'micromanager'
+                     ) -> pd.DataFrame:
     """
+    Builds the table of tiles for the spacetx writer from a single query. Only
+    the needed columns are loaded and the frame metadata is extracted in bulk.
 
+    Returns
+    -------
+    im_df : pd.DataFrame
+        Table with the fov, round, ch, zplane, path, coordinate and tile shape
+        columns ordered by round, fov, ch and zplane
+    """
     meta_keys = metadata_keys[metadata_format.lower()]
 
-    fov = []
-    rnd = []
-    channel = []
-    z = []
-    file_path = []
-    #sha = []
-    xc_min = []
-    xc_max = []
-    yc_min = []
-    yc_max = []
-    zc_min = []
-    zc_max = []
-    tile_width = []
-    tile_height = []
-
-    credentials_str = db_utils.get_connection_str(db_credentials)
-
-    with db_ops.session_scope(credentials_str) as session:
-        for r, im_id in enumerate(image_ids):
-            for fov_idx, p in enumerate(positions):
-                for chan_idx, c in enumerate(channels):
-                    frames = session.query(db_ops.Frames) \
-                        .join(db_ops.FramesGlobal) \
-                        .join(db_ops.DataSet) \
-                        .filter(db_ops.DataSet.dataset_serial == im_id) \
-                        .filter(db_ops.Frames.pos_idx == p) \
-                        .filter(db_ops.Frames.channel_name == c) \
-                        .filter(db_ops.Frames.time_idx == time) \
-
-                    for frame in frames:
-                        # Determine
-                        pixel_size = frame.metadata_json[meta_keys['key']][meta_keys['pixel_size']]
-                        im_width = frame.frames_global.im_width
-                        im_height = frame.frames_global.im_height
-
-                        # Add frame indices
-                        fov.append(fov_idx)
-                        rnd.append(r)
-                        channel.append(chan_idx)
-                        z.append(frame.slice_idx)
-                        # Clean any windows file path seps before adding path
-                        fp = os.path.join(frame.frames_global.storage_dir, frame.file_name)
-                        clean_fp = os.path.join(*fp.split('\\'))
-                        file_path.append(clean_fp)
-                        xc_min.append(frame.metadata_json[meta_keys['key']][meta_keys['xpos_um']])
-                        xc_max.append(xc_min[-1] + im_width * pixel_size)
-                        yc_min.append(frame.metadata_json[meta_keys['key']][meta_keys['ypos_um']])
-                        yc_max.append(yc_min[-1] + im_height * pixel_size)
-                        zc_min.append(frame.metadata_json[meta_keys['key']][meta_keys['zpos_um']])
-                        zc_max.append(frame.metadata_json[meta_keys['key']][meta_keys['zpos_um']])
-                        tile_width.append(im_width)
-                        tile_height.append(im_height)
-
-    sha = _calc_checksums(file_path, data_path)
-                    
-    data = [fov, rnd, channel, z, file_path, sha, xc_min, xc_max, yc_min, yc_max, zc_min, zc_max, tile_width, tile_height]
+    rows = session.query(
+                db_ops.DataSet.dataset_serial,
+                db_ops.Frames.pos_idx,
+                db_ops.Frames.channel_name,
+                db_ops.Frames.slice_idx,
+                db_ops.Frames.file_name,
+                db_ops.Frames.metadata_json,
+                db_ops.FramesGlobal.storage_dir,
+                db_ops.FramesGlobal.im_width,
+                db_ops.FramesGlobal.im_height,
+            ) \
+        .select_from(db_ops.Frames) \
+        .join(db_ops.FramesGlobal) \
+        .join(db_ops.DataSet) \
+        .filter(db_ops.DataSet.dataset_serial.in_(list(image_ids))) \
+        .filter(db_ops.Frames.pos_idx.in_(list(positions))) \
+        .filter(db_ops.Frames.channel_name.in_(list(channels))) \
+        .filter(db_ops.Frames.time_idx == time) \
+        .all()
+
     columns = [
-                'fov','round', 'ch', 'zplane', 'path','sha256', 'xc_min',
-                'xc_max', 'yc_min', 'yc_max', 'zc_min', 'zc_max', 'tile_width', 'tile_height'
+                'dataset_serial', 'pos_idx', 'channel_name', 'zplane', 'file_name',
+                'metadata_json', 'storage_dir', 'tile_width', 'tile_height'
               ]
-    im_df = pd.DataFrame(dict(zip(columns, data)))
-    im_df.to_csv(csv_file)
+    frames_df = pd.DataFrame.from_records(rows, columns=columns)
+
+    # Map the database indices to the ImageStack indices. Merging also
+    # handles a dataset, position or channel that is requested twice.
+    rounds = pd.DataFrame({'dataset_serial': list(image_ids), 'round': range(len(image_ids))})
+    fovs = pd.DataFrame({'pos_idx': list(positions), 'fov': range(len(positions))})
+    chans = pd.DataFrame({'channel_name': list(channels), 'ch': range(len(channels))})
+    frames_df = frames_df.merge(rounds, on='dataset_serial') \
+        .merge(fovs, on='pos_idx') \
+        .merge(chans, on='channel_name') \
+        .sort_values(['round', 'fov', 'ch', 'zplane']) \
+        .reset_index(drop=True)
+
+    # Extract the metadata fields for all frames at once
+    meta = pd.DataFrame.from_records(
+        [m[meta_keys['key']] for m in frames_df['metadata_json']],
+        columns=[meta_keys['pixel_size'], meta_keys['xpos_um'], meta_keys['ypos_um'], meta_keys['zpos_um']]
+    )
+    pixel_size = meta[meta_keys['pixel_size']].to_numpy(dtype=float)
+    xc_min = meta[meta_keys['xpos_um']].to_numpy(dtype=float)
+    yc_min = meta[meta_keys['ypos_um']].to_numpy(dtype=float)
+    zc = meta[meta_keys['zpos_um']].to_numpy(dtype=float)
+    tile_width = frames_df['tile_width'].to_numpy()
+    tile_height = frames_df['tile_height'].to_numpy()
+
+    # Clean any windows file path seps before adding path
+    file_path = [
+        os.path.join(*os.path.join(storage_dir, file_name).split('\\'))
+        for storage_dir, file_name in zip(frames_df['storage_dir'], frames_df['file_name'])
+    ]
+
+    im_df = pd.DataFrame({
+        'fov': frames_df['fov'].to_numpy(),
+        'round': frames_df['round'].to_numpy(),
+        'ch': frames_df['ch'].to_numpy(),
+        'zplane': frames_df['zplane'].to_numpy(),
+        'path': file_path,
+        'xc_min': xc_min,
+        'xc_max': xc_min + tile_width * pixel_size,
+        'yc_min': yc_min,
+        'yc_max': yc_min + tile_height * pixel_size,
+        'zc_min': zc,
+        'zc_max': zc,
+        'tile_width': tile_width,
+        'tile_height': tile_height
+    })
+
+    return im_df
+
+def _calc_checksums(
+                    file_names: List[str], data_path: str, n_workers: int = 8,
+                    checksum_index: str = None
+                   ) -> List[str]:
+    """
+    Calculates the sha256 of each file. The files are hashed in parallel and
+    streamed in fixed size chunks.
+
+    Parameters
+    ----------
+    file_names : List[str]
+        Paths of the files relative to data_path
+    data_path : str
+        Path to the image store volume
+    n_workers : int
+        Number of files hashed concurrently. The default value is 8.
+    checksum_index : str
+        Path to a JSON file caching the checksums by path, size and
+        modification time. Files that haven't changed since they were added to
+        the index are not hashed again. The saved index only has the files of
+        this call, so it doesn't grow with files that were removed or are no
+        longer used. If None, no index is used.
+
+    Returns
+    -------
+    checksums : List[str]
+        The sha256 hex digest of each file
+    """
+    # We need to replace any windows file separators with the proper separator
+    filenames = [
+        os.path.join(data_path, os.path.join(*file.split('\\'))) for file in file_names
+    ]
+    index = _load_checksum_index(checksum_index)
+
+    def _checksum(filename):
+        stat = os.stat(filename)
+        entry = index.get(filename)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return entry['sha256']
 
-    return im_width, im_height
+        readable_hash = _sha256_file(filename)
+        index[filename] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': readable_hash}
 
-def _calc_checksums(file_names, data_path):
-    checksums = []
+        return readable_hash
 
-    for file in file_names:
-        # We need to replace any windows file separators with the proper separator
-        cleaned_filename = os.path.join(*file.split('\\'))
-        filename = os.path.join(data_path, cleaned_filename)
-        with open(filename,"rb") as f:
-            bytes = f.read() # read entire file as bytes
-            readable_hash = hashlib.sha256(bytes).hexdigest();
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        checksums = list(executor.map(_checksum, filenames))
 
-            checksums.append(readable_hash)
+    if checksum_index is not None:
+        # Drop the entries of files that weren't requested
+        seen = set(filenames)
+        _save_checksum_index({k: v for k, v in index.items() if k in seen}, checksum_index)
 
     return checksums
+
+
+def _sha256_file(filename: str) -> str:
+    sha256 = hashlib.sha256()
+    buffer = bytearray(_CHUNK_SIZE)
+    view = memoryview(buffer)
+
+    with open(filename, 'rb', buffering=0) as f:
+        n_bytes = f.readinto(buffer)
+        while n_bytes:
+            sha256.update(view[:n_bytes])
+            instrumentation.count(instrumentation.BYTES_HASHED, n_bytes)
+            n_bytes = f.readinto(buffer)
+
+    return sha256.hexdigest()
+
+
+def _load_checksum_index(checksum_index: str) -> dict:
+    if checksum_index is None or not os.path.isfile(checksum_index):
+        return {}
+
+    try:
+        with open(checksum_index) as f:
+            return json.load(f)
+    except ValueError:
+        # Start over from a corrupt index
+        return {}
+
+
+def _save_checksum_index(index: dict, checksum_index: str):
+    # Write to a temporary file and rename so readers never see a partial index
+    folder = os.path.dirname(os.path.abspath(checksum_index))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, checksum_index)
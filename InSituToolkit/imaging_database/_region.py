@@ -0,0 +1,47 @@
+from typing import Optional, Tuple
+
+
+def make_region(y: slice = None, x: slice = None, stride: int = 1) -> Optional[Tuple[slice, slice]]:
+    """
+    Returns the (y, x) slices selecting a region of each tile, or None if the
+    whole tile is selected
+
+    Parameters
+    ----------
+    y : slice
+        Rows of the tile to select. If None, all rows are selected.
+    x : slice
+        Columns of the tile to select. If None, all columns are selected.
+    stride : int
+        Only every stride-th row and column of the region is selected, which
+        downsamples the tile by nearest neighbor. The default value is 1.
+
+    Returns
+    -------
+    region : Tuple[slice, slice]
+    """
+    if stride < 1:
+        raise ValueError('stride must be at least 1')
+
+    region = []
+    for s in [y, x]:
+        if s is None:
+            s = slice(None)
+        if not isinstance(s, slice) or s.step not in (None, 1):
+            raise ValueError('y and x must be slices without a step, use stride to downsample')
+        region.append(slice(s.start, s.stop, stride))
+
+    if all(s.start is None and s.stop is None for s in region) and stride == 1:
+        return None
+
+    return tuple(region)
+
+
+def region_shape(region: Optional[Tuple[slice, slice]], tile_shape: Tuple[int, int]) -> Tuple[int, int]:
+    """
+    Returns the (y, x) shape of a region of a tile
+    """
+    if region is None:
+        return tuple(tile_shape)
+
+    return tuple(len(range(*s.indices(n))) for s, n in zip(region, tile_shape))
@@ -0,0 +1,162 @@
+import os
+from typing import Tuple
+
+import boto3
+from botocore.config import Config
+import numpy as np
+import imaging_db.filestorage.s3_storage as s3_storage
+from skimage import io
+import tifffile
+
+from .. import instrumentation
+
+
+def _count_get_object(parsed, **kwargs):
+    instrumentation.count(instrumentation.BYTES_DOWNLOADED, parsed.get('ContentLength', 0))
+
+
+def make_s3_storage(s3_dir: str, timeout: float = None):
+    """
+    Creates an imagingDB S3 storage client for a folder
+
+    Parameters
+    ----------
+    s3_dir : str
+        Folder on the imaging bucket containing the frames
+    timeout : float
+        Connect and read timeout in seconds for each request. If None, the
+        boto3 defaults are used.
+
+    Returns
+    -------
+    data_loader : s3_storage.DataStorage
+    """
+    data_loader = s3_storage.DataStorage(s3_dir=s3_dir)
+
+    if timeout is not None:
+        # Retries are handled by the TileDownloader
+        config = Config(
+            connect_timeout=timeout,
+            read_timeout=timeout,
+            retries={'max_attempts': 0}
+        )
+        data_loader.s3_client = boto3.client('s3', config=config)
+
+    # Count the bytes of each downloaded frame for the instrumentation
+    s3_client = getattr(data_loader, 's3_client', None)
+    if s3_client is not None:
+        s3_client.meta.events.register('after-call.s3.GetObject', _count_get_object)
+
+    return data_loader
+
+
+class LocalStorage:
+    """
+    Reads frames from a mounted copy of the image store (e.g., the
+    czbiohub-imaging volume) with the same interface as s3_storage.DataStorage.
+
+    Parameters
+    ----------
+    data_path : str
+        Path to the image store volume
+    s3_dir : str
+        Folder on the image store containing the frames
+    """
+    def __init__(self, data_path: str, s3_dir: str):
+        # Clean any windows file path seps
+        self.s3_dir = os.path.join(*s3_dir.split('\\'))
+        self.data_path = data_path
+
+    def get_path(self, file_name: str) -> str:
+        return os.path.join(self.data_path, self.s3_dir, file_name)
+
+    def get_im(self, file_name: str) -> np.ndarray:
+        path = self.get_path(file_name)
+        instrumentation.count(instrumentation.BYTES_READ, os.path.getsize(path))
+
+        return io.imread(path)
+
+    def get_im_region(self, file_name: str, region: Tuple[slice, slice]) -> np.ndarray:
+        """
+        Returns a (y, x) region of a frame. TIFF frames are memory-mapped when
+        they are uncompressed, otherwise only the strips or tiles overlapping
+        the region are read and decoded. Other formats are decoded and cropped.
+        """
+        path = self.get_path(file_name)
+        if not path.lower().endswith(('.tif', '.tiff')):
+            return self.get_im(file_name)[region]
+
+        try:
+            tile = np.asarray(tifffile.memmap(path, mode='r')[region])
+        except ValueError:
+            # Compressed frames can't be memory-mapped
+            tile = _read_tiff_region(path, region)
+        instrumentation.count(instrumentation.BYTES_READ, tile.nbytes)
+
+        return tile
+
+
+def _read_tiff_region(path: str, region: Tuple[slice, slice]) -> np.ndarray:
+    """
+    Reads a (y, x) region of a single plane TIFF by decoding only the strips
+    or tiles that overlap the bounding box of the region
+    """
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        if len(page.shape) != 2:
+            return page.asarray()[region]
+
+        height, width = page.shape
+        rows = range(*region[0].indices(height))
+        cols = range(*region[1].indices(width))
+        if len(rows) == 0 or len(cols) == 0:
+            return np.empty((len(rows), len(cols)), dtype=page.dtype)
+
+        if page.is_tiled:
+            seg_height, seg_width = page.tilelength, page.tilewidth
+        else:
+            seg_height, seg_width = min(page.rowsperstrip or height, height), width
+
+        # Bounding box of the region and the segments overlapping it
+        y0, y1 = rows[0], rows[-1] + 1
+        x0, x1 = cols[0], cols[-1] + 1
+        n_seg_cols = -(-width // seg_width)
+        indices = [
+            seg_y * n_seg_cols + seg_x
+            for seg_y in range(y0 // seg_height, (y1 - 1) // seg_height + 1)
+            for seg_x in range(x0 // seg_width, (x1 - 1) // seg_width + 1)
+        ]
+
+        # Empty segments are left as 0
+        block = np.zeros((y1 - y0, x1 - x0), dtype=page.dtype)
+        segments = tif.filehandle.read_segments(
+            [page.dataoffsets[i] for i in indices],
+            [page.databytecounts[i] for i in indices],
+            indices=indices,
+            sort=True
+        )
+        for data, index in segments:
+            segment, (_, _, top, left, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+            if segment is None:
+                continue
+            segment = segment[0, :, :, 0]
+
+            # Overlap of the segment and the bounding box
+            top_in, bottom_in = max(top, y0), min(top + segment.shape[0], y1)
+            left_in, right_in = max(left, x0), min(left + segment.shape[1], x1)
+            block[top_in - y0:bottom_in - y0, left_in - x0:right_in - x0] = \
+                segment[top_in - top:bottom_in - top, left_in - left:right_in - left]
+
+    return block[::rows.step, ::cols.step]
+
+
+def make_storage_factory(data_path: str = None, timeout: float = None):
+    """
+    Returns a function that creates a storage client for an s3_dir. Frames are
+    read from S3 unless data_path is set, in which case they are read from the
+    mounted image store.
+    """
+    if data_path is None:
+        return lambda s3_dir: make_s3_storage(s3_dir, timeout=timeout)
+
+    return lambda s3_dir: LocalStorage(data_path, s3_dir)
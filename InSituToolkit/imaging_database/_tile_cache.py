@@ -0,0 +1,158 @@
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+# Fraction of max_bytes the cache is evicted down to, so a full cache isn't
+# rescanned on every put
+_LOW_WATER = 0.9
+
+
+class TileCache:
+    """
+    Persistent on-disk cache of downloaded tiles shared between runs and
+    processes.
+
+    Tiles are stored as .npy files keyed by the hash of (s3_dir, file_name,
+    sha256), so a frame that is re-uploaded with different content gets a new
+    key. Cached tiles are served memory-mapped. When the cache grows beyond
+    max_bytes, the least recently used tiles are evicted until it is below
+    90% of max_bytes.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder to store the cached tiles in. It is created if it doesn't exist.
+    max_bytes : int
+        Size budget of the cache in bytes. The default value is 10 GB.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 10 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._lock = threading.Lock()
+        self._size = sum(size for _, size, _ in self._scan())
+
+    @staticmethod
+    def key(s3_dir: str, file_name: str, sha256: str) -> str:
+        key_str = '\n'.join([s3_dir, file_name, sha256])
+        return hashlib.sha256(key_str.encode('utf-8')).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def get(self, s3_dir: str, file_name: str, sha256: str):
+        """
+        Returns the memory-mapped tile or None if it isn't cached
+        """
+        path = self._path(self.key(s3_dir, file_name, sha256))
+        try:
+            tile = np.load(path, mmap_mode='r')
+            # Mark the tile as recently used
+            os.utime(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            # Missing, evicted by another process, incomplete or corrupt
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+
+        return tile
+
+    def put(self, s3_dir: str, file_name: str, sha256: str, tile: np.ndarray):
+        """
+        Adds a tile to the cache. The tile is written to a temporary file and
+        renamed, so other processes never read a partially written tile.
+        """
+        path = self._path(self.key(s3_dir, file_name, sha256))
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, tile)
+            # A tile put again, e.g. to replace a corrupt entry, replaces the
+            # old file, whose size is no longer part of the cache
+            try:
+                old_size = os.path.getsize(path)
+            except FileNotFoundError:
+                old_size = 0
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._size += os.path.getsize(path) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _scan(self):
+        """
+        Returns (path, size, mtime) for every cached tile
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.npy'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+
+        return entries
+
+    def _evict(self):
+        # Rescan, since other processes share the cache folder
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        size = sum(entry[1] for entry in entries)
+        target = int(self.max_bytes * _LOW_WATER)
+
+        for path, file_size, _ in entries:
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            size -= file_size
+
+        self._size = size
+
+    def clear(self):
+        """
+        Removes all cached tiles
+        """
+        with self._lock:
+            for path, _, _ in self._scan():
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._size = 0
+
+    def stats(self) -> dict:
+        """
+        Returns the hit, miss and eviction counts and the cache size in bytes
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size_bytes': self._size
+            }
@@ -0,0 +1,171 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+import threading
+from time import sleep
+from typing import Callable, Iterable, Tuple
+
+import numpy as np
+
+from .. import instrumentation
+from ._storage import make_storage_factory
+
+
+class TileDownloader:
+    """
+    Downloads frames concurrently and writes each one directly into its slot
+    of a preallocated output array.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of download threads. The default value is 8.
+    max_retries : int
+        Number of times a failed tile download is retried. The default value is 3.
+    backoff : float
+        Delay in seconds before the first retry. The delay doubles after each
+        failed attempt. The default value is 0.5.
+    timeout : float
+        Connect and read timeout in seconds for each tile request. The default
+        value is 60.
+    storage_factory : Callable[[str], object]
+        Function returning a storage client with a get_im(file_name) method for
+        an s3_dir. The default creates an imagingDB S3 client.
+    cache : TileCache
+        Local tile cache. Tiles with a known sha256 are read from the cache
+        when present and added to it after download. The default is no cache.
+    """
+    def __init__(
+                 self, n_workers: int = 8, max_retries: int = 3, backoff: float = 0.5,
+                 timeout: float = 60, storage_factory: Callable = None, cache=None
+                ):
+        if n_workers < 1:
+            raise ValueError('n_workers must be at least 1')
+
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        if storage_factory is None:
+            storage_factory = make_storage_factory(timeout=timeout)
+        self.storage_factory = storage_factory
+        self.cache = cache
+
+        self._storages = {}
+        self._lock = threading.Lock()
+
+    def _get_storage(self, s3_dir: str):
+        with self._lock:
+            if s3_dir not in self._storages:
+                self._storages[s3_dir] = self.storage_factory(s3_dir)
+
+            return self._storages[s3_dir]
+
+    def fetch(
+              self, s3_dir: str, file_name: str, sha256: str = None,
+              region: Tuple[slice, slice] = None
+             ) -> np.ndarray:
+        """
+        Downloads a single tile, retrying with exponential backoff on failure.
+        If the sha256 of the frame is given, the tile cache is used.
+
+        If a (y, x) region is given, only that region is returned. Storages
+        with a get_im_region method read only the region and the result isn't
+        cached. Otherwise, the tile is decoded and cropped.
+        """
+        use_cache = self.cache is not None and sha256 is not None
+        if use_cache:
+            tile = self.cache.get(s3_dir, file_name, sha256)
+            if tile is not None:
+                instrumentation.count(instrumentation.TILES_CACHED)
+                return tile if region is None else tile[region]
+
+        if region is not None and hasattr(self._get_storage(s3_dir), 'get_im_region'):
+            return self._fetch_remote(s3_dir, file_name, region)
+
+        tile = self._fetch_remote(s3_dir, file_name)
+        if use_cache:
+            self.cache.put(s3_dir, file_name, sha256, tile)
+
+        return tile if region is None else tile[region]
+
+    def _fetch_remote(self, s3_dir: str, file_name: str, region: Tuple[slice, slice] = None) -> np.ndarray:
+        storage = self._get_storage(s3_dir)
+
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                with instrumentation.stage('fetch tile'):
+                    if region is None:
+                        tile = storage.get_im(file_name)
+                    else:
+                        tile = storage.get_im_region(file_name, region)
+                instrumentation.count(instrumentation.TILES_DOWNLOADED)
+                return tile
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                sleep(delay)
+                delay *= 2
+
+    def download(self, tiles: Iterable[Tuple[np.ndarray, str, str, str]], region: Tuple[slice, slice] = None):
+        """
+        Downloads tiles into their destination arrays
+
+        Parameters
+        ----------
+        tiles : Iterable[Tuple[np.ndarray, str, str, str]]
+            (dest, s3_dir, file_name, sha256) for each tile, where dest is the
+            (y, x) view of the output array the tile is written into. sha256
+            may be None if the frame checksum is unknown.
+        region : Tuple[slice, slice]
+            (y, x) region of each tile to download. If None, the whole tiles
+            are downloaded.
+        """
+        def _download_tile(dest, s3_dir, file_name, sha256):
+            dest[...] = self.fetch(s3_dir, file_name, sha256, region)
+
+        with instrumentation.stage('download tiles'), \
+                ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            futures = [
+                executor.submit(_download_tile, *tile)
+                for tile in tiles
+            ]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+
+            for future in not_done:
+                future.cancel()
+            for future in done:
+                # Raise the first download error
+                future.result()
+
+    def download_plan(self, plan, out, pos: int = 0, time: int = 0, region: Tuple[slice, slice] = None):
+        """
+        Downloads the tiles of a FramePlan position and time point
+
+        Parameters
+        ----------
+        plan : FramePlan
+            The frames to download
+        out : Union[np.ndarray, List[np.ndarray]]
+            Array with order (r, c, z, y, x) or a list with a (c, z, y, x)
+            array for each round
+        pos : int
+            Index of the position to download. The default value is 0.
+        time : int
+            Index of the time point to download. The default value is 0.
+        region : Tuple[slice, slice]
+            (y, x) region of each tile to download. If None, the whole tiles
+            are downloaded.
+
+        Returns
+        -------
+        out : Union[np.ndarray, List[np.ndarray]]
+        """
+        tiles = (
+            (out[r][c, z], s3_dir, frame.file_name, frame.sha256)
+            for s3_dir, group in plan.by_s3_dir(pos, time).items()
+            for r, c, z, frame in group
+        )
+        self.download(tiles, region)
+
+        return out
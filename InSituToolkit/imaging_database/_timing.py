@@ -0,0 +1,45 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+
+from .. import instrumentation
+
+
+class StageTimer:
+    """
+    Records the wall time of the stages of a job. The stages are also
+    recorded by an active instrumentation.instrument() block.
+
+    Parameters
+    ----------
+    verbose : bool
+        If True, each stage is printed when it finishes. The default value is False.
+    """
+    def __init__(self, verbose: bool = False):
+        self.verbose = verbose
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name: str):
+        if self.verbose:
+            print('{}...'.format(name))
+
+        start = time.perf_counter()
+        try:
+            with instrumentation.stage(name):
+                yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0) + elapsed
+
+            if self.verbose:
+                print('{} done in {:.2f} s'.format(name, elapsed))
+
+    def report(self) -> str:
+        """
+        Returns a table of the stage times
+        """
+        lines = ['{:<30} {:>8.2f} s'.format(name, elapsed) for name, elapsed in self.stages.items()]
+        lines.append('{:<30} {:>8.2f} s'.format('total', sum(self.stages.values())))
+
+        return '\n'.join(lines)
@@ -1,9 +1,23 @@
+from collections import OrderedDict
+import json
+import os
 from os import path
+import re
+import shutil
 import sys
 import subprocess
-from typing import List
+import tempfile
+from typing import Dict, List, Optional, Sequence, Set
 
-from ._make_experiment_csv import make_experiment_csv
+import pandas as pd
+
+from ._make_experiment_csv import make_experiment_csvs
+from ._timing import StageTimer
+
+_WRITER_SCRIPT = 'spacetx_biohub_writer'
+
+# Maps each tile of the last written experiment to its source file and checksum
+_MANIFEST_FILE = 'tile_manifest.json'
 
 
 def write_experiment(
@@ -12,11 +26,18 @@ def write_experiment(
                      nuc_channels:List[str] = None, metadata_format:str = 'micromanager',
                      positions:List[int] = [0], time:int=0,
                      data_path:str = '/Volumes/imaging/czbiohub-imaging/',
-                     img_format: str = 'PNG'
+                     img_format: str = 'PNG', n_workers: int = 8, verbose: bool = False,
+                     incremental: bool = False
                     ):
     """
     Writes the spacetx format experiment files for analysis in starfish
 
+    The image tables of all channel groups are built with one metadata query
+    and the checksums are computed on n_workers threads. The spacetx writer
+    then runs in this process. It only references the tiles by their path
+    and takes their checksums from the tables, so it reads no tiles and runs
+    serially.
+
     Parameters
     ----------
     db_credentials : str
@@ -41,40 +62,295 @@ def write_experiment(
         Index of the time point to download. The default value is 0.
     data_path : str
         Path to the image store volume
+    img_format : str
+        Tile format of the images. The default value is 'PNG'.
+    n_workers : int
+        Number of files hashed concurrently. The default value is 8.
+    verbose : bool
+        If True, the progress and time of each stage are printed. The default value is False.
+    incremental : bool
+        If True, the tiles are compared against the manifest of the previous
+        run in output_folder and only the fields of view with new or changed
+        tiles are rewritten. If there is no previous run, or images or fields
+        of view were removed, the whole experiment is written. The default
+        value is False.
+
+    Returns
+    -------
+    stages : Dict[str, float]
+        Wall time in seconds of each stage
     """
 
-    spots_file_path = path.join(output_folder, 'spots.csv')
-    tile_width, tile_height = make_experiment_csv(
-                                                  db_credentials, spots_file_path, image_ids,
-                                                  spot_channels, metadata_format, positions, time,
-                                                  data_path
-    )
-    csv_args = 'primary ' + spots_file_path
+    timer = StageTimer(verbose=verbose)
 
+    # Build the tables of every image with a single metadata pass
+    csv_files = OrderedDict([('primary', path.join(output_folder, 'spots.csv'))])
+    channel_groups = OrderedDict([('primary', spot_channels)])
     if stain_channels is not None:
-        stain_file_path = path.join(output_folder, 'stain.csv')
-        _, _ = make_experiment_csv(
-                            db_credentials, stain_file_path, image_ids,
-                            stain_channels, metadata_format, positions, time
-        )
+        csv_files['stain'] = path.join(output_folder, 'stain.csv')
+        channel_groups['stain'] = stain_channels
+    if nuc_channels is not None:
+        csv_files['nuclei'] = path.join(output_folder, 'nuclei.csv')
+        channel_groups['nuclei'] = nuc_channels
 
-        csv_args += ' --csv-file stain ' + stain_file_path
+    # Checksums of unchanged files are reused between runs
+    checksum_index = path.join(output_folder, 'checksums.json')
 
-    if nuc_channels is not None:
-        stain_file_path = path.join(output_folder, 'nuclei.csv')
-        _, _ = make_experiment_csv(
-                            db_credentials, stain_file_path, image_ids,
-                            nuc_channels, metadata_format, positions, time
+    tile_width, tile_height = make_experiment_csvs(
+                                                   db_credentials, csv_files, image_ids,
+                                                   channel_groups, metadata_format, positions, time,
+                                                   data_path, checksum_index, n_workers, timer
+    )
+
+    manifest_file = path.join(output_folder, _MANIFEST_FILE)
+    with timer.stage('compare manifest'):
+        manifest = _make_manifest(csv_files)
+        changed_fovs = None
+        if incremental:
+            changed_fovs = _changed_fovs(manifest, _load_manifest(manifest_file), output_folder)
+
+    with timer.stage('spacetx writer'):
+        if changed_fovs is None:
+            _run_writer(_writer_args(
+                tile_width, tile_height, data_path, output_folder, img_format, csv_files
+            ))
+        elif any(len(fovs) > 0 for fovs in changed_fovs.values()):
+            _write_changed_fovs(
+                changed_fovs, csv_files, tile_width, tile_height, data_path,
+                output_folder, img_format
+            )
+        elif verbose:
+            print('No tiles changed')
+
+    _save_json(manifest, manifest_file)
+
+    if verbose:
+        print(timer.report())
+
+    return dict(timer.stages)
+
+
+def _writer_args(
+                 tile_width: int, tile_height: int, data_path: str, output_dir: str,
+                 img_format: str, csv_files: Dict[str, str]
+                ) -> List[str]:
+    args = [
+            '--tile-width', str(tile_width),
+            '--tile-height', str(tile_height),
+            '--s3-prefix', data_path,
+            '--output-dir', output_dir,
+            '--image_format', img_format
+    ]
+    for name, csv_file in csv_files.items():
+        args += ['--csv-file', name, csv_file]
+
+    return args
+
+
+def _make_manifest(csv_files: Dict[str, str]) -> Dict[str, Dict[str, dict]]:
+    """
+    Maps each "fov,round,ch,zplane" tile of each image to its path and sha256
+    """
+    manifest = {}
+    for name, csv_file in csv_files.items():
+        im_df = pd.read_csv(csv_file, index_col=0)
+        keys = [
+            ','.join(str(i) for i in idx)
+            for idx in zip(im_df['fov'], im_df['round'], im_df['ch'], im_df['zplane'])
+        ]
+        manifest[name] = {
+            key: {'path': p, 'sha256': sha, 'fov': int(fov)}
+            for key, p, sha, fov in zip(keys, im_df['path'], im_df['sha256'], im_df['fov'])
+        }
+
+    return manifest
+
+
+def _load_manifest(manifest_file: str) -> Optional[dict]:
+    if not path.isfile(manifest_file):
+        return None
+
+    with open(manifest_file) as f:
+        return json.load(f)
+
+
+def _save_json(data, file_name: str):
+    # Write to a temporary file and rename so a failed run never leaves a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=path.dirname(path.abspath(file_name)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, file_name)
+
+
+def _changed_fovs(manifest: dict, previous: Optional[dict], output_folder: str) -> Optional[Dict[str, Set[int]]]:
+    """
+    Returns the fields of view of each image with new or changed tiles, or None
+    if the whole experiment has to be written
+    """
+    if previous is None or not path.isfile(path.join(output_folder, 'experiment.json')):
+        return None
+
+    # Removing images or tiles requires the manifests to be rebuilt
+    if set(manifest) != set(previous):
+        return None
+
+    changed = {}
+    for name, tiles in manifest.items():
+        previous_tiles = previous[name]
+        if not set(previous_tiles).issubset(tiles):
+            return None
+
+        changed[name] = {
+            tile['fov'] for key, tile in tiles.items()
+            if previous_tiles.get(key) != tile
+        }
+
+    return changed
+
+
+def _write_changed_fovs(
+                       changed_fovs: Dict[str, Set[int]], csv_files: Dict[str, str],
+                       tile_width: int, tile_height: int, data_path: str, output_folder: str,
+                       img_format: str
+                      ):
+    """
+    Writes the fields of view with changed tiles to a staging folder, moves
+    their manifests into output_folder and adds them to the image collections.
+
+    The staged fields of view are numbered 0, 1, ... in the order of their
+    original indices, so their numbering doesn't depend on how the writer
+    numbers sparse indices. They are then renamed to their original indices.
+    If the staged names can't be mapped back, the whole experiment is
+    written instead.
+    """
+    staging_dir = tempfile.mkdtemp(dir=output_folder, prefix='.staging-')
+    try:
+        # Only the tiles of the changed fields of view are passed to the writer
+        staged_csvs = OrderedDict()
+        staged_fovs = OrderedDict()
+        for name, fovs in changed_fovs.items():
+            if len(fovs) == 0:
+                continue
+            im_df = pd.read_csv(csv_files[name], index_col=0)
+            staged_fovs[name] = sorted(fovs)
+            staged_df = im_df[im_df['fov'].isin(fovs)].copy()
+            staged_df['fov'] = staged_df['fov'].map({fov: i for i, fov in enumerate(staged_fovs[name])})
+            staged_csvs[name] = path.join(staging_dir, path.basename(csv_files[name]))
+            staged_df.to_csv(staged_csvs[name])
+
+        _run_writer(_writer_args(
+            tile_width, tile_height, data_path, staging_dir, img_format, staged_csvs
+        ))
+
+        with open(path.join(output_folder, 'experiment.json')) as f:
+            images = json.load(f)['images']
+
+        # Map all images back before anything in output_folder is replaced
+        renamed = OrderedDict()
+        for name in staged_csvs:
+            with open(path.join(staging_dir, images[name])) as f:
+                staged_collection = json.load(f)
+            renamed[images[name]] = _rename_staged_fovs(staged_collection['contents'], staged_fovs[name])
+
+        if any(fov_files is None for fov_files in renamed.values()):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            _run_writer(_writer_args(
+                tile_width, tile_height, data_path, output_folder, img_format, csv_files
+            ))
+            return
+
+        for collection_file, fov_files in renamed.items():
+            with open(path.join(output_folder, collection_file)) as f:
+                collection = json.load(f)
+            for fov_name, (staged_file, fov_file) in fov_files.items():
+                shutil.move(path.join(staging_dir, staged_file), path.join(output_folder, fov_file))
+                collection['contents'][fov_name] = fov_file
+
+            collection['contents'] = OrderedDict(sorted(collection['contents'].items()))
+            _save_json(collection, path.join(output_folder, collection_file))
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+
+def _rename_staged_fovs(contents: Dict[str, str], fovs: Sequence[int]) -> Optional[Dict[str, tuple]]:
+    """
+    Maps the original name of each staged field of view to its staged file
+    and its file name in the experiment. Staged field of view i, e.g. fov_001
+    in primary-fov_001.json, is field of view fovs[i], e.g. fov_007 in
+    primary-fov_007.json. Returns None if the staged names aren't indexed
+    0, 1, ..., len(fovs) - 1 or the file names don't contain them.
+    """
+    fov_files = OrderedDict()
+    staged_indices = set()
+    for staged_name, staged_file in contents.items():
+        match = re.search(r'(\d+)(?!.*\d)', staged_name)
+        if match is None or staged_name not in staged_file:
+            return None
+        staged_index = int(match.group(1))
+        if staged_index >= len(fovs):
+            return None
+        staged_indices.add(staged_index)
+
+        fov_name = '{}{:0{}d}{}'.format(
+            staged_name[:match.start()], fovs[staged_index], len(match.group(1)),
+            staged_name[match.end():]
         )
+        fov_files[fov_name] = (staged_file, staged_file.replace(staged_name, fov_name))
+
+    if staged_indices != set(range(len(fovs))):
+        return None
+
+    return fov_files
+
+
+def _run_writer(args: List[str]):
+    """
+    Runs the spacetx writer in this process. If the writer's entry point
+    can't be found, it is run as a subprocess instead. In either case, a
+    non-zero exit status raises a subprocess.CalledProcessError.
+    """
+    writer = _load_writer()
+    cmd = [_WRITER_SCRIPT] + args
+
+    if writer is None:
+        subprocess.check_call(cmd)
+        return
+
+    try:
+        if hasattr(writer, 'main'):
+            # click command
+            writer.main(args=args, prog_name=_WRITER_SCRIPT, standalone_mode=False)
+        else:
+            # argparse style main() that reads sys.argv
+            argv = sys.argv
+            sys.argv = cmd
+            try:
+                writer()
+            finally:
+                sys.argv = argv
+    except SystemExit as e:
+        # e.g. an argparse error, which would otherwise exit the caller
+        if e.code not in (None, 0):
+            returncode = e.code if isinstance(e.code, int) else 1
+            raise subprocess.CalledProcessError(returncode, cmd) from e
+
+
+def _load_writer():
+    """
+    Returns the function behind the spacetx writer console script or None
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return None
 
-        csv_args += ' --csv-file nuclei ' + stain_file_path
+    eps = entry_points()
+    if hasattr(eps, 'select'):
+        scripts = eps.select(group='console_scripts', name=_WRITER_SCRIPT)
+    else:
+        scripts = [ep for ep in eps.get('console_scripts', []) if ep.name == _WRITER_SCRIPT]
 
-    cmd = 'spacetx_biohub_writer ' + '--tile-width ' + str(tile_width) + ' ' + \
-            '--tile-height ' + str(tile_height) + ' ' + \
-            '--s3-prefix ' + data_path + ' ' + \
-            '--output-dir ' + output_folder + ' ' + \
-            '--image_format ' + img_format  + ' ' + \
-            '--csv-file ' + csv_args 
-            
+    for ep in scripts:
+        return ep.load()
 
-    subprocess.call(cmd, shell=True)
+    return None
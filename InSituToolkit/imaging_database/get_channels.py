@@ -1,9 +1,10 @@
+from typing import Dict
 
-from imaging_db.database.db_operations import DatabaseOperations
 import imaging_db.database.db_operations as db_ops
-import imaging_db.utils.db_utils as db_utils
 
-def get_channels(db_credentials: str, dataset_id: str):
+from ._connection import session_scope
+
+def get_channels(db_credentials: str, dataset_id: str, limit: int = None, offset: int = 0):
     """
     Queries the database for a dataset id and returns a dict of channel assignments
 
@@ -13,18 +14,29 @@ def get_channels(db_credentials: str, dataset_id: str):
         Absolute url to location of .json credentials
     dataset_serial: str
         dataset_serial field of a dataset in the database
+    limit: int
+        Maximum number of channels to return. If None, all channels are returned.
+    offset: int
+        Number of channels to skip. The default value is 0.
 
     Returns
     -------
-    Dict of (channel_idx:channel_name) pairs
+    Dict of (channel_idx:channel_name) pairs in ascending channel_idx order
     """
-    dbops = DatabaseOperations(dataset_id)
-    credentials_str = db_utils.get_connection_str(db_credentials)
-    with db_ops.session_scope(credentials_str) as session:
-        _, frames_meta = dbops.get_frames_meta(session)
-
-    df = frames_meta[['channel_name', 'channel_idx']].drop_duplicates()
-    channels = {}
-    for idx, row in df.iterrows():
-        channels[row['channel_idx']] = row['channel_name']
+    with session_scope(db_credentials) as session:
+        channels = _query_channels(session, dataset_id, limit, offset)
+
     return channels
+
+
+def _query_channels(session, dataset_id: str, limit: int = None, offset: int = 0) -> Dict[int, str]:
+    query = session.query(db_ops.Frames.channel_idx, db_ops.Frames.channel_name) \
+        .join(db_ops.FramesGlobal) \
+        .join(db_ops.DataSet) \
+        .filter(db_ops.DataSet.dataset_serial == dataset_id) \
+        .distinct() \
+        .order_by(db_ops.Frames.channel_idx) \
+        .offset(offset) \
+        .limit(limit)
+
+    return {channel_idx: channel_name for channel_idx, channel_name in query}
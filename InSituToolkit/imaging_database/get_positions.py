@@ -1,8 +1,11 @@
+from typing import List
+
 import imaging_db.database.db_operations as db_ops
-import imaging_db.utils.db_utils as db_utils
+
+from ._connection import session_scope
 
 
-def get_positions(db_credentials: str, dataset_serial: str):
+def get_positions(db_credentials: str, dataset_serial: str, limit: int = None, offset: int = 0):
     """
     Queries the database for a given dataset serial number and returns list of available positions
 
@@ -12,19 +15,29 @@ def get_positions(db_credentials: str, dataset_serial: str):
         Absolute url to location of .json credentials
     dataset_serial: str
         dataset_serial field of a dataset in the database
+    limit: int
+        Maximum number of positions to return. If None, all positions are returned.
+    offset: int
+        Number of positions to skip. The default value is 0.
 
     Returns
     -------
-    List[int] of positions for a given experiment
+    List[int] of positions for a given experiment in ascending order
     """
-    credentials_str = db_utils.get_connection_str(db_credentials)
-
-    with db_ops.session_scope(credentials_str) as session:
-        frames = session.query(db_ops.Frames) \
-            .join(db_ops.FramesGlobal) \
-            .join(db_ops.DataSet) \
-            .filter(db_ops.DataSet.dataset_serial == dataset_serial)
-    positions = set()
-    for f in frames:
-        positions.add(f.pos_idx)
-    return list(positions)
\ No newline at end of file
+    with session_scope(db_credentials) as session:
+        positions = _query_positions(session, dataset_serial, limit, offset)
+
+    return positions
+
+
+def _query_positions(session, dataset_serial: str, limit: int = None, offset: int = 0) -> List[int]:
+    query = session.query(db_ops.Frames.pos_idx) \
+        .join(db_ops.FramesGlobal) \
+        .join(db_ops.DataSet) \
+        .filter(db_ops.DataSet.dataset_serial == dataset_serial) \
+        .distinct() \
+        .order_by(db_ops.Frames.pos_idx) \
+        .offset(offset) \
+        .limit(limit)
+
+    return [pos_idx for pos_idx, in query]
@@ -1,8 +1,11 @@
+from typing import List
+
 import imaging_db.database.db_operations as db_ops
-import imaging_db.utils.db_utils as db_utils
+
+from ._connection import session_scope
 
 
-def search_ids(db_credentials: str, string: str):
+def search_ids(db_credentials: str, string: str, limit: int = None, offset: int = 0):
     """
     Retrieves all the datasets in database whose id's contain a specified string
     Parameters
@@ -11,18 +14,30 @@ def search_ids(db_credentials: str, string: str):
         Absolute url to location of .json credentials
     string: str
         string to match to dataset id's
+    limit: int
+        Maximum number of ids to return. If None, all matching ids are returned.
+    offset: int
+        Number of matching ids to skip. The default value is 0.
 
     Returns
-    -------s
-    List[string] - list of dataset id's that contain the specified string
+    -------
+    List[string] - list of dataset id's that contain the specified string in
+    alphabetical order
     """
-    credentials_str = db_utils.get_connection_str(db_credentials)
-    with db_ops.session_scope(credentials_str) as session:
-        frames = session.query(db_ops.DataSet)
-
-    set_of_ids = list()
-    for f in frames:
-        name = f.dataset_serial
-        if string in name:
-            set_of_ids.append(name)
-    return list(set_of_ids)
\ No newline at end of file
+    with session_scope(db_credentials) as session:
+        ids = _query_ids(session, string, limit, offset)
+
+    return ids
+
+
+def _query_ids(session, string: str, limit: int = None, offset: int = 0) -> List[str]:
+    # Match the string literally
+    escaped = string.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+    query = session.query(db_ops.DataSet.dataset_serial) \
+        .filter(db_ops.DataSet.dataset_serial.like('%' + escaped + '%', escape='\\')) \
+        .order_by(db_ops.DataSet.dataset_serial) \
+        .offset(offset) \
+        .limit(limit)
+
+    return [dataset_serial for dataset_serial, in query]
@@ -0,0 +1,126 @@
+from typing import List
+
+from numcodecs import Blosc
+import zarr
+
+from ._image_database import ImageDatabase
+from ._storage import make_storage_factory
+from ._tile_cache import TileCache
+from ._tile_downloader import TileDownloader
+
+# Axis order of the arrays written by write_zarr
+ZARR_DIMS = ['fov', 'r', 'c', 'z', 'y', 'x']
+
+# Blosc compressors available for write_zarr
+_CODECS = ['blosclz', 'lz4', 'lz4hc', 'zlib', 'zstd']
+
+
+class _ChunkDest:
+    """
+    Destination for the TileDownloader that writes a tile to one chunk of a
+    zarr array
+    """
+    def __init__(self, array: zarr.Array, index: tuple):
+        self.array = array
+        self.index = index
+
+    def __setitem__(self, key, tile):
+        self.array[self.index] = tile
+
+
+def write_zarr(
+               db_credentials: str, output_path: str, image_ids: List[str], channels: List[str],
+               positions: List[int] = [0], time: int = 0, codec: str = 'zstd', clevel: int = 5,
+               n_workers: int = 8, max_retries: int = 3, timeout: float = 60,
+               data_path: str = None, cache: TileCache = None
+              ) -> zarr.Array:
+    """
+    Writes image stacks from the imaging database to a chunked, compressed
+    zarr array with order (fov, r, c, z, y, x). Each tile is one chunk, so
+    tiles are compressed and written in parallel and can be read back
+    individually.
+
+    Parameters
+    ----------
+    db_credentials : str
+        Path to the database credentials file
+    output_path : str
+        Path of the zarr store to create. An existing store is overwritten.
+    image_ids : List[str]
+        A list of the image ids in round order
+    channels : List[str]
+        A list of the channels in the index order.
+    positions : List[int]
+        Indices of the positions to write. Each position is a fov. The default value is [0].
+    time : int
+        Index of the time point to write. The default value is 0.
+    codec : str
+        Blosc compressor: 'blosclz', 'lz4', 'lz4hc', 'zlib' or 'zstd'. If None,
+        the chunks are not compressed. The default value is 'zstd'.
+    clevel : int
+        Compression level from 0 to 9. The default value is 5.
+    n_workers : int
+        Number of tiles downloaded and written concurrently. The default value is 8.
+    max_retries : int
+        Number of times a failed tile download is retried. The default value is 3.
+    timeout : float
+        Timeout in seconds for each tile request. The default value is 60.
+    data_path : str
+        Path to a mounted image store volume. If set, the tiles are read from
+        the volume instead of S3.
+    cache : TileCache
+        Local tile cache to read tiles from and add downloaded tiles to.
+        The default is no cache.
+
+    Returns
+    -------
+    array : zarr.Array
+    """
+    if codec is None:
+        compressor = None
+    elif codec in _CODECS:
+        compressor = Blosc(cname=codec, clevel=clevel, shuffle=Blosc.BITSHUFFLE)
+    else:
+        raise ValueError('codec must be one of {} or None'.format(_CODECS))
+
+    db = ImageDatabase(db_credentials)
+    plan = db.getFramePlan(image_ids, channels, positions=positions, times=[time])
+    for pos in positions:
+        plan.check_complete(pos, time)
+
+    n_slices = max(max(plan.round_slices(pos, time)) for pos in positions)
+    tile_shape = plan.tile_shape(positions[0], time)
+
+    array = zarr.open(
+        output_path,
+        mode='w',
+        shape=(len(positions), len(image_ids), len(channels), n_slices) + tile_shape,
+        chunks=(1, 1, 1, 1) + tile_shape,
+        dtype=plan.dtype(positions[0], time),
+        compressor=compressor,
+        fill_value=0
+    )
+    array.attrs.update({
+        'dims': ZARR_DIMS,
+        'image_ids': list(image_ids),
+        'channels': list(channels),
+        'positions': list(positions),
+        'time': time
+    })
+
+    downloader = TileDownloader(
+        n_workers=n_workers,
+        max_retries=max_retries,
+        timeout=timeout,
+        storage_factory=make_storage_factory(data_path, timeout),
+        cache=cache
+    )
+    # Slices missing from a round are left as the fill value
+    tiles = (
+        (_ChunkDest(array, (fov, r, c, z)), frame.s3_dir, frame.file_name, frame.sha256)
+        for fov, pos in enumerate(positions)
+        for r, c, z, frame in plan.tiles(pos, time)
+    )
+    downloader.download(tiles)
+
+    return array
@@ -0,0 +1,231 @@
+"""
+Opt-in instrumentation of the imaging_database and analysis hot paths.
+
+Nothing is recorded unless a call runs inside ``instrument()``:
+
+    with instrument(trace_file='trace.json') as report:
+        get_image_stack(db_credentials, image_ids, channels)
+    print(report.summary())
+
+The stages (e.g., the frame query, the tile downloads and the checksums) are
+recorded with their wall time and thread, along with counters of the SQL
+statements, the tiles and the bytes downloaded and read. The trace file is in
+the Chrome trace event format and can be loaded in chrome://tracing or
+Perfetto.
+
+The report is process-wide: while a block is open, the stages, counters and
+SQL statements of every thread are recorded, including those of work the
+block didn't start (e.g. another thread's AsyncImageDatabase calls). The
+toolkit runs its tile downloads and checksums on pool threads, which is why
+the report isn't scoped to the thread that opened the block. Only one block
+can be open at a time, and work done in other processes, e.g. the workers of
+run_pipeline, is not recorded.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+import json
+import os
+import threading
+import time
+from typing import Dict, List, NamedTuple
+
+import sqlalchemy as sa
+
+# Names of the counters recorded by the toolkit
+SQL_STATEMENTS = 'sql_statements'
+TILES_DOWNLOADED = 'tiles_downloaded'
+TILES_CACHED = 'tiles_cached'
+BYTES_DOWNLOADED = 'bytes_downloaded'
+BYTES_READ = 'bytes_read'
+BYTES_WRITTEN = 'bytes_written'
+BYTES_HASHED = 'bytes_hashed'
+
+# Report of the active instrument() block
+_active = None
+_active_lock = threading.Lock()
+
+_NULL_STAGE = nullcontext()
+
+
+class StageEvent(NamedTuple):
+    name: str
+    start: float
+    duration: float
+    thread_id: int
+
+
+class InstrumentationReport:
+    """
+    Stages and counters recorded in an instrument() block. Stages and counters
+    can be recorded from several threads.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.end = None
+        self.stages: List[StageEvent] = []
+        self.counters: Dict[str, int] = OrderedDict()
+
+        self._lock = threading.Lock()
+
+    def add_stage(self, name: str, start: float, duration: float):
+        event = StageEvent(name, start, duration, threading.get_ident())
+        with self._lock:
+            self.stages.append(event)
+
+    def add_count(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    @property
+    def wall_time(self) -> float:
+        end = self.end if self.end is not None else time.perf_counter()
+
+        return end - self.start
+
+    def stage_totals(self) -> Dict[str, Dict[str, float]]:
+        """
+        Returns the number of calls and the total time of each stage. Stages
+        run in parallel threads add up, so the total can exceed the wall time.
+        """
+        totals = OrderedDict()
+        for event in self.stages:
+            total = totals.setdefault(event.name, {'calls': 0, 'time_s': 0.0})
+            total['calls'] += 1
+            total['time_s'] += event.duration
+
+        return totals
+
+    def to_dict(self) -> dict:
+        """
+        Returns the wall time, the stage totals and the counters
+        """
+        return {
+            'wall_time_s': self.wall_time,
+            'stages': self.stage_totals(),
+            'counters': dict(self.counters),
+        }
+
+    def summary(self) -> str:
+        """
+        Returns a table of the stage totals and the counters
+        """
+        lines = [
+            '{:<30} {:>6d} x {:>8.2f} s'.format(name, total['calls'], total['time_s'])
+            for name, total in self.stage_totals().items()
+        ]
+        lines.append('{:<30} {:>17.2f} s'.format('wall time', self.wall_time))
+        lines += ['{:<30} {:>19d}'.format(name, value) for name, value in self.counters.items()]
+
+        return '\n'.join(lines)
+
+    def write_chrome_trace(self, file_name: str):
+        """
+        Writes the stages as complete events and the counters as counter
+        events in the Chrome trace event format
+        """
+        pid = os.getpid()
+        to_us = lambda t: (t - self.start) * 1e6
+
+        events = [
+            {
+                'name': event.name,
+                'cat': 'InSituToolkit',
+                'ph': 'X',
+                'ts': to_us(event.start),
+                'dur': event.duration * 1e6,
+                'pid': pid,
+                'tid': event.thread_id,
+            }
+            for event in self.stages
+        ]
+        events += [
+            {
+                'name': name,
+                'ph': 'C',
+                'ts': to_us(self.end if self.end is not None else time.perf_counter()),
+                'pid': pid,
+                'args': {name: value},
+            }
+            for name, value in self.counters.items()
+        ]
+
+        with open(file_name, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def _count_sql_statement(conn, cursor, statement, parameters, context, executemany):
+    count(SQL_STATEMENTS)
+
+
+@contextmanager
+def instrument(trace_file: str = None):
+    """
+    Records the stages and counters of the toolkit calls made while the block
+    is open, in any thread of the process. Blocks can't be nested or opened
+    from two threads at once.
+
+    Parameters
+    ----------
+    trace_file : str
+        Path of a Chrome trace file written when the block exits. If None, no
+        trace file is written.
+
+    Yields
+    ------
+    report : InstrumentationReport
+
+    Raises
+    ------
+    RuntimeError
+        If another instrument() block is open
+    """
+    global _active
+
+    report = InstrumentationReport()
+    with _active_lock:
+        if _active is not None:
+            raise RuntimeError('instrument() blocks cannot be nested')
+        _active = report
+    sa.event.listen(sa.engine.Engine, 'before_cursor_execute', _count_sql_statement)
+
+    try:
+        yield report
+    finally:
+        sa.event.remove(sa.engine.Engine, 'before_cursor_execute', _count_sql_statement)
+        with _active_lock:
+            _active = None
+        report.end = time.perf_counter()
+
+        if trace_file is not None:
+            report.write_chrome_trace(trace_file)
+
+
+@contextmanager
+def _record_stage(report: InstrumentationReport, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add_stage(name, start, time.perf_counter() - start)
+
+
+def stage(name: str):
+    """
+    Returns a context manager recording the wall time of a stage. It does
+    nothing outside of an instrument() block.
+    """
+    report = _active
+    if report is None:
+        return _NULL_STAGE
+
+    return _record_stage(report, name)
+
+
+def count(name: str, value: int = 1):
+    """
+    Adds a value to a counter. It does nothing outside of an instrument()
+    block.
+    """
+    report = _active
+    if report is not None:
+        report.add_count(name, value)
@@ -0,0 +1,157 @@
+"""
+Synthetic imagingDB fixtures for the benchmarks
+"""
+import hashlib
+import os
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import sessionmaker
+from skimage import io
+import imaging_db.database.db_operations as db_ops
+
+
+@compiles(JSONB, 'sqlite')
+def _compile_jsonb_sqlite(type_, compiler, **kw):
+    # Store the postgres JSONB columns as JSON in SQLite
+    return 'JSON'
+
+
+def _foreign_key(table, parent):
+    return [fk.parent.name for fk in table.foreign_keys if fk.column.table is parent.__table__][0]
+
+
+def _insert(connection, table, rows):
+    # Only keep the columns the installed imagingDB schema has
+    columns = set(table.c.keys())
+    rows = [{k: v for k, v in row.items() if k in columns} for row in rows]
+    if len(rows) > 0:
+        connection.execute(table.insert(), rows)
+
+
+def dataset_serial(idx: int) -> str:
+    return 'ISP-2019-08-28-14-30-00-{:04d}'.format(idx)
+
+
+def make_sqlite_db(
+                   db_path: str, n_datasets: int = 10, channels=('Cy5', 'Cy3', 'FITC', 'DAPI'),
+                   n_positions: int = 10, n_slices: int = 11, n_times: int = 1,
+                   tile_shape=(2048, 2048), bit_depth: str = 'uint16'
+                  ) -> str:
+    """
+    Creates a SQLite imagingDB with n_datasets datasets of
+    channels x positions x slices x times frames each.
+
+    Returns
+    -------
+    url : str
+        SQLAlchemy URL of the database
+    """
+    url = 'sqlite:///' + db_path
+    engine = sa.create_engine(url)
+    db_ops.Base.metadata.create_all(engine)
+
+    dataset_table = db_ops.DataSet.__table__
+    frames_global_table = db_ops.FramesGlobal.__table__
+    frames_table = db_ops.Frames.__table__
+    dataset_fk = _foreign_key(frames_global_table, db_ops.DataSet)
+    frames_global_fk = _foreign_key(frames_table, db_ops.FramesGlobal)
+
+    n_frames = len(channels) * n_positions * n_slices * n_times
+
+    with engine.begin() as connection:
+        for d in range(n_datasets):
+            serial = dataset_serial(d)
+            s3_dir = 'raw_frames/' + serial
+            dataset_id = d + 1
+
+            _insert(connection, dataset_table, [{
+                'id': dataset_id,
+                'dataset_serial': serial,
+                'description': 'synthetic',
+                'frames': True,
+                'microscope': 'synthetic',
+            }])
+            _insert(connection, frames_global_table, [{
+                'id': dataset_id,
+                dataset_fk: dataset_id,
+                's3_dir': s3_dir,
+                'storage_dir': s3_dir,
+                'nbr_frames': n_frames,
+                'im_width': tile_shape[1],
+                'im_height': tile_shape[0],
+                'nbr_slices': n_slices,
+                'nbr_channels': len(channels),
+                'im_colors': 1,
+                'nbr_timepoints': n_times,
+                'nbr_positions': n_positions,
+                'bit_depth': bit_depth,
+                'metadata_json': {'IJMetadata': {}},
+            }])
+
+            frames = []
+            for c, chan in enumerate(channels):
+                for p in range(n_positions):
+                    for t in range(n_times):
+                        for z in range(n_slices):
+                            frames.append({
+                                frames_global_fk: dataset_id,
+                                'channel_idx': c,
+                                'channel_name': chan,
+                                'slice_idx': z,
+                                'time_idx': t,
+                                'pos_idx': p,
+                                'file_name': frame_file_name(c, z, t, p),
+                                'sha256': hashlib.sha256(
+                                    (s3_dir + frame_file_name(c, z, t, p)).encode()
+                                ).hexdigest(),
+                                'metadata_json': {
+                                    'MicroManagerMetadata': {
+                                        'PixelSizeUm': 0.325,
+                                        'XPositionUm': 1000.0 * p,
+                                        'YPositionUm': 500.0,
+                                        'ZPositionUm': 1.0 * z
+                                    }
+                                },
+                            })
+            _insert(connection, frames_table, frames)
+
+    return url
+
+
+def frame_file_name(c: int, z: int, t: int, p: int) -> str:
+    return 'im_c{:03d}_z{:03d}_t{:03d}_p{:03d}.png'.format(c, z, t, p)
+
+
+def write_frames(
+                 data_path: str, n_datasets: int = 10, n_channels: int = 4,
+                 n_positions: int = 10, n_slices: int = 11, n_times: int = 1,
+                 tile_shape=(2048, 2048), bit_depth: str = 'uint16', seed: int = 0
+                ):
+    """
+    Writes the frames of the datasets created by make_sqlite_db as PNG files
+    under data_path, laid out like the mounted image store, so they can be
+    read with data_path instead of S3.
+    """
+    rng = np.random.RandomState(seed)
+    max_value = np.iinfo(bit_depth).max
+
+    for d in range(n_datasets):
+        frame_dir = os.path.join(data_path, 'raw_frames', dataset_serial(d))
+        os.makedirs(frame_dir, exist_ok=True)
+        for c in range(n_channels):
+            for p in range(n_positions):
+                for t in range(n_times):
+                    for z in range(n_slices):
+                        tile = rng.randint(0, max_value // 16, size=tile_shape).astype(bit_depth)
+                        io.imsave(
+                            os.path.join(frame_dir, frame_file_name(c, z, t, p)),
+                            tile,
+                            check_contrast=False
+                        )
+
+
+def make_session(url: str):
+    return sessionmaker(bind=sa.create_engine(url))()
@@ -0,0 +1,129 @@
+"""
+Compares the peak memory and wall time of assembling a (r, c, z, y, x) stack
+with ImageDatabase.getStack on a generated SQLite imagingDB:
+
+- legacy: the previous getStack layout (download into an (x, y, colors, z)
+  stack, reorder slice by slice, then copy into the output)
+- getStack: getStack returns a new stack, which is copied into the output
+- getStack_out: getStack decodes the tiles directly into im_stack[r, c]
+
+The tiles come from a storage that returns an in-memory tile, so only the
+assembly of the stack is measured. Each variant runs in its own process so
+the peak RSS is not shared.
+
+    python benchmarks/bench_get_stack.py --rounds 2 --channels 4 --slices 11
+"""
+import argparse
+from multiprocessing import Pool
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+
+from _fixtures import dataset_serial, make_sqlite_db
+from InSituToolkit.imaging_database._image_database import ImageDatabase
+
+CHANNELS = ('Cy5', 'Cy3', 'FITC', 'DAPI', 'TRITC', 'BF')
+
+
+class _SyntheticStorage:
+    """
+    Storage returning a freshly decoded tile for every request
+    """
+    def __init__(self, tile_shape, dtype):
+        self._tile = np.random.randint(0, 1000, size=tile_shape).astype(dtype)
+
+    def get_im(self, file_name):
+        return self._tile.copy()
+
+
+def _legacy(db_url, n_rounds, n_channels, n_slices, tile_shape, dtype):
+    storage = _SyntheticStorage(tile_shape, dtype)
+    im_stack = np.zeros((n_rounds, n_channels, n_slices) + tile_shape, dtype=dtype)
+
+    for r in range(n_rounds):
+        for c in range(n_channels):
+            # s3_storage.DataStorage.get_stack layout
+            downloaded = np.zeros((tile_shape[1], tile_shape[0], 1, n_slices), dtype=dtype)
+            for z in range(n_slices):
+                downloaded[:, :, 0, z] = storage.get_im(str(z))
+
+            im_ordered = np.zeros((1, 1, n_slices) + tile_shape, dtype=dtype)
+            for z in range(n_slices):
+                im_ordered[0, 0, z, :, :] = downloaded[:, :, 0, z]
+
+            im_stack[r, c, ...] = im_ordered
+
+    return im_stack
+
+
+def _get_stack(db_url, n_rounds, n_channels, n_slices, tile_shape, dtype, use_out=False):
+    storage = _SyntheticStorage(tile_shape, dtype)
+    db = ImageDatabase(db_url)
+    im_stack = np.empty((n_rounds, n_channels, n_slices) + tile_shape, dtype=dtype)
+
+    for r in range(n_rounds):
+        for c in range(n_channels):
+            if use_out:
+                db.getStack(
+                    dataset_serial(r), CHANNELS[c], out=im_stack[r, c],
+                    storage_factory=lambda s3_dir: storage
+                )
+            else:
+                im_stack[r, c] = db.getStack(
+                    dataset_serial(r), CHANNELS[c], storage_factory=lambda s3_dir: storage
+                )[0, 0]
+
+    return im_stack
+
+
+def _get_stack_out(*args):
+    return _get_stack(*args, use_out=True)
+
+
+def _run(args):
+    name, db_url, n_rounds, n_channels, n_slices, tile_shape, dtype = args
+    func = {'legacy': _legacy, 'getStack': _get_stack, 'getStack_out': _get_stack_out}[name]
+
+    start = time.perf_counter()
+    func(db_url, n_rounds, n_channels, n_slices, tile_shape, dtype)
+    wall_time = time.perf_counter() - start
+
+    # ru_maxrss is in kB on linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return name, wall_time, peak_rss_mb
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=11)
+    parser.add_argument('--tile-size', type=int, default=2048)
+    args = parser.parse_args()
+
+    tile_shape = (args.tile_size, args.tile_size)
+    output_mb = args.rounds * args.channels * args.slices * args.tile_size ** 2 * 2 / 1024 ** 2
+    print('Output stack: {:.0f} MB'.format(output_mb))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_url = make_sqlite_db(
+            os.path.join(tmp_dir, 'imaging_db.sqlite'), n_datasets=args.rounds,
+            channels=CHANNELS[:args.channels], n_positions=1, n_slices=args.slices,
+            tile_shape=tile_shape
+        )
+
+        for name in ['legacy', 'getStack', 'getStack_out']:
+            # A fresh process per variant so the peak RSS is not carried over
+            with Pool(1) as pool:
+                _, wall_time, peak_rss_mb = pool.apply(
+                    _run, ((name, db_url, args.rounds, args.channels, args.slices, tile_shape, 'uint16'),)
+                )
+            print('{:>12}: {:7.2f} s, peak RSS {:7.0f} MB'.format(name, wall_time, peak_rss_mb))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Compares the quick lookup queries (get_positions, get_channels, search_ids)
+against the previous implementations, which loaded every row through the ORM
+and filtered in Python, on a generated SQLite imagingDB.
+
+    python benchmarks/bench_lookups.py --datasets 200 --positions 50
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import imaging_db.database.db_operations as db_ops
+
+from InSituToolkit.imaging_database.get_channels import _query_channels
+from InSituToolkit.imaging_database.get_positions import _query_positions
+from InSituToolkit.imaging_database.search_ids import _query_ids
+
+from _fixtures import dataset_serial, make_session, make_sqlite_db
+
+
+def _legacy_positions(session, serial):
+    frames = session.query(db_ops.Frames) \
+        .join(db_ops.FramesGlobal) \
+        .join(db_ops.DataSet) \
+        .filter(db_ops.DataSet.dataset_serial == serial)
+    return list({f.pos_idx for f in frames})
+
+
+def _legacy_channels(session, serial):
+    frames = session.query(db_ops.Frames) \
+        .join(db_ops.FramesGlobal) \
+        .join(db_ops.DataSet) \
+        .filter(db_ops.DataSet.dataset_serial == serial)
+    return {f.channel_idx: f.channel_name for f in frames}
+
+
+def _legacy_ids(session, string):
+    return [d.dataset_serial for d in session.query(db_ops.DataSet) if string in d.dataset_serial]
+
+
+def _time(func, *args, repeat=3):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', type=int, default=200)
+    parser.add_argument('--positions', type=int, default=20)
+    parser.add_argument('--slices', type=int, default=11)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        url = make_sqlite_db(
+            os.path.join(tmp_dir, 'imaging_db.sqlite'), n_datasets=args.datasets,
+            n_positions=args.positions, n_slices=args.slices
+        )
+        session = make_session(url)
+        n_frames = session.query(db_ops.Frames).count()
+        print('{} datasets, {} frames'.format(args.datasets, n_frames))
+
+        serial = dataset_serial(args.datasets // 2)
+        cases = [
+            ('get_positions', _legacy_positions, _query_positions, serial),
+            ('get_channels', _legacy_channels, _query_channels, serial),
+            ('search_ids', _legacy_ids, _query_ids, '-00-01'),
+        ]
+        for name, legacy, current, arg in cases:
+            legacy_time = _time(legacy, session, arg)
+            current_time = _time(current, session, arg)
+            print('{:>14}: legacy {:8.4f} s, current {:8.4f} s'.format(name, legacy_time, current_time))
+
+        session.close()
+
+
+if __name__ == '__main__':
+    main()
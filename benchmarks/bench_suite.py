@@ -0,0 +1,362 @@
+"""
+Benchmarks the public entry points on a generated SQLite imagingDB with the
+frames written to a local folder. Most cases read the folder through
+data_path. The *_s3 cases go through the S3 code path with the imagingDB
+DataStorage replaced by a fake that reads the folder after a fixed latency
+per request (--s3-latency), which models the round trip to S3.
+
+For each entry point, the best wall time of --repeat runs, the tile and byte
+throughput, the number of SQL statements of one run and the peak traced
+memory of one run are reported. The results are written as JSON with the
+configuration and git commit, and can be compared to an earlier run.
+
+    python benchmarks/bench_suite.py --rounds 2 --channels 4 --slices 11 --output head.json
+    python benchmarks/bench_suite.py --compare head.json
+"""
+import argparse
+from collections import OrderedDict
+from contextlib import contextmanager
+import importlib
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from unittest import mock
+
+import numpy as np
+from skimage import io
+import sqlalchemy as sa
+
+from _fixtures import dataset_serial, frame_file_name, make_sqlite_db, write_frames
+
+CHANNELS = ('Cy5', 'Cy3', 'FITC', 'DAPI', 'TRITC', 'BF')
+
+
+class _QueryCounter:
+    """
+    Counts the SQL statements executed by all engines
+    """
+    def __init__(self):
+        self.count = 0
+        sa.event.listen(sa.engine.Engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+class _Fixture:
+    """
+    Synthetic imagingDB and image store shared by the benchmark cases
+    """
+    def __init__(self, tmp_dir, args):
+        self.tmp_dir = tmp_dir
+        self.channels = list(CHANNELS[:args.channels])
+        self.image_ids = [dataset_serial(r) for r in range(args.rounds)]
+        self.n_positions = args.positions
+        self.n_slices = args.slices
+        self.tile_shape = (args.tile_size, args.tile_size)
+        self.n_workers = args.workers
+        self.s3_latency = args.s3_latency
+
+        self.db_url = make_sqlite_db(
+            os.path.join(tmp_dir, 'imaging_db.sqlite'), n_datasets=args.rounds,
+            channels=self.channels, n_positions=args.positions, n_slices=args.slices,
+            tile_shape=self.tile_shape
+        )
+        self.data_path = os.path.join(tmp_dir, 'image_store')
+        write_frames(
+            self.data_path, n_datasets=args.rounds, n_channels=args.channels,
+            n_positions=args.positions, n_slices=args.slices, tile_shape=self.tile_shape
+        )
+
+    @property
+    def fov_tiles(self) -> int:
+        return len(self.image_ids) * len(self.channels) * self.n_slices
+
+    @property
+    def tile_bytes(self) -> int:
+        return self.tile_shape[0] * self.tile_shape[1] * 2
+
+
+class _FakeDataStorage:
+    """
+    Stands in for the imagingDB S3 DataStorage. Frames are read from the
+    fixture folder after a fixed latency per request.
+    """
+    def __init__(self, data_path, latency, s3_dir, **kwargs):
+        self.data_path = data_path
+        self.latency = latency
+        self.s3_dir = s3_dir
+
+    def get_im(self, file_name):
+        time.sleep(self.latency)
+        return io.imread(os.path.join(self.data_path, self.s3_dir, file_name))
+
+
+@contextmanager
+def _fake_s3(fx):
+    from InSituToolkit.imaging_database import _storage
+
+    def data_storage(s3_dir, **kwargs):
+        return _FakeDataStorage(fx.data_path, fx.s3_latency, s3_dir, **kwargs)
+
+    with mock.patch.object(_storage.s3_storage, 'DataStorage', data_storage):
+        yield
+
+
+def _bench_get_numpy_stack(fx):
+    from InSituToolkit.imaging_database import get_numpy_stack
+
+    stack = get_numpy_stack(
+        fx.db_url, fx.image_ids, fx.channels, pos=0, n_workers=fx.n_workers,
+        data_path=fx.data_path
+    )
+    return fx.fov_tiles, stack.nbytes
+
+
+def _bench_get_numpy_stack_s3(fx):
+    from InSituToolkit.imaging_database import get_numpy_stack
+
+    with _fake_s3(fx):
+        stack = get_numpy_stack(fx.db_url, fx.image_ids, fx.channels, pos=0, n_workers=fx.n_workers)
+    return fx.fov_tiles, stack.nbytes
+
+
+def _bench_get_numpy_stack_roi(fx):
+    from InSituToolkit.imaging_database import get_numpy_stack
+
+    # A quarter of each tile, downsampled by 2
+    n_y, n_x = fx.tile_shape
+    stack = get_numpy_stack(
+        fx.db_url, fx.image_ids, fx.channels, pos=0, n_workers=fx.n_workers,
+        data_path=fx.data_path, y=slice(n_y // 4, 3 * n_y // 4),
+        x=slice(n_x // 4, 3 * n_x // 4), stride=2
+    )
+    return fx.fov_tiles, stack.nbytes
+
+
+def _bench_get_fovs(fx):
+    from InSituToolkit.imaging_database import get_fovs
+
+    n_bytes = 0
+    for _, _, stack in get_fovs(
+                                fx.db_url, fx.image_ids, fx.channels,
+                                positions=list(range(fx.n_positions)),
+                                n_workers=fx.n_workers, data_path=fx.data_path
+                               ):
+        n_bytes += stack.nbytes
+    return fx.fov_tiles * fx.n_positions, n_bytes
+
+
+def _bench_get_fovs_s3(fx):
+    from InSituToolkit.imaging_database import get_fovs
+
+    n_bytes = 0
+    with _fake_s3(fx):
+        for _, _, stack in get_fovs(
+                                    fx.db_url, fx.image_ids, fx.channels,
+                                    positions=list(range(fx.n_positions)), n_workers=fx.n_workers
+                                   ):
+            n_bytes += stack.nbytes
+    return fx.fov_tiles * fx.n_positions, n_bytes
+
+
+def _bench_get_dask_stack_max_proj(fx):
+    from InSituToolkit.imaging_database import get_dask_stack
+
+    stack = get_dask_stack(fx.db_url, fx.image_ids, fx.channels, pos=0, data_path=fx.data_path)
+    stack.max(axis=2).compute(num_workers=fx.n_workers)
+    return fx.fov_tiles, fx.fov_tiles * fx.tile_bytes
+
+
+def _bench_write_zarr(fx):
+    from InSituToolkit.imaging_database import write_zarr
+
+    write_zarr(
+        fx.db_url, os.path.join(fx.tmp_dir, 'stack.zarr'), fx.image_ids, fx.channels,
+        positions=list(range(fx.n_positions)), n_workers=fx.n_workers, data_path=fx.data_path
+    )
+    n_tiles = fx.fov_tiles * fx.n_positions
+    return n_tiles, n_tiles * fx.tile_bytes
+
+
+def _bench_make_experiment_csv(fx):
+    from InSituToolkit.imaging_database._make_experiment_csv import make_experiment_csv
+
+    # No checksum index, so every file is hashed
+    make_experiment_csv(
+        fx.db_url, os.path.join(fx.tmp_dir, 'primary.csv'), fx.image_ids, fx.channels,
+        positions=list(range(fx.n_positions)), data_path=fx.data_path, n_workers=fx.n_workers
+    )
+    return _frame_files(fx)
+
+
+def _bench_calc_checksums(fx):
+    from InSituToolkit.imaging_database._make_experiment_csv import _calc_checksums
+
+    file_names = [
+        os.path.join('raw_frames', serial, frame_file_name(c, z, 0, p))
+        for serial in fx.image_ids
+        for c in range(len(fx.channels))
+        for p in range(fx.n_positions)
+        for z in range(fx.n_slices)
+    ]
+    _calc_checksums(file_names, fx.data_path, n_workers=fx.n_workers)
+    return _frame_files(fx)
+
+
+def _bench_viewer_sidecar_load(fx):
+    from InSituToolkit.analysis._sidecar import open_sidecar, read_fov, write_fov
+    from InSituToolkit.analysis.pyramid import image_pyramid, label_pyramid
+
+    path = os.path.join(fx.tmp_dir, 'results.zarr')
+    if not os.path.exists(path):
+        rng = np.random.RandomState(0)
+        im_max_proj = rng.rand(len(fx.channels), *fx.tile_shape).astype(np.float32)
+        mask = rng.randint(0, 100, size=fx.tile_shape).astype(np.int32)
+        points = [
+            {'coords': rng.rand(1000, 3) * fx.tile_shape[0], 'name': channel}
+            for channel in fx.channels
+        ]
+        write_fov(open_sidecar(path, mode='w'), 'fov_000', image_pyramid(im_max_proj), points, label_pyramid(mask))
+
+    pyramid, _, mask_pyramid = read_fov(open_sidecar(path), 'fov_000')
+    # Read the full resolution levels like the first render of a field of view
+    image = pyramid[0][...]
+    mask = mask_pyramid[0][...]
+    return len(fx.channels), image.nbytes + mask.nbytes
+
+
+def _frame_files(fx):
+    frame_dir = os.path.join(fx.data_path, 'raw_frames')
+    sizes = [
+        entry.stat().st_size
+        for serial in fx.image_ids
+        for entry in os.scandir(os.path.join(frame_dir, serial))
+    ]
+    return len(sizes), sum(sizes)
+
+
+_DB = 'InSituToolkit.imaging_database'
+
+# Module imported by each case and the case
+CASES = OrderedDict([
+    ('get_numpy_stack', (_DB, _bench_get_numpy_stack)),
+    ('get_numpy_stack_s3', (_DB, _bench_get_numpy_stack_s3)),
+    ('get_numpy_stack_roi', (_DB, _bench_get_numpy_stack_roi)),
+    ('get_fovs', (_DB, _bench_get_fovs)),
+    ('get_fovs_s3', (_DB, _bench_get_fovs_s3)),
+    ('get_dask_stack_max_proj', (_DB, _bench_get_dask_stack_max_proj)),
+    ('write_zarr', (_DB, _bench_write_zarr)),
+    ('make_experiment_csv', (_DB, _bench_make_experiment_csv)),
+    ('calc_checksums', (_DB, _bench_calc_checksums)),
+    ('viewer_sidecar_load', ('InSituToolkit.analysis', _bench_viewer_sidecar_load)),
+])
+
+
+def _run_case(func, fx, counter, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        n_tiles, n_bytes = func(fx)
+        best = min(best, time.perf_counter() - start)
+
+    # The statements and memory are measured in a separate run, since
+    # tracing slows down the run
+    counter.count = 0
+    tracemalloc.start()
+    func(fx)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return OrderedDict([
+        ('time_s', best),
+        ('n_tiles', n_tiles),
+        ('mb', n_bytes / 1024 ** 2),
+        ('tiles_per_s', n_tiles / best),
+        ('mb_per_s', n_bytes / 1024 ** 2 / best),
+        ('n_queries', counter.count),
+        ('peak_mb', peak / 1024 ** 2),
+    ])
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_results(results, baseline=None):
+    for name, result in results.items():
+        if 'error' in result:
+            print('{:>24}: skipped ({})'.format(name, result['error']))
+            continue
+        line = '{:>24}: {:8.3f} s {:9.1f} tiles/s {:8.1f} MB/s {:4d} queries {:8.1f} MB peak'.format(
+            name, result['time_s'], result['tiles_per_s'], result['mb_per_s'],
+            result['n_queries'], result['peak_mb']
+        )
+        if baseline is not None and 'time_s' in baseline.get(name, {}):
+            line += '  ({:.2f}x baseline time)'.format(result['time_s'] / baseline[name]['time_s'])
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rounds', type=int, default=2)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--positions', type=int, default=4)
+    parser.add_argument('--slices', type=int, default=11)
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--s3-latency', type=float, default=0.02, help='Latency in seconds of each fake S3 request')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--output', type=str, default=None, help='Path of the JSON results')
+    parser.add_argument('--compare', type=str, default=None, help='JSON results to compare to')
+    args = parser.parse_args()
+
+    if args.channels > len(CHANNELS):
+        parser.error('At most {} channels are supported'.format(len(CHANNELS)))
+
+    counter = _QueryCounter()
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fx = _Fixture(tmp_dir, args)
+        for name in args.cases:
+            module, func = CASES[name]
+            try:
+                # Imported before the timed runs. A case whose dependencies
+                # are missing (e.g. the analysis package without starfish or
+                # napari) is skipped.
+                importlib.import_module(module)
+                results[name] = _run_case(func, fx, counter, args.repeat)
+            except ImportError as e:
+                results[name] = {'error': repr(e)}
+
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    _print_results(results, baseline)
+
+    if args.output is not None:
+        report = OrderedDict([
+            ('commit', _git_commit()),
+            ('python', platform.python_version()),
+            ('config', vars(args)),
+            ('results', results),
+        ])
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from skimage import io
+
+# The synthetic imagingDB of the benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+CHANNELS = ['Cy5', 'Cy3', 'FITC']
+
+
+@pytest.fixture(scope='session')
+def image_store(tmp_path_factory):
+    """
+    SQLite imagingDB with its frames written to a local image store. The
+    tiles aren't square, so swapped y and x axes are caught.
+    """
+    pytest.importorskip('imaging_db')
+    from _fixtures import dataset_serial, frame_file_name, make_sqlite_db, write_frames
+
+    tmp_dir = str(tmp_path_factory.mktemp('image_store'))
+    n_rounds, n_positions, n_slices, tile_shape = 2, 2, 3, (24, 40)
+
+    db_url = make_sqlite_db(
+        os.path.join(tmp_dir, 'imaging_db.sqlite'), n_datasets=n_rounds, channels=CHANNELS,
+        n_positions=n_positions, n_slices=n_slices, tile_shape=tile_shape
+    )
+    data_path = os.path.join(tmp_dir, 'data')
+    write_frames(
+        data_path, n_datasets=n_rounds, n_channels=len(CHANNELS), n_positions=n_positions,
+        n_slices=n_slices, tile_shape=tile_shape
+    )
+    image_ids = [dataset_serial(r) for r in range(n_rounds)]
+
+    def frame_path(r, c, z, pos=0, time=0):
+        return os.path.join(data_path, 'raw_frames', image_ids[r], frame_file_name(c, z, time, pos))
+
+    def expected(pos=0, time=0):
+        # Serial baseline read straight from the frame files
+        return np.array([
+            [
+                [io.imread(frame_path(r, c, z, pos, time)) for z in range(n_slices)]
+                for c in range(len(CHANNELS))
+            ]
+            for r in range(n_rounds)
+        ])
+
+    return SimpleNamespace(
+        db_url=db_url, data_path=data_path, image_ids=image_ids, channels=list(CHANNELS),
+        n_positions=n_positions, n_slices=n_slices, tile_shape=tile_shape,
+        frame_path=frame_path, expected=expected
+    )
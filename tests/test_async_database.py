@@ -0,0 +1,58 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import AsyncImageDatabase, get_numpy_stack
+
+
+def _run(image_store, coroutine_func, **kwargs):
+    async def main():
+        async with AsyncImageDatabase(image_store.db_url, data_path=image_store.data_path, **kwargs) as db:
+            return await coroutine_func(db)
+
+    return asyncio.run(main())
+
+
+def test_get_stack_matches_numpy_stack(image_store):
+    async def get_stacks(db):
+        return await asyncio.gather(*[
+            db.get_stack(image_store.image_ids, image_store.channels, pos=pos)
+            for pos in range(image_store.n_positions)
+        ])
+
+    stacks = _run(image_store, get_stacks, max_stacks=1, n_tile_workers=4)
+
+    for pos, stack in enumerate(stacks):
+        expected = get_numpy_stack(
+            image_store.db_url, image_store.image_ids, image_store.channels, pos=pos,
+            data_path=image_store.data_path
+        )
+        np.testing.assert_array_equal(stack, expected)
+
+
+def test_lookups(image_store):
+    async def lookups(db):
+        return await asyncio.gather(
+            db.get_positions(image_store.image_ids[0]),
+            db.get_channels(image_store.image_ids[0]),
+            db.get_channels(image_store.image_ids[0], limit=1, offset=1),
+            db.search_ids('0001'),
+        )
+
+    positions, channels, channels_page, ids = _run(image_store, lookups)
+
+    assert positions == list(range(image_store.n_positions))
+    assert list(channels.values()) == image_store.channels
+    assert channels_page == {1: image_store.channels[1]}
+    assert ids == [image_store.image_ids[1]]
+
+
+def test_missing_channel(image_store):
+    async def get_stack(db):
+        return await db.get_stack(image_store.image_ids, ['GFP'])
+
+    with pytest.raises(ValueError, match='No images match query'):
+        _run(image_store, get_stack)
@@ -0,0 +1,105 @@
+import shutil
+
+import numpy as np
+import pytest
+from skimage import img_as_float32
+import sqlalchemy as sa
+
+pytest.importorskip('imaging_db')
+
+import imaging_db.database.db_operations as db_ops
+
+from InSituToolkit.imaging_database import TileCache, get_image_stack, get_numpy_stack
+from InSituToolkit.instrumentation import TILES_CACHED, TILES_DOWNLOADED, instrument
+
+
+def _get_numpy_stack(image_store, db_url=None, **kwargs):
+    return get_numpy_stack(
+        db_url or image_store.db_url, image_store.image_ids, image_store.channels,
+        data_path=image_store.data_path, **kwargs
+    )
+
+
+@pytest.mark.parametrize('n_workers', [1, 8])
+@pytest.mark.parametrize('pos', [0, 1])
+def test_matches_serial_baseline(image_store, n_workers, pos):
+    stack = _get_numpy_stack(image_store, pos=pos, n_workers=n_workers)
+
+    assert stack.dtype == np.uint16
+    np.testing.assert_array_equal(stack, image_store.expected(pos))
+
+
+def test_channel_order(image_store):
+    stack = get_numpy_stack(
+        image_store.db_url, image_store.image_ids[::-1], image_store.channels[::-1],
+        data_path=image_store.data_path
+    )
+
+    np.testing.assert_array_equal(stack, image_store.expected()[::-1, ::-1])
+
+
+def test_missing_channel(image_store):
+    with pytest.raises(ValueError, match='No images match query'):
+        get_numpy_stack(
+            image_store.db_url, image_store.image_ids, ['Cy5', 'GFP'],
+            data_path=image_store.data_path
+        )
+
+
+def test_cache(image_store, tmp_path):
+    cache = TileCache(str(tmp_path))
+    n_tiles = image_store.expected().shape[:3]
+    n_tiles = n_tiles[0] * n_tiles[1] * n_tiles[2]
+
+    with instrument() as cold:
+        _get_numpy_stack(image_store, cache=cache)
+    with instrument() as warm:
+        stack = _get_numpy_stack(image_store, cache=cache)
+
+    np.testing.assert_array_equal(stack, image_store.expected())
+    assert cold.counters[TILES_DOWNLOADED] == n_tiles
+    assert warm.counters[TILES_CACHED] == n_tiles
+    assert TILES_DOWNLOADED not in warm.counters
+
+
+@pytest.fixture
+def ragged_db(image_store, tmp_path):
+    """
+    Copy of the imagingDB where the second round has 2 slices
+    """
+    from _fixtures import _foreign_key
+
+    db_path = str(tmp_path / 'ragged.sqlite')
+    shutil.copy(image_store.db_url[len('sqlite:///'):], db_path)
+
+    frames = db_ops.Frames.__table__
+    frames_global_id = frames.c[_foreign_key(frames, db_ops.FramesGlobal)]
+    engine = sa.create_engine('sqlite:///' + db_path)
+    with engine.begin() as connection:
+        connection.execute(frames.delete().where(sa.and_(frames.c.slice_idx == 2, frames_global_id == 2)))
+    engine.dispose()
+
+    return 'sqlite:///' + db_path
+
+
+def test_ragged(image_store, ragged_db):
+    expected = image_store.expected()
+
+    stack = _get_numpy_stack(image_store, ragged_db)
+    np.testing.assert_array_equal(stack[0], expected[0])
+    np.testing.assert_array_equal(stack[1, :, :2], expected[1, :, :2])
+    assert not stack[1, :, 2].any()
+
+    stacks = _get_numpy_stack(image_store, ragged_db, ragged='list')
+    assert [s.shape[1] for s in stacks] == [3, 2]
+    np.testing.assert_array_equal(stacks[1], expected[1, :, :2])
+
+
+def test_get_image_stack(image_store):
+    pytest.importorskip('starfish')
+    stack = get_image_stack(
+        image_store.db_url, image_store.image_ids, image_store.channels,
+        data_path=image_store.data_path
+    )
+
+    np.testing.assert_array_equal(stack.xarray.values, img_as_float32(image_store.expected()))
@@ -0,0 +1,275 @@
+import json
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import experiment_writer
+
+
+def _use_writer(monkeypatch, writer):
+    monkeypatch.setattr(experiment_writer, '_load_writer', lambda: writer)
+
+
+def _argparse_writer(code):
+    calls = []
+
+    def main():
+        calls.append(list(sys.argv))
+        sys.exit(code)
+
+    return main, calls
+
+
+@pytest.mark.parametrize('code', [None, 0])
+def test_run_writer_success(monkeypatch, code):
+    writer, calls = _argparse_writer(code)
+    _use_writer(monkeypatch, writer)
+    argv = list(sys.argv)
+
+    experiment_writer._run_writer(['--output-dir', 'out'])
+
+    assert calls == [[experiment_writer._WRITER_SCRIPT, '--output-dir', 'out']]
+    assert sys.argv == argv
+
+
+@pytest.mark.parametrize('code, returncode', [(2, 2), ('usage error', 1)])
+def test_run_writer_failure(monkeypatch, code, returncode):
+    writer, _ = _argparse_writer(code)
+    _use_writer(monkeypatch, writer)
+    argv = list(sys.argv)
+
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        experiment_writer._run_writer(['--output-dir', 'out'])
+
+    assert e.value.returncode == returncode
+    assert e.value.cmd == [experiment_writer._WRITER_SCRIPT, '--output-dir', 'out']
+    assert sys.argv == argv
+
+
+class _ClickCommand:
+    def __init__(self, code):
+        self.code = code
+
+    def main(self, args, prog_name, standalone_mode):
+        assert not standalone_mode
+        sys.exit(self.code)
+
+
+def test_run_writer_click_failure(monkeypatch):
+    _use_writer(monkeypatch, _ClickCommand(1))
+
+    with pytest.raises(subprocess.CalledProcessError):
+        experiment_writer._run_writer([])
+
+    _use_writer(monkeypatch, _ClickCommand(0))
+    experiment_writer._run_writer([])
+
+
+def _manifest(tiles):
+    """
+    Manifest of the primary image from (fov, round, ch, zplane, sha256) tiles
+    """
+    return {'primary': {
+        '{},{},{},{}'.format(fov, r, c, z): {'path': 'im_{}_{}_{}_{}.png'.format(fov, r, c, z), 'sha256': sha, 'fov': fov}
+        for fov, r, c, z, sha in tiles
+    }}
+
+
+@pytest.fixture
+def output_folder(tmp_path):
+    with open(str(tmp_path / 'experiment.json'), 'w') as f:
+        f.write('{}')
+
+    return str(tmp_path)
+
+
+_TILES = [(fov, 0, c, 0, 'sha{}{}'.format(fov, c)) for fov in range(3) for c in range(2)]
+
+
+def test_changed_fovs_unchanged(output_folder):
+    assert experiment_writer._changed_fovs(_manifest(_TILES), _manifest(_TILES), output_folder) == {'primary': set()}
+
+
+def test_changed_fovs(output_folder):
+    tiles = list(_TILES)
+    # A changed tile in fov 1 and a new fov 3
+    tiles[3] = (1, 0, 1, 0, 'changed')
+    tiles.append((3, 0, 0, 0, 'sha30'))
+
+    changed = experiment_writer._changed_fovs(_manifest(tiles), _manifest(_TILES), output_folder)
+    assert changed == {'primary': {1, 3}}
+
+
+def test_changed_fovs_full_rewrite(output_folder, tmp_path):
+    manifest = _manifest(_TILES)
+
+    # No previous run
+    assert experiment_writer._changed_fovs(manifest, None, output_folder) is None
+    assert experiment_writer._changed_fovs(manifest, manifest, str(tmp_path / 'missing')) is None
+    # A removed tile
+    assert experiment_writer._changed_fovs(_manifest(_TILES[1:]), manifest, output_folder) is None
+    # A removed image
+    previous = dict(manifest, nuclei=manifest['primary'])
+    assert experiment_writer._changed_fovs(manifest, previous, output_folder) is None
+
+
+def test_make_manifest(tmp_path):
+    csv_file = str(tmp_path / 'spots.csv')
+    pd.DataFrame({
+        'fov': [0, 1], 'round': [0, 0], 'ch': [1, 1], 'zplane': [2, 2],
+        'path': ['a.png', 'b.png'], 'sha256': ['sha_a', 'sha_b']
+    }).to_csv(csv_file)
+
+    manifest = experiment_writer._make_manifest({'primary': csv_file})
+    assert manifest == {'primary': {
+        '0,0,1,2': {'path': 'a.png', 'sha256': 'sha_a', 'fov': 0},
+        '1,0,1,2': {'path': 'b.png', 'sha256': 'sha_b', 'fov': 1},
+    }}
+
+
+def _fake_writer(fail=False):
+    """
+    Writer that numbers the fields of view 0, 1, ... in the order of their
+    index in the csv file, like a writer that ignores sparse indices. Each
+    field of view file lists the paths of its tiles.
+    """
+    def main():
+        args = sys.argv[1:]
+        output_dir = args[args.index('--output-dir') + 1]
+        csv_files = [(args[i + 1], args[i + 2]) for i, arg in enumerate(args) if arg == '--csv-file']
+
+        images = {}
+        for name, csv_file in csv_files:
+            im_df = pd.read_csv(csv_file, index_col=0)
+            contents = {}
+            for i, fov in enumerate(sorted(im_df['fov'].unique())):
+                fov_name = 'fov_{:03d}'.format(i)
+                contents[fov_name] = '{}-{}.json'.format(name, fov_name)
+                with open(os.path.join(output_dir, contents[fov_name]), 'w') as f:
+                    json.dump(sorted(im_df.loc[im_df['fov'] == fov, 'path']), f)
+            images[name] = '{}.json'.format(name)
+            with open(os.path.join(output_dir, images[name]), 'w') as f:
+                json.dump({'contents': contents}, f)
+            if fail:
+                sys.exit(1)
+
+        with open(os.path.join(output_dir, 'experiment.json'), 'w') as f:
+            json.dump({'images': images}, f)
+
+    return main
+
+
+def _write_csv(csv_file, tiles):
+    pd.DataFrame(
+        [(fov, r, c, z, 'im_{}_{}_{}_{}.png'.format(fov, r, c, z), sha) for fov, r, c, z, sha in tiles],
+        columns=['fov', 'round', 'ch', 'zplane', 'path', 'sha256']
+    ).to_csv(csv_file)
+
+
+def _read_experiment(output_folder):
+    with open(os.path.join(output_folder, 'primary.json')) as f:
+        contents = json.load(f)['contents']
+    fov_files = {}
+    for fov_name, fov_file in contents.items():
+        with open(os.path.join(output_folder, fov_file)) as f:
+            fov_files[fov_name] = (fov_file, json.load(f))
+
+    return fov_files
+
+
+def _incremental_run(tmp_path, monkeypatch, writer):
+    output_folder = str(tmp_path / 'experiment')
+    os.mkdir(output_folder)
+    csv_files = {'primary': os.path.join(output_folder, 'spots.csv')}
+    tiles = [(fov, 0, c, 0, 'sha{}{}'.format(fov, c)) for fov in range(5) for c in range(2)]
+    _write_csv(csv_files['primary'], tiles)
+    _use_writer(monkeypatch, _fake_writer())
+    experiment_writer._run_writer(experiment_writer._writer_args(
+        8, 8, 'data', output_folder, 'PNG', csv_files
+    ))
+    previous = experiment_writer._make_manifest(csv_files)
+
+    # Changed tiles in fields of view 1 and 3
+    tiles[2] = (1, 0, 0, 0, 'changed')
+    tiles[7] = (3, 0, 1, 0, 'changed')
+    _write_csv(csv_files['primary'], tiles)
+    changed_fovs = experiment_writer._changed_fovs(
+        experiment_writer._make_manifest(csv_files), previous, output_folder
+    )
+    assert changed_fovs == {'primary': {1, 3}}
+
+    _use_writer(monkeypatch, writer)
+    experiment_writer._write_changed_fovs(changed_fovs, csv_files, 8, 8, 'data', output_folder, 'PNG')
+
+    return output_folder
+
+
+def _expected_experiment():
+    return {
+        'fov_{:03d}'.format(fov): (
+            'primary-fov_{:03d}.json'.format(fov),
+            ['im_{}_0_{}_0.png'.format(fov, c) for c in range(2)]
+        )
+        for fov in range(5)
+    }
+
+
+def test_write_changed_fovs(tmp_path, monkeypatch):
+    output_folder = _incremental_run(tmp_path, monkeypatch, _fake_writer())
+
+    assert _read_experiment(output_folder) == _expected_experiment()
+    assert sorted(os.listdir(output_folder)) == sorted(
+        ['experiment.json', 'primary.json', 'spots.csv'] +
+        ['primary-fov_{:03d}.json'.format(fov) for fov in range(5)]
+    )
+
+
+def test_write_changed_fovs_failure_removes_staging(tmp_path, monkeypatch):
+    with pytest.raises(subprocess.CalledProcessError):
+        _incremental_run(tmp_path, monkeypatch, _fake_writer(fail=True))
+
+    output_folder = str(tmp_path / 'experiment')
+    assert not any(name.startswith('.staging-') for name in os.listdir(output_folder))
+    assert _read_experiment(output_folder) == _expected_experiment()
+
+
+@pytest.mark.parametrize('contents', [
+    {'fov_000': 'primary-fov_000.json'},
+    {'fov_000': 'primary-fov_000.json', 'fov_002': 'primary-fov_002.json'},
+    {'fov': 'primary-fov.json', 'fov_001': 'primary-fov_001.json'},
+    {'fov_000': 'primary-0.json', 'fov_001': 'primary-1.json'},
+])
+def test_rename_staged_fovs_unmapped(contents):
+    assert experiment_writer._rename_staged_fovs(contents, [1, 3]) is None
+
+
+def test_rename_staged_fovs():
+    contents = {'fov_1': 'primary-fov_1.json', 'fov_0': 'primary-fov_0.json'}
+
+    assert experiment_writer._rename_staged_fovs(contents, [3, 12]) == {
+        'fov_12': ('primary-fov_1.json', 'primary-fov_12.json'),
+        'fov_3': ('primary-fov_0.json', 'primary-fov_3.json'),
+    }
+
+
+def test_write_changed_fovs_falls_back_to_full_write(tmp_path, monkeypatch):
+    calls = []
+
+    def writer():
+        calls.append(sys.argv[sys.argv.index('--output-dir') + 1])
+        if os.path.basename(calls[-1]).startswith('.staging-'):
+            # Names the staged fields of view without an index
+            with open(os.path.join(calls[-1], 'primary.json'), 'w') as f:
+                json.dump({'contents': {'a': 'primary-a.json', 'b': 'primary-b.json'}}, f)
+        else:
+            _fake_writer()()
+
+    output_folder = _incremental_run(tmp_path, monkeypatch, writer)
+
+    assert calls[1:] == [output_folder]
+    assert _read_experiment(output_folder) == _expected_experiment()
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import zarr
+
+pytest.importorskip('starfish')
+pytest.importorskip('napari')
+
+from InSituToolkit.analysis._fov_cache import FovCache, _nbytes
+
+
+def test_nbytes():
+    image = np.zeros((2, 64, 64), dtype=np.float32)
+    lazy_image = zarr.zeros((2, 64, 64), chunks=(1, 32, 32), dtype=np.float32)
+    points = [{'coords': np.zeros((10, 3)), 'name': 'gene'}]
+
+    # A lazy level counts with one chunk
+    assert _nbytes(lazy_image) == 32 * 32 * 4
+    assert _nbytes(([image, lazy_image], points, None)) == image.nbytes + 32 * 32 * 4 + 240
+
+
+def test_nbytes_dask():
+    da = pytest.importorskip('dask.array')
+
+    assert _nbytes(da.zeros((2, 64, 64), chunks=(1, 32, 32), dtype=np.uint16)) == 32 * 32 * 2
+
+
+def _cache(loads, max_bytes, lazy_keys=()):
+    def load(key):
+        loads.append(key)
+        if key in lazy_keys:
+            # Lazy levels like the ones read from the sidecar
+            return [zarr.zeros((1024, 1024), chunks=(256, 256), dtype=np.uint8)]
+        return [np.zeros((256, 256), dtype=np.uint8)]
+
+    return FovCache(load, max_bytes=max_bytes)
+
+
+def test_evicts_least_recently_used():
+    loads = []
+    cache = _cache(loads, max_bytes=2 * 256 * 256)
+    try:
+        for key in [0, 1, 0, 2]:
+            cache.request(key).result()
+
+        assert 0 in cache
+        assert 1 not in cache
+        assert 2 in cache
+        assert loads == [0, 1, 2]
+    finally:
+        cache.shutdown()
+
+
+def test_lazy_fovs_do_not_evict_loaded_fovs():
+    loads = []
+    # The lazy fields of view count as one 256 x 256 chunk each, not 1024 x 1024
+    cache = _cache(loads, max_bytes=4 * 256 * 256, lazy_keys={'a', 'b'})
+    try:
+        for key in [0, 1, 'a', 'b']:
+            cache.request(key).result()
+
+        assert all(key in cache for key in [0, 1, 'a', 'b'])
+    finally:
+        cache.shutdown()
@@ -0,0 +1,62 @@
+import gc
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import get_fovs
+
+
+def _producers():
+    return [thread for thread in threading.enumerate() if thread.name == 'get_fovs-producer']
+
+
+def _get_fovs(image_store, **kwargs):
+    return get_fovs(
+        image_store.db_url, image_store.image_ids, image_store.channels,
+        positions=list(range(image_store.n_positions)), data_path=image_store.data_path,
+        **kwargs
+    )
+
+
+def test_get_fovs(image_store):
+    fovs = list(_get_fovs(image_store, prefetch=1))
+
+    assert [(pos, time) for pos, time, _ in fovs] == [(0, 0), (1, 0)]
+    for pos, _, im_stack in fovs:
+        np.testing.assert_array_equal(im_stack, image_store.expected(pos))
+    assert _producers() == []
+
+
+@pytest.mark.parametrize('prefetch', [0, -1])
+def test_prefetch_must_be_positive(image_store, prefetch):
+    with pytest.raises(ValueError, match='prefetch'):
+        _get_fovs(image_store, prefetch=prefetch)
+
+
+def test_break_stops_producer(image_store):
+    for pos, _, _ in _get_fovs(image_store, prefetch=1):
+        break
+
+    assert pos == 0
+    assert _producers() == []
+
+
+def test_close_stops_producer(image_store):
+    fovs = _get_fovs(image_store, prefetch=1)
+    next(fovs)
+    assert len(_producers()) == 1
+
+    fovs.close()
+    assert _producers() == []
+
+
+def test_dropped_iterator_stops_producer(image_store):
+    fovs = _get_fovs(image_store, prefetch=1)
+    next(fovs)
+
+    del fovs
+    gc.collect()
+    assert _producers() == []
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database._image_database import ImageDatabase
+from InSituToolkit.imaging_database._storage import LocalStorage
+
+
+def test_get_stack_data_path(image_store):
+    db = ImageDatabase(image_store.db_url)
+    stack = db.getStack(image_store.image_ids[1], 'Cy3', pos_idx=1, data_path=image_store.data_path)
+
+    np.testing.assert_array_equal(stack, image_store.expected(pos=1)[1, 1][np.newaxis, np.newaxis])
+
+
+def test_get_stack_storage_factory(image_store):
+    s3_dirs = []
+
+    def storage_factory(s3_dir):
+        s3_dirs.append(s3_dir)
+        return LocalStorage(image_store.data_path, s3_dir)
+
+    db = ImageDatabase(image_store.db_url)
+    stack = db.getStack(image_store.image_ids[0], 'Cy5', storage_factory=storage_factory)
+
+    np.testing.assert_array_equal(stack[0, 0], image_store.expected()[0, 0])
+    assert s3_dirs == ['raw_frames/' + image_store.image_ids[0]]
+
+
+def test_get_stack_verbose_is_deprecated(image_store):
+    db = ImageDatabase(image_store.db_url)
+    with pytest.deprecated_call():
+        db.getStack(image_store.image_ids[0], 'Cy5', verbose=True, data_path=image_store.data_path)
+
+
+def test_get_stack_into_stack(image_store):
+    db = ImageDatabase(image_store.db_url)
+    expected = image_store.expected()
+    im_stack = np.zeros(expected.shape, dtype=expected.dtype)
+
+    for r, image_id in enumerate(image_store.image_ids):
+        for c, channel in enumerate(image_store.channels):
+            stack = db.getStack(image_id, channel, out=im_stack[r, c], data_path=image_store.data_path)
+            assert np.shares_memory(stack, im_stack)
+
+    np.testing.assert_array_equal(im_stack, expected)
+
+
+def test_get_stack_into_transposed_view(image_store):
+    db = ImageDatabase(image_store.db_url)
+    n_y, n_x = image_store.tile_shape
+    # (x, y, z) memory layout, so out is not contiguous
+    buffer = np.zeros((n_x, n_y, image_store.n_slices), dtype=np.uint16)
+    out = buffer.transpose(2, 1, 0)
+    assert not out.flags.c_contiguous
+
+    stack = db.getStack(image_store.image_ids[1], 'FITC', pos_idx=1, out=out, data_path=image_store.data_path)
+
+    assert np.shares_memory(stack, buffer)
+    np.testing.assert_array_equal(out, image_store.expected(pos=1)[1, 2])
+
+
+@pytest.mark.parametrize('shape, dtype, match', [
+    ((2, 24, 40), np.uint16, 'shape'),
+    ((3, 40, 24), np.uint16, 'shape'),
+    ((3, 24, 40), np.float32, 'dtype'),
+])
+def test_get_stack_out_mismatch(image_store, shape, dtype, match):
+    db = ImageDatabase(image_store.db_url)
+    out = np.zeros(shape, dtype=dtype)
+
+    with pytest.raises(ValueError, match=match):
+        db.getStack(image_store.image_ids[0], 'Cy5', out=out, data_path=image_store.data_path)
+    assert not out.any()
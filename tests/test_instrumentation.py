@@ -0,0 +1,150 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+import sqlalchemy as sa
+
+from InSituToolkit import instrumentation
+from InSituToolkit.instrumentation import instrument
+
+
+def test_nothing_recorded_outside_a_block():
+    with instrumentation.stage('stage'):
+        pass
+    instrumentation.count('counter')
+
+    with instrument() as report:
+        pass
+
+    assert report.stages == []
+    assert report.counters == {}
+
+
+def test_stage_totals_and_counters():
+    with instrument() as report:
+        for _ in range(3):
+            with instrumentation.stage('a'):
+                time.sleep(0.01)
+        with instrumentation.stage('b'):
+            pass
+        instrumentation.count('tiles')
+        instrumentation.count('bytes', 100)
+        instrumentation.count('bytes', 28)
+
+    totals = report.stage_totals()
+    assert list(totals) == ['a', 'b']
+    assert totals['a']['calls'] == 3
+    assert totals['a']['time_s'] >= 0.03
+    assert totals['b']['calls'] == 1
+    assert totals['a']['time_s'] + totals['b']['time_s'] <= report.wall_time
+
+    assert report.to_dict() == {
+        'wall_time_s': report.wall_time,
+        'stages': totals,
+        'counters': {'tiles': 1, 'bytes': 128},
+    }
+    # The wall time is fixed when the block exits
+    assert report.wall_time == report.to_dict()['wall_time_s']
+
+    lines = report.summary().splitlines()
+    assert [line.split()[0] for line in lines] == ['a', 'b', 'wall', 'tiles', 'bytes']
+    assert lines[0].split()[1:3] == ['3', 'x']
+    assert lines[-1].split() == ['bytes', '128']
+
+
+def test_stage_recorded_on_error():
+    with instrument() as report:
+        with pytest.raises(KeyError):
+            with instrumentation.stage('fails'):
+                raise KeyError
+
+    assert report.stage_totals()['fails']['calls'] == 1
+
+
+def test_other_threads_are_recorded():
+    def work():
+        with instrumentation.stage('thread'):
+            instrumentation.count('thread')
+
+    with instrument() as report:
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    assert report.stage_totals()['thread']['calls'] == 4
+    assert report.counters == {'thread': 4}
+    assert {event.thread_id for event in report.stages} == {thread.ident for thread in threads}
+
+
+def test_nested_blocks_raise():
+    with instrument() as report:
+        with pytest.raises(RuntimeError, match='nested'):
+            with instrument():
+                pass
+        instrumentation.count('outer')
+
+    assert report.counters == {'outer': 1}
+    # The failed block leaves the outer one closable and a new block can open
+    with instrument():
+        pass
+
+
+def test_chrome_trace(tmp_path):
+    trace_file = str(tmp_path / 'trace.json')
+    with instrument(trace_file=trace_file) as report:
+        with instrumentation.stage('a'):
+            time.sleep(0.01)
+        instrumentation.count('tiles', 2)
+
+    with open(trace_file) as f:
+        trace = json.load(f)
+
+    assert trace['displayTimeUnit'] == 'ms'
+    complete, counter = trace['traceEvents']
+    assert complete['name'] == 'a'
+    assert complete['ph'] == 'X'
+    assert complete['pid'] == os.getpid()
+    assert complete['tid'] == threading.get_ident()
+    assert complete['ts'] >= 0
+    assert complete['dur'] == pytest.approx(report.stages[0].duration * 1e6)
+    assert complete['ts'] + complete['dur'] <= report.wall_time * 1e6
+
+    assert counter['ph'] == 'C'
+    assert counter['args'] == {'tiles': 2}
+    assert counter['ts'] == pytest.approx(report.wall_time * 1e6)
+
+
+def test_sql_statements(image_store):
+    from InSituToolkit.imaging_database._image_database import ImageDatabase
+
+    statements = []
+
+    def on_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    db = ImageDatabase(image_store.db_url)
+    sa.event.listen(sa.engine.Engine, 'before_cursor_execute', on_execute)
+    try:
+        with instrument() as report:
+            stack = db.getStack(image_store.image_ids[0], 'Cy3', data_path=image_store.data_path)
+    finally:
+        sa.event.remove(sa.engine.Engine, 'before_cursor_execute', on_execute)
+
+    assert len(statements) > 0
+    assert report.counters[instrumentation.SQL_STATEMENTS] == len(statements)
+    assert report.counters[instrumentation.TILES_DOWNLOADED] == image_store.n_slices
+    assert report.counters[instrumentation.BYTES_READ] == sum(
+        os.path.getsize(image_store.frame_path(0, 1, z)) for z in range(image_store.n_slices)
+    )
+    totals = report.stage_totals()
+    assert totals['query frames']['calls'] == 1
+    assert totals['fetch tile']['calls'] == image_store.n_slices
+    assert stack.shape[2] == image_store.n_slices
+
+    # The listener is removed when the block exits
+    db.getStack(image_store.image_ids[0], 'Cy3', data_path=image_store.data_path)
+    assert report.counters[instrumentation.SQL_STATEMENTS] == len(statements)
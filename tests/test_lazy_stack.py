@@ -0,0 +1,53 @@
+import pickle
+
+import numpy as np
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import TileCache, get_dask_stack, get_numpy_stack
+
+
+def _get_stacks(image_store, **kwargs):
+    args = (image_store.db_url, image_store.image_ids, image_store.channels)
+    kwargs.update(pos=1, data_path=image_store.data_path)
+
+    return get_dask_stack(*args, **kwargs), get_numpy_stack(*args, **kwargs)
+
+
+def test_compute_equals_numpy_stack(image_store):
+    lazy_stack, stack = _get_stacks(image_store)
+
+    assert lazy_stack.shape == stack.shape
+    assert lazy_stack.dtype == stack.dtype
+    np.testing.assert_array_equal(lazy_stack.compute(scheduler='threads'), stack)
+    np.testing.assert_array_equal(lazy_stack.max(axis=2).compute(), stack.max(axis=2))
+
+
+def test_graph_is_picklable(image_store, tmp_path):
+    lazy_stack, stack = _get_stacks(image_store, cache=TileCache(str(tmp_path)))
+
+    graph = pickle.loads(pickle.dumps(dict(lazy_stack.__dask_graph__())))
+    assert len(graph) > 0
+    np.testing.assert_array_equal(lazy_stack.compute(scheduler='processes', num_workers=2), stack)
+
+
+def test_keys_are_deterministic(image_store):
+    first, _ = _get_stacks(image_store)
+    second, _ = _get_stacks(image_store)
+    assert first.name == second.name
+
+    # Another storage config gives other keys
+    other, _ = _get_stacks(image_store, max_retries=0)
+    assert not set(other.__dask_graph__()) & {
+        key for key in first.__dask_graph__() if str(key).startswith('tile-')
+    }
+
+
+def test_cache(image_store, tmp_path):
+    cache = TileCache(str(tmp_path))
+    lazy_stack, stack = _get_stacks(image_store, cache=cache)
+
+    lazy_stack.compute(scheduler='threads')
+    np.testing.assert_array_equal(lazy_stack.compute(scheduler='threads'), stack)
+    assert cache.hits > 0
@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import get_channels, get_positions, search_ids
+
+
+def test_get_channels(image_store):
+    channels = get_channels(image_store.db_url, image_store.image_ids[0])
+    assert channels == dict(enumerate(image_store.channels))
+
+    assert get_channels(image_store.db_url, image_store.image_ids[0], limit=2) == {0: 'Cy5', 1: 'Cy3'}
+    assert get_channels(image_store.db_url, image_store.image_ids[0], limit=2, offset=2) == {2: 'FITC'}
+    assert get_channels(image_store.db_url, image_store.image_ids[0], offset=3) == {}
+    assert get_channels(image_store.db_url, 'missing') == {}
+
+
+def test_get_positions(image_store):
+    assert get_positions(image_store.db_url, image_store.image_ids[0]) == [0, 1]
+    assert get_positions(image_store.db_url, image_store.image_ids[0], limit=1, offset=1) == [1]
+
+
+def test_search_ids(image_store):
+    assert search_ids(image_store.db_url, '2019-08') == image_store.image_ids
+    assert search_ids(image_store.db_url, '2019-08', limit=1, offset=1) == image_store.image_ids[1:]
+    assert search_ids(image_store.db_url, 'missing') == []
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import _make_experiment_csv
+from InSituToolkit.imaging_database._make_experiment_csv import _calc_checksums, make_experiment_csvs
+
+
+def _sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@pytest.fixture
+def files(tmp_path):
+    names = ['a.png', os.path.join('sub', 'b.png'), 'c.png']
+    os.makedirs(str(tmp_path / 'sub'))
+    for i, name in enumerate(names):
+        with open(str(tmp_path / name), 'wb') as f:
+            f.write(os.urandom(1000 + i))
+
+    return str(tmp_path), names
+
+
+@pytest.fixture
+def hashed(monkeypatch):
+    """
+    Records the files that are hashed
+    """
+    calls = []
+    sha256_file = _make_experiment_csv._sha256_file
+
+    def _sha256_file(filename):
+        calls.append(os.path.basename(filename))
+        return sha256_file(filename)
+
+    monkeypatch.setattr(_make_experiment_csv, '_sha256_file', _sha256_file)
+
+    return calls
+
+
+def test_checksums(files):
+    data_path, names = files
+    # Windows separators are converted
+    checksums = _calc_checksums([name.replace(os.sep, '\\') for name in names], data_path, n_workers=2)
+
+    assert checksums == [_sha256(os.path.join(data_path, name)) for name in names]
+
+
+def test_checksum_index(files, hashed, tmp_path):
+    data_path, names = files
+    index = str(tmp_path / 'checksums.json')
+
+    first = _calc_checksums(names, data_path, checksum_index=index)
+    assert sorted(hashed) == ['a.png', 'b.png', 'c.png']
+
+    # Unchanged files aren't hashed again
+    del hashed[:]
+    assert _calc_checksums(names, data_path, checksum_index=index) == first
+    assert hashed == []
+
+    # Changed files are hashed again
+    path = os.path.join(data_path, 'c.png')
+    stat = os.stat(path)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(stat.st_size + 1))
+    checksums = _calc_checksums(names, data_path, checksum_index=index)
+    assert hashed == ['c.png']
+    assert checksums[:2] == first[:2]
+    assert checksums[2] == _sha256(path)
+
+
+def test_corrupt_checksum_index(files, hashed, tmp_path):
+    data_path, names = files
+    index = str(tmp_path / 'checksums.json')
+    with open(index, 'w') as f:
+        f.write('{"truncated')
+
+    checksums = _calc_checksums(names, data_path, checksum_index=index)
+
+    assert checksums == [_sha256(os.path.join(data_path, name)) for name in names]
+    assert len(hashed) == 3
+
+
+def test_make_experiment_csvs(image_store, tmp_path):
+    csv_files = {'primary': str(tmp_path / 'spots.csv'), 'nuclei': str(tmp_path / 'nuclei.csv')}
+    tile_width, tile_height = make_experiment_csvs(
+        image_store.db_url, csv_files, image_store.image_ids,
+        {'primary': ['Cy5', 'Cy3'], 'nuclei': ['FITC']},
+        positions=[0, 1], data_path=image_store.data_path
+    )
+    assert (tile_height, tile_width) == image_store.tile_shape
+
+    spots = pd.read_csv(csv_files['primary'], index_col=0)
+    nuclei = pd.read_csv(csv_files['nuclei'], index_col=0)
+    n_rounds, n_slices = len(image_store.image_ids), image_store.n_slices
+    assert len(spots) == 2 * n_rounds * 2 * n_slices
+    assert len(nuclei) == 2 * n_rounds * n_slices
+    assert sorted(nuclei['ch'].unique()) == [0]
+
+    row = spots[(spots['fov'] == 1) & (spots['round'] == 1) & (spots['ch'] == 1) & (spots['zplane'] == 2)].iloc[0]
+    path = image_store.frame_path(1, 1, 2, pos=1)
+    assert row['sha256'] == _sha256(path)
+    assert path.endswith(os.path.join(*row['path'].split('/')))
+
+
+def test_checksum_index_drops_unused_files(files, hashed, tmp_path):
+    data_path, names = files
+    index = str(tmp_path / 'checksums.json')
+
+    _calc_checksums(names, data_path, checksum_index=index)
+    _calc_checksums(names[:1], data_path, checksum_index=index)
+
+    with open(index) as f:
+        assert list(json.load(f)) == [os.path.join(data_path, names[0])]
+
+    del hashed[:]
+    _calc_checksums(names, data_path, checksum_index=index)
+    assert sorted(hashed) == ['b.png', 'c.png']
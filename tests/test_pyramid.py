@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('starfish')
+pytest.importorskip('napari')
+
+from InSituToolkit.analysis.pyramid import image_pyramid, label_pyramid
+
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float32])
+def test_image_pyramid_dtype(dtype):
+    image = (np.arange(2 * 512 * 600) % 200).astype(dtype).reshape(2, 512, 600)
+
+    pyramid = image_pyramid(image)
+
+    assert [level.shape for level in pyramid] == [(2, 512, 600), (2, 256, 300)]
+    assert all(level.dtype == dtype for level in pyramid)
+    assert pyramid[0] is image
+
+
+def test_image_pyramid_averages_blocks():
+    image = np.zeros((4, 6), dtype=np.float32)
+    image[0, 0], image[1, 1] = 4, 8
+
+    pyramid = image_pyramid(image, min_size=2)
+
+    assert pyramid[1].shape == (2, 3)
+    assert pyramid[1][0, 0] == 3
+    assert pyramid[1].sum() == 3
+
+
+def test_image_pyramid_odd_size():
+    image = np.arange(7 * 9, dtype=np.float32).reshape(7, 9)
+
+    pyramid = image_pyramid(image, min_size=1)
+
+    # The last row and column are dropped before each downsampling
+    assert [level.shape for level in pyramid] == [(7, 9), (3, 4), (1, 2)]
+    expected = image[:6, :8].reshape(3, 2, 4, 2).mean(axis=(1, 3))
+    np.testing.assert_allclose(pyramid[1], expected)
+
+
+@pytest.mark.parametrize('shape, min_size, shapes', [
+    ((256, 1024), 256, [(256, 1024)]),
+    ((257, 1024), 256, [(257, 1024), (128, 512)]),
+    ((1030, 2050), 256, [(1030, 2050), (515, 1025), (257, 512), (128, 256)]),
+    ((100, 100), 10, [(100, 100), (50, 50), (25, 25), (12, 12), (6, 6)]),
+])
+def test_pyramid_min_size(shape, min_size, shapes):
+    image = np.zeros(shape, dtype=np.uint8)
+
+    assert [level.shape for level in image_pyramid(image, min_size)] == shapes
+    assert [level.shape for level in label_pyramid(image, min_size)] == shapes
+
+
+def test_label_pyramid_keeps_labels():
+    rng = np.random.RandomState(0)
+    labels = rng.choice([0, 3, 7, 1000], size=(601, 523)).astype(np.int32)
+
+    pyramid = label_pyramid(labels)
+
+    assert [level.shape for level in pyramid] == [(601, 523), (300, 261), (150, 130)]
+    assert all(level.dtype == np.int32 for level in pyramid)
+    # Nearest neighbor, so no averaged values at the object borders
+    np.testing.assert_array_equal(pyramid[1], labels[:600:2, :522:2])
+    np.testing.assert_array_equal(pyramid[2], labels[:600:4, :520:4])
+    assert set(np.unique(pyramid[2])) <= {0, 3, 7, 1000}
+
+
+def test_image_pyramid_dask():
+    da = pytest.importorskip('dask.array')
+    image = np.arange(2 * 600 * 520, dtype=np.uint16).reshape(2, 600, 520) % 1000
+
+    pyramid = image_pyramid(da.from_array(image, chunks=(1, 256, 256)))
+
+    assert all(isinstance(level, da.Array) for level in pyramid)
+    for level, expected in zip(pyramid, image_pyramid(image)):
+        assert level.dtype == expected.dtype
+        np.testing.assert_array_equal(level.compute(), expected)
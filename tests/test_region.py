@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import tifffile
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import TileCache, get_numpy_stack
+from InSituToolkit.imaging_database._frame_plan import FramePlan, FrameRecord
+from InSituToolkit.imaging_database._region import make_region
+from InSituToolkit.imaging_database._storage import LocalStorage
+
+
+def _get_region(image_store, **kwargs):
+    return get_numpy_stack(
+        image_store.db_url, image_store.image_ids, image_store.channels,
+        data_path=image_store.data_path, **kwargs
+    )
+
+
+@pytest.mark.parametrize('kwargs, index', [
+    ({'z': slice(1, None)}, np.s_[:, :, 1:]),
+    ({'z': slice(None, None, 2)}, np.s_[:, :, ::2]),
+    ({'stride': 3}, np.s_[..., ::3, ::3]),
+    ({'y': slice(5, 17), 'x': slice(3, 30), 'stride': 2}, np.s_[..., 5:17:2, 3:30:2]),
+    # Partly outside of the 24 x 40 tiles
+    ({'y': slice(20, 100), 'x': slice(-8, None)}, np.s_[..., 20:100, -8:]),
+    ({'y': slice(10, 100), 'x': slice(35, 60), 'z': slice(2, 10)}, np.s_[:, :, 2:10, 10:100, 35:60]),
+])
+def test_region(image_store, kwargs, index):
+    np.testing.assert_array_equal(_get_region(image_store, **kwargs), image_store.expected()[index])
+
+
+def test_region_from_cache(image_store, tmp_path):
+    cache = TileCache(str(tmp_path))
+    # The full tiles are cached by the first request
+    _get_region(image_store, cache=cache)
+
+    stack = _get_region(image_store, cache=cache, y=slice(4, 100), x=slice(None, 7), stride=2)
+
+    np.testing.assert_array_equal(stack, image_store.expected()[..., 4:100:2, :7:2])
+    assert cache.misses == len(image_store.image_ids) * len(image_store.channels) * image_store.n_slices
+
+
+@pytest.mark.parametrize('z', [slice(5, None), slice(3, 3), slice(2, 0)])
+def test_empty_z_range(image_store, z):
+    with pytest.raises(ValueError, match='selects no slices of the 3 slices'):
+        _get_region(image_store, z=z)
+
+
+def _frame(dataset_serial, channel_name, slice_idx):
+    return FrameRecord(
+        dataset_serial, channel_name, 0, 0, slice_idx, 'im.png', 's3_dir', 40, 24, 'uint16', 'sha'
+    )
+
+
+def test_select_slices_of_ragged_stacks():
+    frames = [_frame('a', 'Cy5', z) for z in range(5)] + [_frame('b', 'Cy5', z) for z in range(2)]
+    plan = FramePlan(['a', 'b'], ['Cy5'], frames)
+
+    selected = plan.select_slices(slice(1, 3))
+    assert selected.round_slices() == [2, 1]
+
+    with pytest.raises(ValueError, match='z range 2: selects no slices of the 2 slices of dataset b'):
+        plan.select_slices(slice(2, None))
+    with pytest.raises(ValueError, match='z must be a slice'):
+        plan.select_slices(1)
+
+
+@pytest.mark.parametrize('tif_kwargs', [
+    {},
+    {'compression': 'zlib', 'rowsperstrip': 7},
+    {'compression': 'zlib', 'tile': (16, 16)},
+])
+@pytest.mark.parametrize('y, x, stride', [
+    (slice(3, 21), slice(17, 50), 1),
+    (slice(30, 90), slice(None, 20), 3),
+    (slice(-10, None), slice(60, 200), 2),
+])
+def test_tiff_region(tmp_path, tif_kwargs, y, x, stride):
+    tile = np.random.RandomState(0).randint(0, 4096, size=(64, 80)).astype(np.uint16)
+    tifffile.imwrite(str(tmp_path / 'im.tif'), tile, **tif_kwargs)
+
+    storage = LocalStorage(str(tmp_path), '.')
+    region = make_region(y, x, stride)
+
+    np.testing.assert_array_equal(storage.get_im_region('im.tif', region), tile[region])
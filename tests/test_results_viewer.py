@@ -0,0 +1,183 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+pytest.importorskip('starfish')
+pytest.importorskip('napari')
+
+from InSituToolkit.analysis import results_viewer
+from InSituToolkit.analysis.run_pipeline import FOV_TABLE
+
+
+def _compute_results(fov_data, exp, target_channels=None):
+    im_max_proj = np.arange(2 * 64 * 96, dtype=np.float32).reshape(2, 64, 96)
+    points = [{'coords': np.array([[0, 1.0, 2.0]]), 'name': 'gene'}]
+    return im_max_proj, points
+
+
+@pytest.fixture
+def pipeline_output(tmp_path, monkeypatch):
+    """
+    fovs.csv as written by run_pipeline, with a mask for fov_000 and none for
+    fov_001
+    """
+    monkeypatch.setattr(results_viewer, '_compute_results', _compute_results)
+
+    mask_file = str(tmp_path / 'fov_000_mask.tif')
+    tifffile.imwrite(mask_file, np.arange(64 * 96, dtype=np.int32).reshape(64, 96))
+    fov_df = pd.DataFrame([
+        {'fov_name': 'fov_000', 'spot_file': str(tmp_path / 'fov_000_spots.nc'), 'mask_file': mask_file},
+        {'fov_name': 'fov_001', 'spot_file': str(tmp_path / 'fov_001_spots.nc'), 'mask_file': None},
+    ])
+    fov_df.to_csv(os.path.join(str(tmp_path), FOV_TABLE), index=False)
+
+    return fov_df
+
+
+@pytest.mark.parametrize('from_csv', [False, True])
+def test_load_data_without_mask(tmp_path, pipeline_output, from_csv):
+    fov_df = pipeline_output
+    if from_csv:
+        # The missing mask file is read back as NaN
+        fov_df = pd.read_csv(os.path.join(str(tmp_path), FOV_TABLE))
+
+    im_pyramid, points, mask_pyramid = results_viewer._load_data(fov_df.loc[1], exp=None)
+    assert mask_pyramid is None
+    assert im_pyramid[0].shape == (2, 64, 96)
+    assert points[0]['name'] == 'gene'
+
+    _, _, mask_pyramid = results_viewer._load_data(fov_df.loc[0], exp=None)
+    assert mask_pyramid[0].shape == (64, 96)
+
+
+class _Viewer:
+    def __init__(self):
+        self.layers = []
+
+    def add_labels(self, data, **kwargs):
+        layer = SimpleNamespace(data=data, visible=True, **kwargs)
+        self.layers.append(layer)
+        return layer
+
+
+def test_update_mask():
+    viewer = _Viewer()
+    layers = {'mask': None}
+
+    # No layer is added until a field of view has a mask
+    results_viewer._update_mask(viewer, layers, None)
+    assert viewer.layers == []
+
+    mask_pyramid = [np.zeros((4, 4), dtype=np.int32)]
+    results_viewer._update_mask(viewer, layers, mask_pyramid)
+    assert layers['mask'].data is mask_pyramid
+    assert layers['mask'].visible
+
+    results_viewer._update_mask(viewer, layers, None)
+    assert not layers['mask'].visible
+
+    results_viewer._update_mask(viewer, layers, mask_pyramid)
+    assert layers['mask'].visible
+    assert len(viewer.layers) == 1
+
+
+def test_load_data_recomputes_stale_sidecar(tmp_path, pipeline_output, monkeypatch):
+    from InSituToolkit.analysis._sidecar import fov_sources, open_sidecar, write_fov
+
+    fov_data = pipeline_output.loc[1]
+    with open(fov_data.spot_file, 'w') as f:
+        f.write('spots')
+
+    sidecar = open_sidecar(str(tmp_path / 'results.zarr'), mode='w')
+    stored = [np.zeros((2, 64, 96), dtype=np.float32)]
+    write_fov(sidecar, fov_data.fov_name, stored, [], sources=fov_sources(fov_data.spot_file))
+
+    im_pyramid, points, _ = results_viewer._load_data(fov_data, exp=None, sidecar=sidecar)
+    assert points == []
+    np.testing.assert_array_equal(im_pyramid[0][...], stored[0])
+
+    stat = os.stat(fov_data.spot_file)
+    os.utime(fov_data.spot_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    im_pyramid, points, _ = results_viewer._load_data(fov_data, exp=None, sidecar=sidecar)
+    assert points[0]['name'] == 'gene'
+    np.testing.assert_array_equal(im_pyramid[0], _compute_results(fov_data, None)[0])
+
+
+def _codebook():
+    xr = pytest.importorskip('xarray')
+    from starfish.types import Axes, Features
+
+    # (target, c, r) codes over 3 channels and 2 rounds
+    codes = np.zeros((4, 3, 2), dtype=np.uint8)
+    codes[0, 1, 0] = 1                    # gene_a: c1 in round 0
+    codes[1, 2, 0] = codes[1, 0, 1] = 1   # gene_b: c2 in round 0, c0 in round 1
+    codes[2, 2, 1] = 1                    # gene_c: c2 in round 1, no spots
+    codes[3, 1, 1] = codes[3, 2, 0] = 1   # gene_d: c2 in round 0, c1 in round 1
+
+    return xr.DataArray(
+        codes, dims=(Features.TARGET, Axes.CH.value, Axes.ROUND.value),
+        coords={Features.TARGET: ['gene_a', 'gene_b', 'gene_c', 'gene_d']}
+    )
+
+
+def _intensity_table(targets):
+    xr = pytest.importorskip('xarray')
+    from starfish.types import Axes, Features
+
+    rng = np.random.RandomState(0)
+    n_spots = len(targets)
+    return xr.DataArray(
+        np.zeros((n_spots, 3, 2)), dims=('features', Axes.CH.value, Axes.ROUND.value),
+        coords={
+            Features.TARGET: ('features', targets),
+            Axes.X.value: ('features', rng.rand(n_spots) * 100),
+            Axes.Y.value: ('features', rng.rand(n_spots) * 100),
+        }
+    )
+
+
+def test_target_channels_multi_round():
+    assert results_viewer._target_channels(_codebook()) == {
+        'gene_a': 1, 'gene_b': 0, 'gene_c': 2, 'gene_d': 1
+    }
+
+
+def test_get_points_matches_per_target_loop():
+    from starfish.types import Axes, Features
+
+    codebook = _codebook()
+    target_channels = results_viewer._target_channels(codebook)
+    # Unknown targets (not in the codebook) are dropped, gene_c has no spots
+    targets = ['gene_d', 'gene_a', 'nan', 'gene_b', 'gene_a', 'unknown', 'gene_d', 'gene_a']
+    it = _intensity_table(targets)
+
+    points = results_viewer._get_points(it, SimpleNamespace(codebook=codebook))
+    # The precomputed channels give the same points
+    for point, other in zip(points, results_viewer._get_points(it, None, target_channels)):
+        assert point['name'] == other['name']
+        np.testing.assert_array_equal(point['coords'], other['coords'])
+
+    # The per target loop the grouping replaced
+    spot_targets = it[Features.TARGET].values
+    x, y = it[Axes.X.value].values, it[Axes.Y.value].values
+    assert [p['name'] for p in points] == ['gene_a', 'gene_b', 'gene_c', 'gene_d']
+    for point in points:
+        spots = np.where(spot_targets == point['name'])[0]
+        expected = np.column_stack([np.full(len(spots), target_channels[point['name']]), y[spots], x[spots]])
+        assert point['coords'].shape == (len(spots), 3)
+        np.testing.assert_array_equal(point['coords'], expected)
+
+    assert len(points[2]['coords']) == 0
+    assert sum(len(p['coords']) for p in points) == 6
+
+
+def test_get_points_without_spots():
+    codebook = _codebook()
+    points = results_viewer._get_points(_intensity_table([]), SimpleNamespace(codebook=codebook))
+
+    assert [p['name'] for p in points] == ['gene_a', 'gene_b', 'gene_c', 'gene_d']
+    assert all(p['coords'].shape == (0, 3) for p in points)
@@ -0,0 +1,137 @@
+from concurrent.futures import ThreadPoolExecutor
+import importlib
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+import tifffile
+
+pytest.importorskip('starfish')
+pytest.importorskip('napari')
+
+from InSituToolkit.analysis.run_pipeline import FOV_TABLE, SpotPipeline, run_pipeline
+
+# The package exports the run_pipeline function under the module's name
+run_pipeline_module = importlib.import_module('InSituToolkit.analysis.run_pipeline')
+
+
+class _FieldOfView:
+    def __init__(self, name, image_types):
+        self.name = name
+        self.image_types = set(image_types)
+
+
+class _Experiment:
+    codebook = 'codebook'
+
+    def __init__(self, image_types):
+        self._fovs = {
+            name: _FieldOfView(name, types) for name, types in image_types.items()
+        }
+
+    def keys(self):
+        return self._fovs.keys()
+
+    def __getitem__(self, fov_name):
+        return self._fovs[fov_name]
+
+
+class _Spots:
+    def __init__(self, fov_name):
+        self.fov_name = fov_name
+
+    def to_netcdf(self, file_name):
+        with open(file_name, 'w') as f:
+            f.write(self.fov_name)
+
+
+class _Pipeline(SpotPipeline):
+    """
+    Per field of view stub of the starfish pipeline. fov_000 finishes last
+    and the fields of view in fail raise.
+    """
+    def __init__(self, fail=(), **kwargs):
+        super().__init__(filters=[], spot_finder=object(), segmenter=object(), segmentation_filters=[], **kwargs)
+        self.fail = set(fail)
+
+    def find_spots(self, fov, codebook):
+        assert codebook == 'codebook'
+        if fov.name == 'fov_000':
+            time.sleep(0.1)
+        if fov.name in self.fail:
+            raise KeyError(fov.name)
+        return _Spots(fov.name)
+
+    def segment(self, fov):
+        return np.full((8, 8), int(fov.name[-1]), dtype=np.int32)
+
+
+@pytest.fixture
+def experiment(monkeypatch):
+    """
+    Sets the image types of the fields of view of the experiment loaded by
+    run_pipeline, which runs the fields of view on threads
+    """
+    image_types = {}
+
+    def from_json(experiment_path):
+        assert experiment_path == 'experiment.json'
+        return _Experiment(image_types)
+
+    monkeypatch.setattr(run_pipeline_module, 'Experiment', SimpleNamespace(from_json=from_json))
+    monkeypatch.setattr(run_pipeline_module, 'ProcessPoolExecutor', ThreadPoolExecutor)
+
+    return image_types
+
+
+def test_run_pipeline(tmp_path, experiment):
+    experiment.update({name: ['primary', 'stain', 'nuclei'] for name in ['fov_000', 'fov_001']})
+    output_dir = str(tmp_path / 'output')
+
+    fov_df = run_pipeline('experiment.json', output_dir, _Pipeline(), n_workers=2)
+
+    # In the order of the fields of view, not the order they finished in
+    assert fov_df['fov_name'].tolist() == ['fov_000', 'fov_001']
+    for i, row in fov_df.iterrows():
+        with open(row['spot_file']) as f:
+            assert f.read() == row['fov_name']
+        np.testing.assert_array_equal(tifffile.imread(row['mask_file']), np.full((8, 8), i))
+    pd.testing.assert_frame_equal(pd.read_csv(os.path.join(output_dir, FOV_TABLE)), fov_df)
+    assert not any(name.endswith('.tmp') for name in os.listdir(output_dir))
+
+
+def test_run_pipeline_error(tmp_path, experiment):
+    experiment.update({name: ['primary', 'stain', 'nuclei'] for name in ['fov_000', 'fov_001']})
+    output_dir = str(tmp_path / 'output')
+
+    with pytest.raises(RuntimeError, match=r'fov_000 \(KeyError'):
+        run_pipeline('experiment.json', output_dir, _Pipeline(fail=['fov_000']), n_workers=2)
+
+    # The other field of view is done and the failed one is rerun
+    assert pd.read_csv(os.path.join(output_dir, FOV_TABLE))['fov_name'].tolist() == ['fov_001']
+    fov_df = run_pipeline('experiment.json', output_dir, _Pipeline(), n_workers=2)
+    assert fov_df['fov_name'].tolist() == ['fov_000', 'fov_001']
+
+
+def test_run_pipeline_without_segmentation_images(tmp_path, experiment):
+    experiment.update({name: ['primary'] for name in ['fov_000', 'fov_001']})
+    pipeline = _Pipeline()
+
+    fov_df = run_pipeline('experiment.json', str(tmp_path), pipeline, n_workers=2)
+
+    assert fov_df['mask_file'].isna().all()
+    assert all(os.path.isfile(spot_file) for spot_file in fov_df['spot_file'])
+    # The pipeline of the caller is unchanged
+    assert pipeline.segmentation is None
+
+
+def test_run_pipeline_segmentation_needs_images(tmp_path, experiment):
+    experiment.update({'fov_000': ['primary', 'stain', 'nuclei'], 'fov_001': ['primary', 'stain']})
+
+    with pytest.raises(ValueError, match=r'fov_001 \(nuclei\)'):
+        run_pipeline('experiment.json', str(tmp_path), _Pipeline(segmentation=True))
+
+    assert os.listdir(str(tmp_path)) == []
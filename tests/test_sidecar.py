@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('starfish')
+pytest.importorskip('napari')
+
+from InSituToolkit.analysis._sidecar import fov_sources, open_sidecar, read_fov, write_fov
+from InSituToolkit.analysis.pyramid import image_pyramid, label_pyramid
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = {}
+    for name in ['spots.nc', 'mask.tif', 'experiment.json']:
+        paths[name] = str(tmp_path / name)
+        with open(paths[name], 'w') as f:
+            f.write(name)
+
+    return paths
+
+
+def _write(sidecar, sources=None, with_mask=True):
+    rng = np.random.RandomState(0)
+    image = rng.rand(2, 600, 520).astype(np.float32)
+    mask = rng.randint(0, 50, size=(600, 520)).astype(np.int32)
+    points = [
+        {'coords': rng.rand(5, 3), 'name': 'gene_a'},
+        {'coords': np.empty((0, 3)), 'name': 'gene_b'},
+        {'coords': rng.rand(3, 3), 'name': 'gene_c'},
+    ]
+    write_fov(
+        sidecar, 'fov_000', image_pyramid(image), points,
+        label_pyramid(mask) if with_mask else None, sources
+    )
+
+    return image, mask, points
+
+
+def test_round_trip(tmp_path):
+    sidecar = open_sidecar(str(tmp_path / 'results.zarr'), mode='w')
+    image, mask, points = _write(sidecar)
+
+    pyramid, read_points, mask_pyramid = read_fov(open_sidecar(str(tmp_path / 'results.zarr')), 'fov_000')
+    assert [level.shape[-2:] for level in pyramid] == [(600, 520), (300, 260), (150, 130)]
+    np.testing.assert_array_equal(pyramid[0][...], image)
+    np.testing.assert_array_equal(mask_pyramid[0][...], mask)
+    assert [p['name'] for p in read_points] == ['gene_a', 'gene_b', 'gene_c']
+    for point, read_point in zip(points, read_points):
+        np.testing.assert_array_equal(read_point['coords'], point['coords'])
+
+    assert read_fov(sidecar, 'fov_001') is None
+
+
+def test_without_mask(tmp_path):
+    sidecar = open_sidecar(str(tmp_path / 'results.zarr'), mode='w')
+    _write(sidecar, with_mask=False)
+
+    assert read_fov(sidecar, 'fov_000')[2] is None
+
+
+def test_incomplete_is_ignored(tmp_path):
+    sidecar = open_sidecar(str(tmp_path / 'results.zarr'), mode='w')
+    _write(sidecar)
+    sidecar['fov_000'].attrs['complete'] = False
+
+    assert read_fov(sidecar, 'fov_000') is None
+
+
+def test_changed_sources_are_stale(tmp_path, files):
+    sidecar = open_sidecar(str(tmp_path / 'results.zarr'), mode='w')
+    sources = fov_sources(files['spots.nc'], files['mask.tif'], files['experiment.json'])
+    _write(sidecar, sources)
+
+    def current_sources(experiment_path=files['experiment.json']):
+        return fov_sources(files['spots.nc'], files['mask.tif'], experiment_path)
+
+    assert read_fov(sidecar, 'fov_000', current_sources()) is not None
+    # The sources aren't checked if they aren't given
+    assert read_fov(sidecar, 'fov_000') is not None
+    # Nor is the experiment if it isn't given
+    assert read_fov(sidecar, 'fov_000', fov_sources(files['spots.nc'], files['mask.tif'])) is not None
+
+    assert read_fov(sidecar, 'fov_000', current_sources(str(tmp_path / 'other.json'))) is None
+
+    # A rerun of the pipeline rewrites the spot file
+    stat = os.stat(files['spots.nc'])
+    os.utime(files['spots.nc'], ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert read_fov(sidecar, 'fov_000', current_sources()) is None
+
+
+def test_removed_mask_is_stale(tmp_path, files):
+    sidecar = open_sidecar(str(tmp_path / 'results.zarr'), mode='w')
+    _write(sidecar, fov_sources(files['spots.nc'], files['mask.tif']))
+
+    assert read_fov(sidecar, 'fov_000', fov_sources(files['spots.nc'], None)) is None
+
+
+def test_rewrite_with_smaller_pyramid_and_no_mask(tmp_path):
+    sidecar = open_sidecar(str(tmp_path / 'results.zarr'), mode='w')
+    _write(sidecar)
+
+    image = np.ones((2, 200, 180), dtype=np.float32)
+    write_fov(sidecar, 'fov_000', image_pyramid(image), [])
+
+    pyramid, points, mask_pyramid = read_fov(open_sidecar(str(tmp_path / 'results.zarr')), 'fov_000')
+    assert [level.shape for level in pyramid] == [(2, 200, 180)]
+    np.testing.assert_array_equal(pyramid[0][...], image)
+    assert points == []
+    assert mask_pyramid is None
+    assert sorted(sidecar['fov_000']['max_proj']) == ['0']
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from skimage import img_as_float32
+import tifffile
+
+pytest.importorskip('starfish')
+pytest.importorskip('napari')
+
+from starfish import ImageStack
+
+from InSituToolkit.analysis import save_stack, stack_from_tif
+
+
+def _image(shape):
+    return np.random.RandomState(0).randint(0, 2 ** 16, size=shape).astype(np.uint16)
+
+
+@pytest.mark.parametrize('file_name', ['stack.tif', 'stack.ome.tif'])
+@pytest.mark.parametrize('compression_level, n_workers', [(0, 1), (6, 1), (6, 4)])
+def test_round_trip(tmp_path, file_name, compression_level, n_workers):
+    image = _image((2, 3, 4, 24, 40))
+    path = str(tmp_path / file_name)
+
+    save_stack(ImageStack.from_numpy(image), path, compression_level, n_workers)
+
+    with tifffile.TiffFile(path) as tif:
+        assert tif.is_bigtiff
+        assert tif.series[0].axes == 'TCZYX'
+        np.testing.assert_array_equal(tif.asarray(), image)
+    np.testing.assert_array_equal(stack_from_tif(path).xarray.values, img_as_float32(image))
+
+
+def test_singleton_axes(tmp_path):
+    image = _image((1, 3, 1, 24, 40))
+    path = str(tmp_path / 'stack.tif')
+
+    save_stack(ImageStack.from_numpy(image), path)
+
+    with tifffile.TiffFile(path) as tif:
+        assert tif.series[0].axes == 'CYX'
+    np.testing.assert_array_equal(stack_from_tif(path).xarray.values, img_as_float32(image))
+
+
+@pytest.mark.parametrize('axes, shape', [('TZCYX', (2, 4, 3, 24, 40)), ('ZCYX', (4, 3, 24, 40))])
+def test_imagej_axes(tmp_path, axes, shape):
+    image = _image(shape)
+    path = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(path, image, imagej=True, metadata={'axes': axes})
+
+    stack = stack_from_tif(path).xarray.values
+
+    # ImageJ hyperstacks are (t, z, c, y, x)
+    expected = image.reshape((-1,) + image.shape[-4:]).transpose(0, 2, 1, 3, 4)
+    np.testing.assert_array_equal(stack, img_as_float32(expected))
+
+
+def test_plain_stack_is_channels(tmp_path):
+    image = _image((3, 24, 40))
+    path = str(tmp_path / 'stack.tif')
+    tifffile.imwrite(path, image, photometric='minisblack')
+
+    stack = stack_from_tif(path).xarray.values
+
+    np.testing.assert_array_equal(stack, img_as_float32(image[np.newaxis, :, np.newaxis]))
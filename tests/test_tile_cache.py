@@ -0,0 +1,85 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import TileCache
+
+
+def _tile(value, shape=(32, 32)):
+    return np.full(shape, value, dtype=np.uint16)
+
+
+def _set_mtime(cache, file_name, mtime):
+    path = cache._path(cache.key('s3_dir', file_name, 'sha'))
+    os.utime(path, (mtime, mtime))
+
+
+def test_round_trip(tmp_path):
+    cache = TileCache(str(tmp_path))
+    assert cache.get('s3_dir', 'a.png', 'sha') is None
+
+    cache.put('s3_dir', 'a.png', 'sha', _tile(1))
+    np.testing.assert_array_equal(cache.get('s3_dir', 'a.png', 'sha'), _tile(1))
+
+    stats = cache.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+
+def test_put_again_replaces_size(tmp_path):
+    cache = TileCache(str(tmp_path))
+    cache.put('s3_dir', 'a.png', 'sha', _tile(1))
+    size = cache.stats()['size_bytes']
+
+    for _ in range(3):
+        cache.put('s3_dir', 'a.png', 'sha', _tile(2))
+
+    assert cache.stats()['size_bytes'] == size
+    assert cache.evictions == 0
+    np.testing.assert_array_equal(cache.get('s3_dir', 'a.png', 'sha'), _tile(2))
+
+
+def test_evicts_least_recently_used_to_low_water(tmp_path):
+    cache = TileCache(str(tmp_path))
+    cache.put('s3_dir', 'a.png', 'sha', _tile(0))
+    tile_size = cache.stats()['size_bytes']
+    # Room for 4 tiles, and the low-water mark is below 4 tiles
+    cache.max_bytes = 4 * tile_size + tile_size // 4
+
+    for i, file_name in enumerate(['a.png', 'b.png', 'c.png', 'd.png']):
+        cache.put('s3_dir', file_name, 'sha', _tile(i))
+        _set_mtime(cache, file_name, 1000 + i)
+    # Reading a marks it as recently used
+    assert cache.get('s3_dir', 'a.png', 'sha') is not None
+
+    cache.put('s3_dir', 'e.png', 'sha', _tile(4))
+
+    assert cache.evictions == 2
+    assert cache.stats()['size_bytes'] == 3 * tile_size
+    assert cache.get('s3_dir', 'b.png', 'sha') is None
+    assert cache.get('s3_dir', 'c.png', 'sha') is None
+    for file_name in ['a.png', 'd.png', 'e.png']:
+        assert cache.get('s3_dir', file_name, 'sha') is not None
+
+
+@pytest.mark.parametrize('content', [b'', b'garbage' * 10, 'truncated'])
+def test_corrupt_entry_is_a_miss(tmp_path, content):
+    cache = TileCache(str(tmp_path))
+    cache.put('s3_dir', 'a.png', 'sha', _tile(1))
+    path = cache._path(cache.key('s3_dir', 'a.png', 'sha'))
+
+    if content == 'truncated':
+        with open(path, 'rb') as f:
+            content = f.read()[:200]
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    assert cache.get('s3_dir', 'a.png', 'sha') is None
+    assert cache.misses == 1
+
+    # Putting the tile again repairs the entry
+    cache.put('s3_dir', 'a.png', 'sha', _tile(1))
+    np.testing.assert_array_equal(cache.get('s3_dir', 'a.png', 'sha'), _tile(1))
@@ -0,0 +1,123 @@
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('imaging_db')
+
+from InSituToolkit.imaging_database import TileCache
+from InSituToolkit.imaging_database._storage import LocalStorage
+from InSituToolkit.imaging_database._tile_downloader import TileDownloader
+
+
+class _FakeStorage:
+    """
+    Storage returning a tile per file name, failing the first n_failures
+    requests of each file and every request of the files in missing
+    """
+    def __init__(self, n_failures=0, missing=()):
+        self.n_failures = n_failures
+        self.missing = set(missing)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def get_im(self, file_name):
+        with self._lock:
+            self.calls.append(file_name)
+            n_calls = self.calls.count(file_name)
+        if file_name in self.missing:
+            raise FileNotFoundError(file_name)
+        if n_calls <= self.n_failures:
+            raise ConnectionError('Connection reset')
+
+        return _tile(file_name)
+
+
+def _tile(file_name):
+    return np.full((8, 12), int(file_name.split('.')[0]), dtype=np.uint16)
+
+
+def _downloader(storage, **kwargs):
+    kwargs.setdefault('backoff', 0)
+    return TileDownloader(storage_factory=lambda s3_dir: storage, **kwargs)
+
+
+def _tiles(out):
+    return [(out[i], 's3_dir', '{}.png'.format(i), 'sha{}'.format(i)) for i in range(len(out))]
+
+
+def test_download():
+    storage = _FakeStorage()
+    out = np.zeros((20, 8, 12), dtype=np.uint16)
+    _downloader(storage, n_workers=4).download(_tiles(out))
+
+    for i in range(len(out)):
+        np.testing.assert_array_equal(out[i], _tile('{}.png'.format(i)))
+    assert len(storage.calls) == len(out)
+
+
+def test_retry_transient_errors():
+    storage = _FakeStorage(n_failures=2)
+    tile = _downloader(storage, max_retries=2).fetch('s3_dir', '3.png')
+
+    np.testing.assert_array_equal(tile, _tile('3.png'))
+    assert storage.calls == ['3.png'] * 3
+
+
+def test_retry_exhaustion():
+    storage = _FakeStorage(n_failures=10)
+    with pytest.raises(ConnectionError):
+        _downloader(storage, max_retries=3).fetch('s3_dir', '3.png')
+
+    assert storage.calls == ['3.png'] * 4
+
+
+def test_missing_tile(image_store):
+    downloader = TileDownloader(
+        max_retries=1, backoff=0,
+        storage_factory=lambda s3_dir: LocalStorage(image_store.data_path, s3_dir)
+    )
+    with pytest.raises(FileNotFoundError):
+        downloader.fetch('raw_frames/' + image_store.image_ids[0], 'missing.png')
+
+
+def test_first_exception_cancels_queued_tiles():
+    storage = _FakeStorage(missing=['0.png'])
+    out = np.zeros((50, 8, 12), dtype=np.uint16)
+
+    with pytest.raises(FileNotFoundError):
+        _downloader(storage, n_workers=1, max_retries=0).download(_tiles(out))
+
+    # The tiles queued behind the failed one are not downloaded
+    assert len(storage.calls) < len(out)
+
+
+def test_corrupt_cache_entry_is_downloaded_again(tmp_path):
+    cache = TileCache(str(tmp_path))
+    storage = _FakeStorage()
+    downloader = _downloader(storage, cache=cache)
+
+    downloader.fetch('s3_dir', '3.png', 'sha')
+    path = cache._path(cache.key('s3_dir', '3.png', 'sha'))
+    with open(path, 'r+b') as f:
+        f.truncate(100)
+
+    np.testing.assert_array_equal(downloader.fetch('s3_dir', '3.png', 'sha'), _tile('3.png'))
+    assert storage.calls == ['3.png'] * 2
+
+    # The repaired entry is served from the cache
+    np.testing.assert_array_equal(downloader.fetch('s3_dir', '3.png', 'sha'), _tile('3.png'))
+    assert storage.calls == ['3.png'] * 2
+    assert cache.hits == 1
+
+
+def test_tiles_without_checksum_are_not_cached(tmp_path):
+    cache = TileCache(str(tmp_path))
+    storage = _FakeStorage()
+    downloader = _downloader(storage, cache=cache)
+
+    downloader.fetch('s3_dir', '3.png')
+    downloader.fetch('s3_dir', '3.png')
+
+    assert storage.calls == ['3.png'] * 2
+    assert cache.stats()['size_bytes'] == 0
@@ -0,0 +1,93 @@
+import importlib
+
+import numpy as np
+import pytest
+from skimage import img_as_float32
+import zarr
+
+pytest.importorskip('imaging_db')
+pytest.importorskip('starfish')
+pytest.importorskip('napari')
+
+from _fixtures import frame_file_name
+
+from InSituToolkit.analysis import stack_from_zarr
+from InSituToolkit.imaging_database import write_zarr
+from InSituToolkit.imaging_database._storage import LocalStorage
+from InSituToolkit.imaging_database.zarr_writer import ZARR_DIMS
+
+
+@pytest.mark.parametrize('codec', ['zstd', None])
+def test_write_zarr(image_store, tmp_path, codec):
+    path = str(tmp_path / 'stack.zarr')
+    write_zarr(
+        image_store.db_url, path, image_store.image_ids, image_store.channels,
+        positions=[1, 0], codec=codec, n_workers=4, data_path=image_store.data_path
+    )
+
+    array = zarr.open(path, mode='r')
+    assert array.attrs['dims'] == ZARR_DIMS
+    assert array.attrs['positions'] == [1, 0]
+    assert array.chunks == (1, 1, 1, 1) + image_store.tile_shape
+    np.testing.assert_array_equal(array[0], image_store.expected(pos=1))
+    np.testing.assert_array_equal(array[1], image_store.expected(pos=0))
+
+
+def test_stack_from_zarr(image_store, tmp_path):
+    path = str(tmp_path / 'stack.zarr')
+    write_zarr(
+        image_store.db_url, path, image_store.image_ids, image_store.channels,
+        positions=[0, 1], data_path=image_store.data_path
+    )
+
+    stack = stack_from_zarr(path, fov=1, rounds=[1], zplanes=[0, 2])
+
+    expected = image_store.expected(pos=1)[[1]][:, :, [0, 2]]
+    np.testing.assert_array_equal(stack.xarray.values, img_as_float32(expected))
+
+
+def test_invalid_codec(image_store, tmp_path):
+    with pytest.raises(ValueError, match='codec'):
+        write_zarr(
+            image_store.db_url, str(tmp_path / 'stack.zarr'), image_store.image_ids,
+            image_store.channels, codec='gzip', data_path=image_store.data_path
+        )
+
+
+def test_write_zarr_retries_and_timeout(image_store, tmp_path, monkeypatch):
+    zarr_writer = importlib.import_module('InSituToolkit.imaging_database.zarr_writer')
+    failed_file = frame_file_name(1, 2, 0, 0)
+    factories = []
+
+    class _FlakyStorage(LocalStorage):
+        attempts = 0
+
+        def get_im(self, file_name):
+            if file_name == failed_file and self.s3_dir.endswith(image_store.image_ids[0]):
+                _FlakyStorage.attempts += 1
+                if _FlakyStorage.attempts == 1:
+                    raise ConnectionError('stalled read')
+            return super().get_im(file_name)
+
+    def make_storage_factory(data_path=None, timeout=None):
+        factories.append((data_path, timeout))
+        return lambda s3_dir: _FlakyStorage(data_path, s3_dir)
+
+    monkeypatch.setattr(zarr_writer, 'make_storage_factory', make_storage_factory)
+    path = str(tmp_path / 'stack.zarr')
+
+    with pytest.raises(ConnectionError):
+        write_zarr(
+            image_store.db_url, path, image_store.image_ids, image_store.channels,
+            max_retries=0, timeout=5, data_path=image_store.data_path
+        )
+    assert factories == [(image_store.data_path, 5)]
+
+    _FlakyStorage.attempts = 0
+    array = write_zarr(
+        image_store.db_url, path, image_store.image_ids, image_store.channels,
+        max_retries=1, data_path=image_store.data_path
+    )
+    assert _FlakyStorage.attempts == 2
+    assert factories[-1] == (image_store.data_path, 60)
+    np.testing.assert_array_equal(array[0], image_store.expected())